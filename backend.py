@@ -0,0 +1,381 @@
+import serialization
+from time import perf_counter
+from data_structures import MetadataBatch
+
+
+# Raised by a storage backend when the remote service refuses a request
+# because too many were issued in a short time (Telegram's FloodWait).
+# The number of seconds to wait before retrying is kept in 'seconds'.
+class ThrottledError(Exception):
+    def __init__(self, seconds):
+        super().__init__('throttled, retry in %s seconds' % seconds)
+        self.seconds = seconds
+
+
+# This class describes the storage used by the file system: a chat-like
+# sequence of immutable messages, each one holding a file and identified by
+# a message id, with one of them pinned to locate the superblock. TgFuseFs
+# only uses the public methods defined here, so any subclass implementing
+# the raw routines (_send_data, _download_data, _delete_data, _get_pinned_id
+# and _pin_data) can be mounted. Downloads are served from the local
+# block_cache (a BlockCache) when one is set and the calls to the raw
+# routines go through the transfers scheduler (a TransferScheduler) when
+# one is set. The calls and the bytes transferred are recorded in stats
+# (a Stats) when one is set. Small objects are grouped in packs when packs
+# (a PackStore) is set, their pointers are negative. The chunks of the files
+# are stored by content when dedup (a DedupStore) is set. The messages no
+# longer used are deleted in background by deletions (a DeletionQueue) when
+# it is set, once the superblock or journal batch not using them is pinned,
+# at once otherwise.
+class StorageBackend:
+    # persistent cache of message contents, None when not used
+    block_cache = None
+    # scheduler of the calls to the raw routines, None to call them directly
+    transfers = None
+    # performance counters, None when not recorded
+    stats = None
+    # store of the packed objects, None when not used
+    packs = None
+    # store of the chunks by content, None when not used
+    dedup = None
+    # queue of the messages to delete, None to delete them at once
+    deletions = None
+
+    # Routine to upload the given bytes as a new message with an optional
+    # caption. It returns the id of the new message.
+    async def _send_data(self, data, caption=None):
+        raise NotImplementedError
+
+    # Routine to download the contents of a message by its id. It returns
+    # the contents as bytes or None if the message doesn't exist.
+    async def _download_data(self, message_id):
+        raise NotImplementedError
+
+    # Routine to delete a message by its id.
+    async def _delete_data(self, message_id):
+        raise NotImplementedError
+
+    # Routine to get the id of the pinned message, None if there is none.
+    async def _get_pinned_id(self):
+        raise NotImplementedError
+
+    # Routine to pin the message with the given id.
+    async def _pin_data(self, message_id):
+        raise NotImplementedError
+
+    # Routine to delete several messages by their ids, in a single call
+    # when the storage supports it.
+    async def _delete_many(self, message_ids):
+        for message_id in message_ids:
+            await self._delete_data(message_id)
+
+    # Routine to call one of the raw routines (through the scheduler if any).
+    async def _call(self, routine, *args):
+        if self.stats is not None:
+            routine = self._timed(routine)
+        if self.transfers is None:
+            return await routine(*args)
+        return await self.transfers.run(routine, *args)
+
+    # Method to wrap a raw routine recording the latency and the errors of
+    # its calls (without the time waiting in the scheduler).
+    def _timed(self, routine):
+        label = 'call="%s"' % routine.__name__.lstrip('_')
+
+        async def timed_routine(*args):
+            start = perf_counter()
+            try:
+                return await routine(*args)
+            except Exception:
+                self.stats.count('tgfuse_backend_errors_total', label)
+                raise
+            finally:
+                self.stats.observe('tgfuse_backend_seconds', label, perf_counter() - start)
+        return timed_routine
+
+    # Routine to download a message counting the bytes downloaded.
+    async def _download(self, message_id):
+        data = await self._call(self._download_data, message_id)
+        if self.stats is not None and data is not None:
+            self.stats.count('tgfuse_downloaded_bytes_total', amount=len(data))
+        return data
+
+    # Routine to get the contents of a message from the block cache or
+    # download them (and cache them) when missing, or a packed object.
+    async def _fetch(self, message_id):
+        if message_id < 0:
+            return await self.packs.read(message_id)
+        # no cache: just download
+        if self.block_cache is None:
+            return await self._download(message_id)
+        # try the cache first
+        data = self.block_cache.get(message_id)
+        if data is None:
+            data = await self._download(message_id)
+            if data is not None:
+                self.block_cache.put(message_id, data)
+        return data
+
+    # Routine to upload data into the file system. It receives the data,
+    # a caption and the id of a message to delete once the upload has
+    # succeeded (used when replacing contents). It returns the new message id.
+    async def _upload_data(self, data, caption=None, old_to_delete=None):
+        # upload given data
+        message_id = await self._call(self._send_data, data, caption)
+        if self.stats is not None:
+            self.stats.count('tgfuse_uploaded_bytes_total', amount=len(data))
+        # keep it in the cache, it is likely to be read again
+        if self.block_cache is not None:
+            self.block_cache.put(message_id, data)
+        # if old to delete is provided then try to delete that message
+        if old_to_delete is not None:
+            await self.delete_data(old_to_delete)
+        # return the new message id
+        return message_id
+
+    # Routine to delete a message by its id (and from the cache), or to
+    # release a packed object or a reference to a deduplicated chunk. With
+    # deletions set it is only held (see take_deletions), so the inode no
+    # longer pointing to it must be marked as changed before.
+    async def delete_data(self, message_id):
+        if self.deletions is not None:
+            self.deletions.add(message_id)
+            return
+        message_id = await self._unreference(message_id)
+        if message_id is not None:
+            await self.release_deletions([message_id])
+
+    # Routine to release a packed object or a reference to a deduplicated
+    # chunk. It returns the message id to delete (None if there is none).
+    async def _unreference(self, pointer):
+        if self.dedup is not None and await self.dedup.release(pointer):
+            return None
+        if pointer < 0:
+            await self.packs.release(pointer)
+            return None
+        return pointer
+
+    # Routine to take the pointers deleted until now, when the metadata no
+    # longer pointing to them is being written. The packed objects and the
+    # references to deduplicated chunks are released at once (the pack
+    # table and the dedup index written next no longer hold them). It
+    # returns the message ids to delete once that metadata is pinned (see
+    # release_deletions), or to give back with restore_deletions when
+    # writing it fails.
+    async def take_deletions(self):
+        if self.deletions is None:
+            return []
+        pointers = list(self.deletions.take())
+        message_ids = []
+        for (n, pointer) in enumerate(pointers):
+            try:
+                message_id = await self._unreference(pointer)
+            except:
+                self.restore_deletions(message_ids + pointers[n:])
+                raise
+            if message_id is not None:
+                message_ids.append(message_id)
+        return message_ids
+
+    def restore_deletions(self, message_ids):
+        if self.deletions is not None:
+            self.deletions.restore(message_ids)
+
+    # Routine to delete the given messages, no longer used by the pinned
+    # superblock or journal batch.
+    async def release_deletions(self, message_ids):
+        if self.block_cache is not None:
+            for message_id in message_ids:
+                self.block_cache.discard(message_id)
+        if self.deletions is not None:
+            self.deletions.release(message_ids)
+            return
+        for message_id in message_ids:
+            await self._call(self._delete_data, message_id)
+
+    # Routine to delete the given messages at once (up to 100).
+    async def delete_batch(self, message_ids):
+        await self._call(self._delete_many, list(message_ids))
+
+    # Routine to write and pin the contents of the superblock file.
+    # This routine is used by the mktgfs.py script to set the superblock
+    # of the file system. The modified segments of the inode table are
+    # written first and the old messages (and the ones deleted until the
+    # segments are serialized) are only deleted once the new superblock is
+    # pinned, so a failure leaves the old one intact. The segments are
+    # serialized before saving the packs and the dedup index, so these hold
+    # every object the segments point to even when the file system is being
+    # modified meanwhile (see MetadataJournal).
+    async def write_superblock(self, superblock, should_replace=False):
+        # if the old superblock should be replaced get its message id, None otherwise
+        old_id = await self._call(self._get_pinned_id) if should_replace else None
+        # serialize the modified segments, they are clean from this moment
+        indexes = sorted(superblock.dirty)
+        superblock.dirty.difference_update(indexes)
+        serialized = [serialization.dumps(superblock.stored_segment(index)) for index in indexes]
+        # the messages deleted until now are no longer used by them
+        try:
+            deleted = await self.take_deletions()
+        except:
+            superblock.dirty.update(indexes)
+            raise
+        try:
+            # write the dedup index, upload the pending packs and write the
+            # pack table
+            old_index = None
+            old_packs = []
+            try:
+                if self.dedup is not None:
+                    (superblock.dedup_pointer, old_index) = await self.dedup.save()
+                if self.packs is not None:
+                    (superblock.pack_pointer, old_packs) = await self.packs.save()
+            except:
+                superblock.dirty.update(indexes)
+                raise
+            # write the modified segments
+            old_segments = []
+            for (n, (index, data)) in enumerate(zip(indexes, serialized)):
+                try:
+                    message_id = await self._upload_data(data, 'inode segment')
+                except:
+                    superblock.dirty.update(indexes[n:])
+                    raise
+                if superblock.pointers[index]:
+                    old_segments.append(superblock.pointers[index])
+                superblock.pointers[index] = message_id
+            # the journal (and the superblock it started from) is replaced too
+            journal = [message_id for message_id in superblock.journal if message_id != old_id]
+            replaced = [message_id for message_id in [old_id, old_index] if message_id is not None]
+            replaced += old_packs + old_segments + journal + deleted
+            # save the messages still to delete, including the ones
+            # replaced by this superblock, to delete them on the next mount
+            # when the storage is left before they are
+            if self.deletions is not None:
+                superblock.deletions = sorted(self.deletions.pending.union(replaced))
+            # serialize and save the superblock
+            message_id = await self._serialize_and_save(superblock, 'superblock')
+            # pin the message containing the superblock data
+            await self.pin(message_id)
+        except:
+            self.restore_deletions(deleted)
+            raise
+        superblock.head = message_id
+        superblock.journal = ()
+        # now the old messages can be deleted
+        await self.release_deletions(replaced)
+        # return the message id
+        return message_id
+
+    # Routine to pin the message with the given id (the superblock or the
+    # last batch of the metadata journal).
+    async def pin(self, message_id):
+        await self._call(self._pin_data, message_id)
+
+    # Routine to get the id of the message holding the superblock (None if
+    # there is none).
+    async def get_pinned_id(self):
+        return await self._call(self._get_pinned_id)
+
+    # Routine to look for the superblock pinned file and deserialize its
+    # contents to returned them. When the pinned message is a batch of the
+    # metadata journal the batches are followed back to the superblock they
+    # started from and replayed on it in order.
+    async def read_superblock(self):
+        # get the pinned message id, if there is none there is no superblock
+        head = await self._call(self._get_pinned_id)
+        if head is None:
+            return None
+        # deserialize the pinned message and the previous ones of the journal
+        message_id = head
+        batches = []
+        obj = await self.read_data(message_id)
+        while isinstance(obj, MetadataBatch):
+            batches.append((message_id, obj))
+            message_id = obj.previous
+            obj = await self.read_data(message_id)
+        superblock = obj
+        if superblock is None:
+            return None
+        superblock.head = head
+        if batches:
+            superblock.journal = [message_id] + [batch_id for (batch_id, _) in reversed(batches)]
+        for (_, batch) in reversed(batches):
+            superblock.replay(batch)
+        self.open_stores(superblock)
+        # return the superblock
+        return superblock
+
+    # Routine to use the packs and the dedup index of the given superblock
+    # (creating the stores if there are packs or deduplicated chunks but
+    # they are not set, to keep reading and releasing them), and queue the
+    # messages it left to delete.
+    def open_stores(self, superblock):
+        if self.packs is None and superblock.pack_pointer:
+            from packs import PackStore
+            self.packs = PackStore(self, max_object=0)
+        if self.packs is not None:
+            self.packs.open(superblock)
+        if self.dedup is None and superblock.dedup_pointer:
+            from dedup import DedupStore
+            self.dedup = DedupStore(self, enabled=False)
+        if self.dedup is not None:
+            self.dedup.open(superblock)
+        if self.deletions is not None:
+            self.deletions.release(superblock.deletions)
+
+    # Routine to write contents into a file. It the file already exists
+    # its contents are replaced. It additionally receives the caption
+    # of the file.
+    async def write_data(self, data, caption=None, old_to_delete=None):
+        # serialize and save data then return the message id
+        return await self.write_raw(serialization.dumps(data), caption, old_to_delete)
+
+    # Routine that looks for a file by its message id. If the file exists
+    # then its contents are deserialized and returned.
+    async def read_data(self, message_id):
+        # get the file by id
+        file = await self._fetch(message_id)
+        # the directory data, None as default
+        data = None
+        # if existed
+        if file is not None:
+            # deserialize the data
+            data = self._deserialize(file)
+        # return the retrieved data or None
+        return data
+
+    # Routine to write raw bytes (a chunk of a file) without serializing
+    # them. It returns the new message id (or the pointer to the packed
+    # object when small, unless may_pack is False).
+    async def write_raw(self, data, caption=None, old_to_delete=None, may_pack=True):
+        if may_pack and self.packs is not None and self.packs.accepts(data):
+            pointer = await self.packs.put(data)
+            if old_to_delete is not None:
+                await self.delete_data(old_to_delete)
+            return pointer
+        return await self._upload_data(data, caption, old_to_delete)
+
+    # Routine to write a chunk of a file, stored by content when dedup is
+    # set. It returns the pointer to the chunk.
+    async def write_chunk(self, data):
+        if self.dedup is not None:
+            return await self.dedup.write(data)
+        return await self.write_raw(data)
+
+    # Routine to read the raw bytes written by write_raw (None if missing).
+    # A cached message is returned as a read-only mmap.
+    async def read_raw(self, message_id):
+        return await self._fetch(message_id)
+
+    # Routine to serialize an object and save it into the storage.
+    async def _serialize_and_save(self, obj, caption=None, old_to_delete=None):
+        # serialize the given object (see serialization.py)
+        serialized = serialization.dumps(obj)
+        # upload the serialized data and return the message id
+        return await self._upload_data(serialized, caption, old_to_delete)
+
+    # Method to deserialize the contents of a file (also reads the pickled
+    # files written by older versions).
+    @staticmethod
+    def _deserialize(file):
+        return serialization.loads(file)
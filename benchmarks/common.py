@@ -0,0 +1,52 @@
+import os
+from time import perf_counter
+from types import SimpleNamespace
+
+
+# Request context used to drive the operations without a kernel.
+def make_ctx():
+    return SimpleNamespace(uid=os.getuid(), gid=os.getgid(), pid=os.getpid(), umask=0o022)
+
+
+# Collects the latency of every call by operation name and prints a
+# summary with the number of calls, operations per second (over the time
+# spent in the operation) and the p50/p99 latencies.
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+
+    # Routine to await the given coroutine recording its latency under name.
+    async def time(self, name, coro):
+        start = perf_counter()
+        try:
+            return await coro
+        finally:
+            self.samples.setdefault(name, []).append(perf_counter() - start)
+
+    # Routine to record an already measured latency.
+    def add(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds)
+
+    def report(self, title=None):
+        if title is not None:
+            print(title)
+        print('%-12s %8s %12s %12s %12s' % ('op', 'calls', 'ops/s', 'p50 (ms)', 'p99 (ms)'))
+        for (name, samples) in self.samples.items():
+            total = sum(samples)
+            print('%-12s %8d %12.1f %12.3f %12.3f' % (
+                name, len(samples), len(samples) / total if total else float('inf'),
+                percentile(samples, 50) * 1000, percentile(samples, 99) * 1000))
+
+
+# Routine to get the given percentile (0-100) of a list of samples.
+def percentile(samples, p):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+# Routine to format an amount of bytes per second.
+def rate(size, seconds):
+    return '%.2f MB/s' % (size / seconds / 1E6 if seconds else float('inf'))
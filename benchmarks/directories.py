@@ -0,0 +1,80 @@
+import asyncio
+import stat
+from argparse import ArgumentParser
+from time import perf_counter
+
+import tgfuse
+from mktgfs import make
+from local_backend import LocalBackend
+from benchmarks.common import *
+
+
+# Benchmark of a very large directory over a LocalBackend: it creates the
+# given number of files in a single directory, waiting for the write back
+# every few files (like a slow burst of touch), then lists the directory
+# in readdir calls of a few entries (like a kernel with a small buffer)
+# and reports the time and the bytes uploaded for the directory.
+# Run it from the repository root: python3 -m benchmarks.directories --help
+
+class CountingBackend(LocalBackend):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent_bytes = 0
+
+    async def _send_data(self, data, caption=None):
+        self.sent_bytes += len(data)
+        return await super()._send_data(data, caption)
+
+
+async def run(fs, options):
+    ctx = make_ctx()
+    dir_attr = await fs.mkdir(1, b'big', stat.S_IFDIR | 0o755, ctx)
+    start = perf_counter()
+    for i in range(options.entries):
+        await fs.mknod(dir_attr.st_ino, b'file%08d' % i, stat.S_IFREG | 0o644, 0, ctx)
+        if (i + 1) % options.sync_every == 0:
+            await fs.writeback.drain()
+    await fs.writeback.drain()
+    created = perf_counter() - start
+    # list it with the given number of entries per readdir call
+    entries = []
+
+    def readdir_reply(token, name, attr, next_id):
+        if len(token) == options.batch:
+            return False
+        token.append(next_id)
+        entries.append(name)
+        return True
+    tgfuse.readdir_reply = readdir_reply
+    start = perf_counter()
+    fh = await fs.opendir(dir_attr.st_ino, ctx)
+    offset = 0
+    while True:
+        token = []
+        await fs.readdir(fh, offset, token)
+        if not token:
+            break
+        offset = token[-1]
+    await fs.releasedir(fh)
+    listed = perf_counter() - start
+    await fs.close()
+    print('%d entries created in %.3f s (%.0f entries/s), %.2f MB uploaded' % (
+        options.entries, created, options.entries / created, fs.wrapper.sent_bytes / 1E6))
+    print('%d entries listed in %.3f s (%.0f entries/s)' % (len(entries), listed, len(entries) / listed))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--entries', type=int, default=100000, help='Number of files created in the directory')
+    parser.add_argument('--sync-every', type=int, default=100, help='Files created between write back drains')
+    parser.add_argument('--batch', type=int, default=100, help='Entries returned by each readdir call')
+    options = parser.parse_args()
+    backend = CountingBackend()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(make(backend))
+    fs = tgfuse.TgFuseFs(backend)
+    loop.run_until_complete(run(fs, options))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import asyncio
+import stat
+from argparse import ArgumentParser
+from time import perf_counter
+
+import tgfuse
+from mktgfs import make
+from local_backend import LocalBackend
+from block_cache import BlockCache
+from transfers import TransferScheduler
+from benchmarks.common import *
+
+
+# Benchmark of the TgFuseFs operations over a LocalBackend simulating the
+# latency, bandwidth and throttling of Telegram. The operations are called
+# directly (without a kernel) by a number of concurrent workers, each one
+# creating, writing, looking up, listing and reading back its own files.
+# Run it from the repository root: python3 -m benchmarks.ops --help
+
+# readdir replies are collected in a list (there is no kernel token)
+def readdir_reply(token, name, attr, next_id):
+    token.append((name, next_id))
+    return True
+
+
+async def worker(fs, rec, ctx, options, dir_inode_n, names, payload):
+    # create and write the files
+    for name in names:
+        (fi, attr) = await rec.time('create', fs.create(dir_inode_n, name, stat.S_IFREG | 0o644, 0, ctx))
+        for off in range(0, options.file_size, options.write_size):
+            await rec.time('write', fs.write(fi.fh, off, payload[off:off + options.write_size]))
+        await rec.time('release', fs.release(fi.fh))
+    # look them up
+    for name in names:
+        await rec.time('lookup', fs.lookup(dir_inode_n, name, ctx))
+    # list the directory
+    fh = await rec.time('opendir', fs.opendir(dir_inode_n, ctx))
+    await rec.time('readdir', fs.readdir(fh, 0, []))
+    await fs.releasedir(fh)
+    # read the files back
+    for name in names:
+        attr = await fs.lookup(dir_inode_n, name, ctx)
+        fi = await rec.time('open', fs.open(attr.st_ino, 0, ctx))
+        for off in range(0, options.file_size, options.read_size):
+            data = await rec.time('read', fs.read(fi.fh, off, options.read_size))
+            assert bytes(data) == payload[off:off + options.read_size]
+        await rec.time('release', fs.release(fi.fh))
+
+
+async def run(fs, options):
+    rec = Recorder()
+    ctx = make_ctx()
+    payload = bytes(range(256)) * (options.file_size // 256 + 1)
+    payload = payload[:options.file_size]
+    # one directory per worker
+    tasks = []
+    for w in range(options.workers):
+        attr = await rec.time('mkdir', fs.mkdir(1, b'dir%d' % w, stat.S_IFDIR | 0o755, ctx))
+        names = [b'file%d' % i for i in range(w, options.files, options.workers)]
+        tasks.append(worker(fs, rec, ctx, options, attr.st_ino, names, payload))
+    start = perf_counter()
+    await asyncio.gather(*tasks)
+    # unmount, waiting for the pending writes
+    await fs.close()
+    elapsed = perf_counter() - start
+    rec.report()
+    total = options.files * options.file_size
+    print('%d files, %d bytes each, in %.3f s (%s written and read back)' % (
+        options.files, options.file_size, elapsed, rate(2 * total, elapsed)))
+    print('throttled calls: %d' % fs.wrapper.throttled)
+    transfers = fs.wrapper.transfers
+    if transfers is not None:
+        print('transfers: %d retried after throttling (%.1f s waited), final limit %d of %d' % (
+            transfers.throttled, transfers.throttled_seconds, transfers.limit, transfers.max_transfers))
+    print('directory cache: %d hits, %d misses' % (fs.dir_cache.hits, fs.dir_cache.misses))
+    if fs.wrapper.block_cache is not None:
+        print('block cache: %d hits, %d misses' % (fs.wrapper.block_cache.hits, fs.wrapper.block_cache.misses))
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('--files', type=int, default=200, help='Number of files to create')
+    parser.add_argument('--file-size', type=int, default=64 * 1024, help='Size of each file in bytes')
+    parser.add_argument('--write-size', type=int, default=128 * 1024, help='Size of each write call')
+    parser.add_argument('--read-size', type=int, default=128 * 1024, help='Size of each read call')
+    parser.add_argument('--workers', type=int, default=1, help='Number of concurrent workers')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds of latency per call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Maximum random extra latency')
+    parser.add_argument('--bandwidth', type=float, default=None, help='Bytes per second of the link')
+    parser.add_argument('--rate-limit', type=float, default=None, help='Calls per second before throttling')
+    parser.add_argument('--burst', type=int, default=20, help='Calls allowed at once by the rate limit')
+    parser.add_argument('--flood-sleep-threshold', type=float, default=60,
+                        help='Throttling waits longer than this fail the call')
+    parser.add_argument('--transfers', type=int, default=8,
+                        help='Maximum number of concurrent transfers (0 to call the backend directly)')
+    parser.add_argument('--cache-dir', type=str, default=None, help='Directory of the block cache (none if absent)')
+    parser.add_argument('--cache-size', type=int, default=1024, help='Size of the block cache in MiB')
+    parser.add_argument('--storage', type=str, default=None, help='Directory to store messages (memory if absent)')
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    backend = LocalBackend(options.storage, latency=options.latency, jitter=options.jitter,
+                           bandwidth=options.bandwidth, rate_limit=options.rate_limit, burst=options.burst,
+                           flood_sleep_threshold=options.flood_sleep_threshold)
+    if options.transfers:
+        backend.transfers = TransferScheduler(options.transfers)
+    if options.cache_dir is not None:
+        backend.block_cache = BlockCache(options.cache_dir, options.cache_size * 1024 * 1024)
+    loop = asyncio.get_event_loop()
+    # create an empty file system and mount it
+    loop.run_until_complete(make(backend))
+    tgfuse.readdir_reply = readdir_reply
+    fs = tgfuse.TgFuseFs(backend)
+    loop.run_until_complete(run(fs, options))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import asyncio
+import random
+import stat
+from argparse import ArgumentParser
+from time import perf_counter
+
+import tgfuse
+from mktgfs import make
+from local_backend import LocalBackend
+from benchmarks.common import *
+
+
+# Benchmark of the reads of a large file over a LocalBackend with latency:
+# the file is read sequentially (like streaming a video) and at random
+# offsets, with readahead windows of the given sizes (0 disables it).
+# Every pass reads from a fresh mount so no chunk is loaded beforehand.
+# Run it from the repository root: python3 -m benchmarks.readahead --help
+
+async def write_file(fs, options):
+    ctx = make_ctx()
+    (fi, attr) = await fs.create(1, b'big', stat.S_IFREG | 0o644, 0, ctx)
+    payload = bytes(range(256)) * (options.write_size // 256)
+    for off in range(0, options.size, len(payload)):
+        await fs.write(fi.fh, off, payload)
+    await fs.release(fi.fh)
+    await fs.close()
+    return attr.st_ino
+
+
+async def read_file(fs, inode_n, offsets, options):
+    fi = await fs.open(inode_n, 0, make_ctx())
+    start = perf_counter()
+    for off in offsets:
+        await fs.read(fi.fh, off, options.read_size)
+    elapsed = perf_counter() - start
+    await fs.release(fi.fh)
+    await fs.close()
+    return elapsed
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--size', type=int, default=64 * 1024 * 1024, help='Size of the file in bytes')
+    parser.add_argument('--write-size', type=int, default=1024 * 1024, help='Size of each write call')
+    parser.add_argument('--read-size', type=int, default=128 * 1024, help='Size of each read call')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds of latency per call')
+    parser.add_argument('--bandwidth', type=float, default=None, help='Bytes per second of the link')
+    parser.add_argument('--windows', type=int, nargs='*', default=[0, 2, 8, 32],
+                        help='Readahead windows in chunks to compare (default: 0 2 8 32)')
+    options = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    backend = LocalBackend()
+    loop.run_until_complete(make(backend))
+    inode_n = loop.run_until_complete(write_file(tgfuse.TgFuseFs(backend), options))
+    # simulate the remote service only while reading
+    backend.latency = options.latency
+    backend.bandwidth = options.bandwidth
+    sequential = list(range(0, options.size, options.read_size))
+    shuffled = random.Random(0).sample(sequential, len(sequential) // 8)
+    print('%-10s %-12s %12s %14s' % ('window', 'access', 'time (s)', 'throughput'))
+    for window in options.windows:
+        for (name, offsets) in (('sequential', sequential), ('random', shuffled)):
+            fs = tgfuse.TgFuseFs(backend, readahead=window)
+            elapsed = loop.run_until_complete(read_file(fs, inode_n, offsets, options))
+            print('%-10d %-12s %12.3f %14s' % (window, name, elapsed,
+                                               rate(len(offsets) * options.read_size, elapsed)))
+
+
+if __name__ == '__main__':
+    main()
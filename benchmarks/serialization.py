@@ -0,0 +1,66 @@
+import pickle
+import random
+import stat
+from argparse import ArgumentParser
+from time import perf_counter
+
+import serialization
+from data_structures import *
+
+
+# Benchmark of the serialization of superblocks: time to encode and decode
+# and encoded size with pickle (the old format, a single message) and with
+# the binary format of serialization.py (the superblock and its segments),
+# for superblocks with the given numbers of inodes. For the binary format it
+# also shows what a mount reads (the superblock without segments) and what
+# a change of one inode writes (the superblock and a segment).
+# Most inodes are regular files with a few chunks, one in ten is a directory.
+# Run it from the repository root: python3 -m benchmarks.serialization --help
+
+def make_superblock(n_inodes):
+    rnd = random.Random(n_inodes)
+    superblock = Superblock()
+    for _ in range(n_inodes - 1):
+        inode = superblock.get_new_inode()
+        attr = inode.attributes
+        attr.st_uid = attr.st_gid = 1000
+        attr.st_atime_ns = attr.st_mtime_ns = attr.st_ctime_ns = 1700000000000000000 + rnd.randrange(10 ** 15)
+        if rnd.random() < 0.1:
+            attr.st_mode = stat.S_IFDIR | 0o755
+            inode.data_pointer = rnd.randrange(1, 10 ** 6)
+        else:
+            attr.st_mode = stat.S_IFREG | 0o644
+            attr.st_size = rnd.randrange(4 * CHUNK_SIZE)
+            inode.chunks = [rnd.randrange(1, 10 ** 6) for _ in range(-(-attr.st_size // CHUNK_SIZE))]
+    return superblock
+
+
+def measure(dumps, loads, objects):
+    start = perf_counter()
+    messages = [dumps(obj) for obj in objects]
+    encoded = perf_counter()
+    for data in messages:
+        loads(data)
+    decoded = perf_counter()
+    return (encoded - start, decoded - encoded, sum(len(data) for data in messages))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('sizes', type=int, nargs='*', default=[1000, 100000, 1000000],
+                        help='Numbers of inodes of the superblocks (default: 1k, 100k and 1M)')
+    options = parser.parse_args()
+    print('%-10s %-8s %14s %14s %14s' % ('inodes', 'format', 'encode (s)', 'decode (s)', 'size (bytes)'))
+    for n_inodes in options.sizes:
+        superblock = make_superblock(n_inodes)
+        segments = [superblock.segments[index] for index in sorted(superblock.segments)]
+        for (name, dumps, loads, objects) in (
+                ('pickle', pickle.dumps, pickle.loads, [superblock]),
+                ('binary', serialization.dumps, serialization.loads, [superblock] + segments),
+                ('mount', serialization.dumps, serialization.loads, [superblock]),
+                ('update', serialization.dumps, serialization.loads, [superblock, segments[-1]])):
+            print('%-10d %-8s %14.3f %14.3f %14d' % ((n_inodes, name) + measure(dumps, loads, objects)))
+
+
+if __name__ == '__main__':
+    main()
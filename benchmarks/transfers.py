@@ -0,0 +1,90 @@
+import asyncio
+import stat
+from argparse import ArgumentParser
+from time import perf_counter
+
+import tgfuse
+from mktgfs import make
+from local_backend import LocalBackend
+from transfers import TransferScheduler
+from data_structures import CHUNK_SIZE
+from benchmarks.common import *
+
+
+# Benchmark of the transfer scheduler over a LocalBackend with limited
+# bandwidth: while the write back uploads a batch of files, a reader reads
+# another file chunk by chunk. It reports the latency of those reads, the
+# time to upload the batch and the queue depth and transfers in flight
+# (sampled every 10 ms) for each number of concurrent transfers given (0
+# calls the backend directly, without priorities).
+# Run it from the repository root: python3 -m benchmarks.transfers --help
+
+async def sample(transfers, samples):
+    while True:
+        samples.append((transfers.queue_depth(), transfers.in_flight))
+        await asyncio.sleep(0.01)
+
+
+async def run(fs, inode_n, options):
+    ctx = make_ctx()
+    backend = fs.wrapper
+    rec = Recorder()
+    samples = []
+    sampler = asyncio.ensure_future(sample(backend.transfers, samples)) if backend.transfers else None
+    payload = bytes(range(256)) * (options.file_size // 256)
+    start = perf_counter()
+    # fill the write back queue (with new files every run)
+    for i in range(options.files):
+        (fi, _) = await fs.create(1, b'batch%d-%d' % (fs.wrapper.next_id, i), stat.S_IFREG | 0o644, 0, ctx)
+        await fs.write(fi.fh, 0, payload)
+        await fs.release(fi.fh)
+    # read while the batch is uploaded
+    fi = await fs.open(inode_n, 0, ctx)
+    for off in range(0, options.read_file_size, CHUNK_SIZE):
+        await rec.time('read', fs.read(fi.fh, off, 128 * 1024))
+    await fs.release(fi.fh)
+    await fs.writeback.drain()
+    uploaded = perf_counter() - start
+    if sampler is not None:
+        sampler.cancel()
+    await fs.close()
+    return (rec, uploaded, samples)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--files', type=int, default=32, help='Number of files uploaded in background')
+    parser.add_argument('--file-size', type=int, default=1024 * 1024, help='Size of each uploaded file in bytes')
+    parser.add_argument('--read-file-size', type=int, default=8 * 1024 * 1024, help='Size of the file read')
+    parser.add_argument('--upload-workers', type=int, default=8, help='Number of write back workers')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds of latency per call')
+    parser.add_argument('--bandwidth', type=float, default=20e6, help='Bytes per second of the link')
+    parser.add_argument('--limits', type=int, nargs='*', default=[0, 1, 2, 8],
+                        help='Numbers of concurrent transfers to compare (default: 0 1 2 8)')
+    options = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    backend = LocalBackend()
+    loop.run_until_complete(make(backend))
+    # write the file to be read
+    fs = tgfuse.TgFuseFs(backend)
+    ctx = make_ctx()
+    (fi, attr) = loop.run_until_complete(fs.create(1, b'read', stat.S_IFREG | 0o644, 0, ctx))
+    loop.run_until_complete(fs.write(fi.fh, 0, bytes(options.read_file_size)))
+    loop.run_until_complete(fs.release(fi.fh))
+    loop.run_until_complete(fs.close())
+    backend.latency = options.latency
+    backend.bandwidth = options.bandwidth
+    for limit in options.limits:
+        backend.transfers = TransferScheduler(limit) if limit else None
+        fs = tgfuse.TgFuseFs(backend, upload_workers=options.upload_workers, readahead=0)
+        (rec, uploaded, samples) = loop.run_until_complete(run(fs, attr.st_ino, options))
+        rec.report('transfers: %s' % (limit or 'direct'))
+        print('batch uploaded in %.3f s' % uploaded)
+        if samples:
+            print('queue depth: max %d, mean %.1f; in flight: max %d, mean %.1f' % (
+                max(q for (q, _) in samples), sum(q for (q, _) in samples) / len(samples),
+                max(n for (_, n) in samples), sum(n for (_, n) in samples) / len(samples)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import asyncio
+from argparse import ArgumentParser
+from time import perf_counter
+
+from data_structures import Inode
+from local_backend import LocalBackend
+from open_file import OpenFile
+from benchmarks.common import rate
+
+
+# Microbenchmark of the write path of an open file: a file is written
+# sequentially with FUSE-sized writes and the throughput is reported for
+# each tenth of the file, it should stay flat as the file grows. With
+# --naive the old write path (rebuilding the whole contents as bytes on
+# every write) is measured instead for comparison.
+# Run it from the repository root: python3 -m benchmarks.write_buffer --help
+
+async def write_open_file(options, buf, steps):
+    of = OpenFile(Inode(2), LocalBackend())
+    off = 0
+    for writes in steps:
+        start = perf_counter()
+        for _ in range(writes):
+            await of.write(off, buf)
+            off += len(buf)
+        yield perf_counter() - start
+
+
+async def write_naive(options, buf, steps):
+    data = b''
+    off = 0
+    for writes in steps:
+        start = perf_counter()
+        for _ in range(writes):
+            data = data[:off] + buf + data[off + len(buf):]
+            off += len(buf)
+        yield perf_counter() - start
+
+
+async def run(options):
+    buf = b'x' * options.write_size
+    total_writes = options.size // options.write_size
+    # split the writes in ten steps
+    steps = [total_writes // 10] * 10
+    steps[-1] += total_writes % 10
+    method = write_naive if options.naive else write_open_file
+    written = 0
+    print('%-24s %14s' % ('file size reached', 'throughput'))
+    # the time of each step is yielded once it is completed
+    async for elapsed in method(options, buf, list(steps)):
+        size = steps.pop(0) * options.write_size
+        written += size
+        print('%-24d %14s' % (written, rate(size, elapsed)))
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('--size', type=int, default=256 * 1024 * 1024, help='Final size of the file in bytes')
+    parser.add_argument('--write-size', type=int, default=128 * 1024, help='Size of each write call')
+    parser.add_argument('--naive', action='store_true', default=False,
+                        help='Measure the old whole-contents write path instead')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(run(parse_args()))
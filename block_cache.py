@@ -0,0 +1,97 @@
+import mmap
+import os
+from collections import OrderedDict
+
+
+# A persistent cache of message contents in a local directory, one file per
+# message named by its id. Message ids are never reused (every write creates
+# a new message) so cached contents never become stale: they are only
+# removed when the message is deleted or to keep the cache within its byte
+# budget, evicting the least recently used first. The recency survives
+# remounts through the modification time of the files. Hits are read
+# through mmap.
+class BlockCache:
+    def __init__(self, path, max_bytes):
+        # directory of the cache and its byte budget
+        self.path = path
+        self.max_bytes = max_bytes
+        # size of the cached messages by id, least recently used first
+        self.sizes = OrderedDict()
+        self.used_bytes = 0
+        # counters
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+        # load the cached messages ordered by their last use
+        entries = []
+        for entry in os.scandir(path):
+            # other files in the directory are left alone
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            name = entry.name
+            # remove leftovers of interrupted writes (see put)
+            if name.endswith('.tmp') and name[:-len('.tmp')].isdigit():
+                os.remove(entry.path)
+            elif name.isdigit():
+                st = entry.stat()
+                entries.append((st.st_mtime_ns, int(name), st.st_size))
+        for (_, message_id, size) in sorted(entries):
+            self.sizes[message_id] = size
+            self.used_bytes += size
+        self._evict()
+
+    def _file_path(self, message_id):
+        return os.path.join(self.path, str(message_id))
+
+    # Routine to get the contents of a message as a read-only mmap (or
+    # b'' when empty), None if it is not cached.
+    def get(self, message_id):
+        if message_id not in self.sizes:
+            self.misses += 1
+            return None
+        file_path = self._file_path(message_id)
+        try:
+            with open(file_path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.sizes[message_id] else b''
+            # mark it as the most recently used (also on disk)
+            os.utime(file_path)
+        except FileNotFoundError:
+            # removed from outside
+            self._forget(message_id)
+            self.misses += 1
+            return None
+        self.sizes.move_to_end(message_id)
+        self.hits += 1
+        return data
+
+    # Routine to cache the contents of a message evicting the least
+    # recently used ones if over budget.
+    def put(self, message_id, data):
+        size = len(data)
+        # too big to be cached or already cached
+        if size > self.max_bytes or message_id in self.sizes:
+            return
+        # write it in a temporary file and move it atomically
+        file_path = self._file_path(message_id)
+        with open(file_path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(file_path + '.tmp', file_path)
+        self.sizes[message_id] = size
+        self.used_bytes += size
+        self._evict()
+
+    # Routine to remove a message from the cache (if cached).
+    def discard(self, message_id):
+        if message_id in self.sizes:
+            self._forget(message_id)
+            try:
+                os.remove(self._file_path(message_id))
+            except FileNotFoundError:
+                pass
+
+    def _forget(self, message_id):
+        self.used_bytes -= self.sizes.pop(message_id)
+
+    def _evict(self):
+        while self.used_bytes > self.max_bytes:
+            self.discard(next(iter(self.sizes)))
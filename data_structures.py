@@ -1,17 +1,50 @@
 from pyfuse3 import *
+from bisect import bisect_right, insort
+from hashlib import blake2b
 import stat
 
+# size in bytes of the chunks in which the contents of a regular file are
+# split, each chunk being stored in its own message
+CHUNK_SIZE = 1024 * 1024
+# maximum size in bytes of a regular file
+MAX_FILE_SIZE = 1500 * 1000 * 1000
+# number of inodes in each segment of the inode table
+INODES_PER_SEGMENT = 4096
+# a directory doubles its number of shards when one of them has more
+# entries than this
+SHARD_ENTRIES = 2048
+# the shards of a directory are rewritten when its journal has more
+# records than this
+JOURNAL_RECORDS = 2048
+# bits of the hash of the names of directory entries
+HASH_BITS = 54
+# maximum number of objects in a pack
+PACK_SLOTS = 1 << 16
+
 
 # The inode object contains the metadata of a file.
 # In this implementation an inode recognizes either a regular file
 # or a directory. An inode object has a unique id to recognize a
-# file within the file system.
+# file within the file system. The contents of a regular file are
+# found through its chunk map, a list with the message id of each
+# chunk (0 for holes: chunks never written or holding only zeros, which
+# read as zeros without any transfer). Small contents are kept in
+# the inode itself instead (inline): the bytes of a regular file or the
+# serialized shard of a directory with a single one.
 class Inode:
+    # inodes of regular files created before chunking keep their whole
+    # contents as a FileData pointed by data_pointer and have no chunk map
+    chunks = None
+    # contents kept inline, None when stored in messages
+    inline = None
+
     def __init__(self, number):
         # inode attributes like 'stat'
         self.attributes = EntryAttributes()
-        # pointer to data (message id) or data when inlining
+        # pointer to data (message id), the data inlined is kept in inline
         self.data_pointer = 0
+        # chunk map of a regular file
+        self.chunks = []
         # init the number in attributes
         self.attributes.st_ino = number
 
@@ -23,42 +56,413 @@ class Inode:
         # check mode and return
         return stat.S_ISREG(self.attributes.st_mode)
 
+    # Routine to copy the pointers of the inode, sharing its attributes
+    # (see Superblock.hold).
+    def copy(self):
+        inode = Inode.__new__(Inode)
+        inode.attributes = self.attributes
+        inode.data_pointer = self.data_pointer
+        inode.chunks = list(self.chunks) if self.chunks is not None else None
+        inode.inline = self.inline
+        return inode
+
+
+# A segment of the inode table: the inodes whose numbers are in the range
+# [index * INODES_PER_SEGMENT + 1, (index + 1) * INODES_PER_SEGMENT]. Each
+# segment is stored in its own message.
+class InodeSegment:
+    def __init__(self, index, inodes=()):
+        self.index = index
+        # inodes of the segment by number
+        self.inodes = {inode.attributes.st_ino: inode for inode in inodes}
+        # free inode numbers of the segment (not stored, derived)
+        first = index * INODES_PER_SEGMENT + 1
+        self.free_set = set(range(first, first + INODES_PER_SEGMENT)) - self.inodes.keys()
+
 
 # The superblock contains all the information of a mounted file system.
-# It stores a list of all inodes and has the methods to create, delete
-# and fetch for an inode.
+# The inode table is split in segments: the superblock itself only keeps
+# the message id of each segment and how many inodes it uses, segments are
+# loaded when one of their inodes is first needed (see add_segment) and
+# only the modified (dirty) ones are written. The table grows by adding
+# segments when the existing ones are full. It has the methods to create,
+# delete and fetch for an inode in the loaded segments. The numbers of the
+# inodes changed are also kept for the MetadataJournal, whose batches are
+# replayed on the superblock they follow (see replay). While the chunk map
+# of an inode is being rewritten its last stored state is written in its
+# place (see hold).
 class Superblock:
-    def __init__(self, inode_n):
-        # init inode dict with the root inode and free set
-        self.inodes = {1: Inode(1)}
-        self.free_set = set(range(2, inode_n + 1))
+    # message id of the PackTable and of the DedupIndex, 0 if there is none
+    pack_pointer = 0
+    dedup_pointer = 0
+    # message ids left to delete when it was written (see DeletionQueue)
+    deletions = ()
+    # message id of the pinned message it was read from or written to (the
+    # superblock itself or the last MetadataBatch) and the messages of the
+    # journal (with the superblock it started from) replaced when it is
+    # written again
+    head = 0
+    journal = ()
 
-    def get_new_inode(self):
-        # if there are free inodes
-        if self.free_set:
-            # get a free inode number
-            free_n = self.free_set.pop()
-            # add a new inode with the given number to the dict
-            self.inodes[free_n] = Inode(free_n)
-            # return the new inode
-            return self.inodes[free_n]
-        # return None otherwise
+    def __init__(self):
+        # message id of each segment (0 if never written) and used inodes
+        self.pointers = [0]
+        self.used = [1]
+        # loaded segments by index and the ones with free inodes
+        self.segments = {}
+        self.with_space = set()
+        # indexes of the segments modified since written
+        self.dirty = set()
+        # numbers of the inodes changed since the last batch of the journal
+        # and the inodes replayed from it by segment index (None when freed)
+        # applied when their segment is loaded
+        self.changed = set()
+        self.replayed = {}
+        # last stored state of the inodes being rewritten by number
+        self.stored = {}
+        # init the first segment with the root inode
+        self.add_segment(InodeSegment(0, [Inode(1)]))
+        self.dirty.add(0)
+
+    # Routine to build a superblock holding the given inodes (used to
+    # convert the superblocks written before segments existed).
+    @staticmethod
+    def from_inodes(inodes):
+        superblock = Superblock.__new__(Superblock)
+        n_segments = (max(inodes) - 1) // INODES_PER_SEGMENT + 1
+        superblock.pointers = [0] * n_segments
+        superblock.used = [0] * n_segments
+        superblock.segments = {}
+        superblock.with_space = set()
+        superblock.dirty = set(range(n_segments))
+        superblock.changed = set()
+        superblock.replayed = {}
+        superblock.stored = {}
+        # group the inodes by segment
+        groups = [[] for _ in range(n_segments)]
+        for inode in inodes.values():
+            groups[superblock.segment_of(inode.attributes.st_ino)].append(inode)
+        for (index, group) in enumerate(groups):
+            superblock.used[index] = len(group)
+            superblock.add_segment(InodeSegment(index, group))
+        return superblock
+
+    @staticmethod
+    def segment_of(number):
+        return (number - 1) // INODES_PER_SEGMENT
+
+    def is_loaded(self, number):
+        return self.segment_of(number) in self.segments
+
+    # Routine to add a segment once loaded, with the inodes replayed.
+    def add_segment(self, segment):
+        self.segments[segment.index] = segment
+        self._apply_replayed(segment)
+        if segment.free_set:
+            self.with_space.add(segment.index)
+
+    # Routine to replay a MetadataBatch: the table takes its size and used
+    # inodes, its inodes replace the ones with the same number (and its
+    # freed ones are removed) in their segments, now or when loaded.
+    def replay(self, batch):
+        self.pack_pointer = batch.pack_pointer
+        self.dedup_pointer = batch.dedup_pointer
+        self.deletions = batch.deletions
+        for (index, used) in enumerate(batch.used):
+            # added after the superblock was written: it starts empty
+            if index == len(self.pointers):
+                self.pointers.append(0)
+                self.used.append(0)
+                self.add_segment(InodeSegment(index))
+            self.used[index] = used
+        for inode in batch.inodes:
+            number = inode.attributes.st_ino
+            self.replayed.setdefault(self.segment_of(number), {})[number] = inode
+        for number in batch.freed:
+            self.replayed.setdefault(self.segment_of(number), {})[number] = None
+        for index in list(self.replayed):
+            if index in self.segments:
+                self._apply_replayed(self.segments[index])
+                if self.segments[index].free_set:
+                    self.with_space.add(index)
+                else:
+                    self.with_space.discard(index)
+
+    def _apply_replayed(self, segment):
+        replayed = self.replayed.pop(segment.index, None)
+        if replayed is None:
+            return
+        for (number, inode) in replayed.items():
+            if inode is None:
+                segment.inodes.pop(number, None)
+                segment.free_set.add(number)
+            else:
+                segment.inodes[number] = inode
+                segment.free_set.discard(number)
+        # written by the next checkpoint
+        self.dirty.add(segment.index)
+
+    # Routine to get the index of a segment that is not loaded and has free
+    # inodes, None if there is none.
+    def segment_to_load(self):
+        for (index, used) in enumerate(self.used):
+            if used < INODES_PER_SEGMENT and index not in self.segments:
+                return index
         return None
 
+    def mark_dirty(self, number):
+        self.dirty.add(self.segment_of(number))
+        self.changed.add(number)
+
+    # Routine to keep the current state of an inode as its stored one
+    # before its chunk map points to objects not written yet (or is partly
+    # updated): until release is called the superblock and the journal
+    # batches write that state, with the current attributes. The messages
+    # it points to must not be deleted meanwhile.
+    def hold(self, inode):
+        if inode.attributes.st_ino not in self.stored:
+            self.stored[inode.attributes.st_ino] = inode.copy()
+
+    # Routine to make the current state of an inode held the stored one,
+    # once everything it points to is written.
+    def release(self, number):
+        if self.stored.pop(number, None) is not None:
+            self.mark_dirty(number)
+
+    def is_held(self, number):
+        return number in self.stored
+
+    # Routines to get the state of an inode and the segment to write.
+    def stored_inode(self, inode):
+        return self.stored.get(inode.attributes.st_ino, inode)
+
+    def stored_segment(self, index):
+        segment = self.segments[index]
+        if not self.stored or not any(number in self.stored for number in segment.inodes):
+            return segment
+        stored = InodeSegment.__new__(InodeSegment)
+        stored.index = index
+        stored.inodes = {number: self.stored_inode(inode) for (number, inode) in segment.inodes.items()}
+        stored.free_set = segment.free_set
+        return stored
+
+    def get_new_inode(self):
+        # if no loaded segment has free inodes
+        if not self.with_space:
+            # if a segment not loaded has free inodes it must be loaded first
+            if self.segment_to_load() is not None:
+                return None
+            # otherwise grow the table with a new segment
+            self.pointers.append(0)
+            self.used.append(0)
+            self.add_segment(InodeSegment(len(self.pointers) - 1))
+        # get a segment with free inodes
+        segment = self.segments[next(iter(self.with_space))]
+        # get a free inode number
+        free_n = segment.free_set.pop()
+        if not segment.free_set:
+            self.with_space.discard(segment.index)
+        self.used[segment.index] += 1
+        self.dirty.add(segment.index)
+        self.changed.add(free_n)
+        # add a new inode with the given number to the dict
+        segment.inodes[free_n] = Inode(free_n)
+        # return the new inode
+        return segment.inodes[free_n]
+
     def free_inode(self, number):
+        segment = self.segments[self.segment_of(number)]
         # delete the inode from the dictionary
-        del self.inodes[number]
+        del segment.inodes[number]
         # add the inode number to the free set
-        self.free_set.add(number)
+        segment.free_set.add(number)
+        self.with_space.add(segment.index)
+        self.used[segment.index] -= 1
+        self.dirty.add(segment.index)
+        self.changed.add(number)
+        self.stored.pop(number, None)
 
     def get_inode_by_number(self, number):
-        # return the inode if exists, None otherwise
-        return self.inodes.get(number, None)
+        # return the inode if exists and its segment is loaded, None otherwise
+        segment = self.segments.get(self.segment_of(number), None)
+        return segment.inodes.get(number, None) if segment is not None else None
+
+
+# Routine to get the hash of the name of a directory entry.
+def name_hash(name):
+    return int.from_bytes(blake2b(name, digest_size=8).digest(), 'little') >> (64 - HASH_BITS)
+
+
+# Routine to get the index of the shard of a directory (with n_shards, a
+# power of two) holding the entries with the given name hash: the shards
+# split the hashes in consecutive ranges.
+def shard_index(hash_value, n_shards):
+    return hash_value >> (HASH_BITS - (n_shards.bit_length() - 1))
+
+
+# Routine to get the first name hash of the given shard of a directory.
+def shard_start(index, n_shards):
+    return index << (HASH_BITS - (n_shards.bit_length() - 1))
+
+
+# Check if the contents of a chunk are only zeros (it is kept as a hole).
+def is_hole(data):
+    return data.count(0) == len(data)
+
+
+# A shard of the entries of a directory. The entries of a directory are
+# split by the hash of their names in a number of shards (the message id of
+# each one is in the chunk map of the directory inode), so rewriting the
+# changes of a directory only rewrites the shards changed (see
+# DirectoryJournal). Every entry has a cookie, the hash of its name followed
+# by 8 bits distinguishing the names with the same hash, that never changes
+# and orders the entries in readdir: listing a directory can continue after
+# any cookie, even if the directory changed.
+class DirectoryShard:
+    def __init__(self, entries=()):
+        # entries by name as (inode number, cookie)
+        self.entries = {}
+        # sorted cookies and the name of each one
+        self.cookies = []
+        self.names = {}
+        for (name, inode_n, cookie) in entries:
+            self.entries[name] = (inode_n, cookie)
+            self.names[cookie] = name
+        self.cookies = sorted(self.names)
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Routine to get the inode number of an entry, None if missing.
+    def get(self, name):
+        entry = self.entries.get(name, None)
+        return entry[0] if entry is not None else None
+
+    # Routine to add an entry (or replace the inode number of an existing
+    # one) with the given cookie or a new one. It returns the cookie.
+    def add(self, name, inode_n, cookie=None):
+        entry = self.entries.get(name, None)
+        if entry is not None:
+            self.entries[name] = (inode_n, entry[1])
+            return entry[1]
+        if cookie is None:
+            # take the first cookie of the hash that is not used
+            base = name_hash(name) << 8
+            cookie = next(base | seq for seq in range(1, 256) if base | seq not in self.names)
+        self.entries[name] = (inode_n, cookie)
+        self.names[cookie] = name
+        insort(self.cookies, cookie)
+        return cookie
+
+    # Routine to remove an entry, it returns its inode number and cookie.
+    def remove(self, name):
+        (inode_n, cookie) = self.entries.pop(name)
+        del self.names[cookie]
+        del self.cookies[bisect_right(self.cookies, cookie) - 1]
+        return (inode_n, cookie)
+
+    # Routine to apply a record of a DirectoryJournal.
+    def apply(self, name, inode_n, cookie):
+        if inode_n:
+            self.add(name, inode_n, cookie)
+        elif name in self.entries:
+            self.remove(name)
+
+    # Routine to get the entries after the given cookie as (cookie, name,
+    # inode number) in cookie order.
+    def after(self, cookie):
+        return [(c, self.names[c], self.entries[self.names[c]][0])
+                for c in self.cookies[bisect_right(self.cookies, cookie):]]
+
+
+# The changes of the entries of a directory not written in its shards yet,
+# as records (name, inode number, cookie) in order, with inode number 0 for
+# the removed entries. While a directory is being modified only its
+# journal is written (pointed by the data_pointer of the inode), which is
+# small, and once it has more than JOURNAL_RECORDS records the shards
+# changed are rewritten and the journal starts again. When a shard is read
+# the records of its entries are applied to it.
+class DirectoryJournal:
+    def __init__(self, records=()):
+        self.records = list(records)
+
+    def __len__(self):
+        return len(self.records)
+
+
+# A batch of the metadata journal (see MetadataJournal): the inodes changed
+# and the numbers of the ones freed since the previous batch, with the used
+# inodes of each segment of the table and the message ids of the PackTable
+# and the DedupIndex at that moment. previous is the message id of the
+# previous batch or of the superblock the journal started from.
+class MetadataBatch:
+    def __init__(self, previous, pack_pointer=0, dedup_pointer=0, used=(), inodes=(), freed=(), deletions=()):
+        self.previous = previous
+        self.pack_pointer = pack_pointer
+        self.dedup_pointer = dedup_pointer
+        self.used = list(used)
+        self.inodes = list(inodes)
+        self.freed = list(freed)
+        # messages left to delete when it was written (like the ones of
+        # the superblock)
+        self.deletions = list(deletions)
+
+
+# A pack: a message holding many small objects (see PackStore). Objects are
+# addressed by the number of their pack and their slot in it, the table
+# gives the message id of each pack so a pack can be rewritten (with the
+# same slots) without changing the pointers to its objects. The slots of
+# the objects still referenced (live) are kept with their lengths.
+class Pack:
+    def __init__(self, message_id=0, size=0, live=None):
+        # message holding the pack (0 until written) and its bytes
+        self.message_id = message_id
+        self.size = size
+        # lengths of the live objects by slot
+        self.live = live if live is not None else {}
+
+    def live_bytes(self):
+        return sum(self.live.values())
+
+
+# The packs of the file system by number and the next number to use.
+class PackTable:
+    def __init__(self, next_pack=1, packs=None):
+        self.next_pack = next_pack
+        self.packs = packs if packs is not None else {}
+
+
+# A chunk stored once for all the files with the same contents: its
+# pointer, length and number of references from chunk maps.
+class DedupEntry:
+    def __init__(self, pointer, length, refs=1):
+        self.pointer = pointer
+        self.length = length
+        self.refs = refs
+
+
+# The chunks stored by content (see DedupStore): the DedupEntry of each one
+# by the hash of its contents.
+class DedupIndex:
+    def __init__(self, chunks=None):
+        self.chunks = chunks if chunks is not None else {}
+
+
+# Pointers to packed objects are negative, built from the pack number and
+# the slot (0 means no data and message ids are positive).
+def pack_pointer(pack_n, slot):
+    return -(pack_n * PACK_SLOTS + slot)
+
+
+# Routine to get the pack number and slot of a pointer to a packed object.
+def split_pack_pointer(pointer):
+    return divmod(-pointer, PACK_SLOTS)
 
 
 # It contains the metadata of a directory entry, that is, a filename and
 # its linking to a corresponding file. A reference to the parent inode and
 # to the current directory inode is kept for each directory created.
+# Only directories created before sharding are stored this way.
 class DirectoryData:
     def __init__(self, self_inode_n, parent_inode_n):
         # init directory entries with '.' and '..'
@@ -69,6 +473,7 @@ class DirectoryData:
 
 
 # Stores the contents of a file in bytes. It is initialized with no contents.
+# Only files created before chunking are stored this way.
 class FileData:
     def __init__(self, initial_data=b''):
         self.raw_data = initial_data
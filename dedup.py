@@ -0,0 +1,134 @@
+import asyncio
+from hashlib import blake2b
+import serialization
+from data_structures import *
+
+# bytes of the hashes identifying the contents of the chunks
+DIGEST_SIZE = 32
+
+
+def chunk_hash(data):
+    return blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+# Stores the chunks of the files by content: a chunk with the same contents
+# as one already stored takes a new reference to its message instead of
+# being uploaded again (rewriting a chunk with the contents it already has
+# included). The DedupIndex keeps the hash, pointer and references of
+# each chunk stored this way; deleting one of them only releases a
+# reference until it has none. The index is loaded when first needed and
+# written with the superblock (see save). Chunks written before (or while
+# disabled) are not in the index and are deleted as always.
+class DedupStore:
+    def __init__(self, backend, enabled=True):
+        self.backend = backend
+        # new chunks are only looked up and added when enabled (the chunks
+        # of the index are still released otherwise)
+        self.enabled = enabled
+        # message id of the index (from the superblock) and the index once
+        # loaded, modified since written or not
+        self.index_pointer = 0
+        self.index = None
+        self.index_dirty = False
+        self.index_lock = asyncio.Lock()
+        # hash of each chunk of the index by pointer
+        self.hashes = {}
+        # counters
+        self.skipped_uploads = 0
+        self.skipped_bytes = 0
+
+    # Routine to start from the index of the given superblock.
+    def open(self, superblock):
+        if superblock.dedup_pointer != self.index_pointer:
+            self.index_pointer = superblock.dedup_pointer
+            self.index = None
+            self.hashes = {}
+
+    async def _get_index(self):
+        if self.index is None:
+            async with self.index_lock:
+                if self.index is None:
+                    index = (await self.backend.read_data(self.index_pointer) if self.index_pointer
+                             else DedupIndex())
+                    self.hashes = {entry.pointer: key for (key, entry) in index.chunks.items()}
+                    self.index = index
+        return self.index
+
+    # Routine to write a chunk. It returns the pointer to the chunk.
+    async def write(self, data):
+        if not self.enabled:
+            return await self.backend.write_raw(data)
+        index = await self._get_index()
+        key = chunk_hash(data)
+        entry = index.chunks.get(key, None)
+        if entry is not None:
+            entry.refs += 1
+            self._skipped(data)
+        else:
+            pointer = await self.backend.write_raw(data)
+            # the same contents may have been stored meanwhile
+            entry = index.chunks.get(key, None)
+            if entry is not None:
+                entry.refs += 1
+                await self.backend.delete_data(pointer)
+            else:
+                entry = index.chunks[key] = DedupEntry(pointer, len(data))
+                self.hashes[pointer] = key
+        self.index_dirty = True
+        return entry.pointer
+
+    def _skipped(self, data):
+        self.skipped_uploads += 1
+        self.skipped_bytes += len(data)
+        if self.backend.stats is not None:
+            self.backend.stats.count('tgfuse_dedup_skipped_bytes_total', amount=len(data))
+
+    # Routine to release a reference to a chunk of the index, deleting it
+    # when it was the last one. It returns False if the pointer is not in
+    # the index (it is to be deleted as usual).
+    async def release(self, pointer):
+        await self._get_index()
+        key = self.hashes.get(pointer, None)
+        if key is None:
+            return False
+        entry = self.index.chunks[key]
+        entry.refs -= 1
+        self.index_dirty = True
+        if entry.refs <= 0:
+            del self.index.chunks[key]
+            del self.hashes[pointer]
+            # no longer in the index: really deleted
+            await self.backend.delete_data(pointer)
+        return True
+
+    # The bytes of the chunks stored and the bytes they hold for the files.
+    def stored_bytes(self):
+        return sum(entry.length for entry in self.index.chunks.values()) if self.index is not None else 0
+
+    def referenced_bytes(self):
+        return (sum(entry.length * entry.refs for entry in self.index.chunks.values())
+                if self.index is not None else 0)
+
+    # The bytes not stored thanks to the deduplication and the ratio of
+    # the bytes referenced to the bytes stored.
+    def saved_bytes(self):
+        return self.referenced_bytes() - self.stored_bytes()
+
+    def ratio(self):
+        stored = self.stored_bytes()
+        return self.referenced_bytes() / stored if stored else 1.0
+
+    # Routine to write the index (when modified). It returns the message id
+    # of the index and the one of the index it replaces (to delete once the
+    # superblock is written), None when unchanged.
+    async def save(self):
+        old_pointer = self.index_pointer
+        if self.index_dirty:
+            self.index_dirty = False
+            try:
+                self.index_pointer = await self.backend.write_raw(serialization.dumps(self.index), 'dedup index',
+                                                                  may_pack=False)
+            except:
+                self.index_dirty = True
+                raise
+        return (self.index_pointer, old_pointer if old_pointer != self.index_pointer else None)
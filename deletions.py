@@ -0,0 +1,113 @@
+import asyncio
+import logging
+from transfers import BACKGROUND, transfer_priority
+
+log = logging.getLogger(__name__)
+
+# maximum number of messages deleted by a call (the limit of Telegram)
+MAX_BATCH = 100
+
+
+# Collects the messages no longer used and deletes them in background in
+# calls of up to batch messages each, linger seconds after the first one
+# is queued (at once when a whole batch is waiting), so deleting takes no
+# call on the path of the operations. The pointers deleted by the file
+# system are held (see add) until the superblock or journal batch no
+# longer pointing to them is pinned, the pinned one may still use them:
+# they are taken when it is written and released once it is pinned (see
+# StorageBackend.take_deletions and release_deletions). The superblock or
+# batch pinned records the messages queued (or to queue once it is pinned)
+# when it was written and the next mount queues them again, so a crash
+# leaves none behind.
+class DeletionQueue:
+    def __init__(self, backend, batch=MAX_BATCH, linger=1.0, retry_delay=5):
+        self.backend = backend
+        self.batch = min(batch, MAX_BATCH)
+        self.linger = linger
+        self.retry_delay = retry_delay
+        # pointers deleted since the metadata was last written and message
+        # ids waiting to be deleted
+        self.held = set()
+        self.pending = set()
+        # task deleting them (None when idle) and the event waking it up
+        # before linger when a batch is full
+        self.task = None
+        self.full = asyncio.Event()
+        self.closing = False
+        # counters
+        self.deleted = 0
+        self.calls = 0
+
+    def __len__(self):
+        return len(self.held) + len(self.pending)
+
+    # Routine to hold a pointer deleted by the file system until the
+    # metadata written next is pinned.
+    def add(self, pointer):
+        self.held.add(pointer)
+
+    # Routine to take the pointers held, when the metadata no longer
+    # pointing to them is written. They are given back by restore when
+    # writing it fails.
+    def take(self):
+        held = self.held
+        self.held = set()
+        return held
+
+    def restore(self, pointers):
+        self.held.update(pointers)
+
+    # Routine to queue messages to delete.
+    def release(self, message_ids):
+        self.pending.update(message_ids)
+        if not self.pending:
+            return
+        if len(self.pending) >= self.batch:
+            self.full.set()
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        transfer_priority.set(BACKGROUND)
+        try:
+            while self.pending and not self.closing:
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.linger)
+                except asyncio.TimeoutError:
+                    pass
+                await self._delete_pending()
+        finally:
+            self.task = None
+
+    # Routine to delete the queued messages, a batch per call. The ones of
+    # a failed call are queued again (and retried after retry_delay by the
+    # background task).
+    async def _delete_pending(self):
+        while self.pending:
+            self.full.clear()
+            message_ids = sorted(self.pending)[:self.batch]
+            self.pending.difference_update(message_ids)
+            try:
+                await self.backend.delete_batch(message_ids)
+            except Exception:
+                log.exception('deleting %d messages failed, retrying in %s seconds', len(message_ids),
+                              self.retry_delay)
+                self.pending.update(message_ids)
+                await asyncio.sleep(self.retry_delay)
+                return
+            self.calls += 1
+            self.deleted += len(message_ids)
+
+    # Routine to delete the queued messages now (a failed batch stays
+    # queued, the held pointers are not touched).
+    async def flush(self):
+        await self._delete_pending()
+
+    # Routine to stop the background task (after a last try without
+    # waiting for linger) and delete the messages still queued.
+    async def close(self):
+        self.closing = True
+        self.full.set()
+        if self.task is not None:
+            await self.task
+        await self.flush()
@@ -0,0 +1,47 @@
+from collections import OrderedDict
+
+
+# A bounded LRU cache of directory shards (DirectoryShard). Entries are
+# keyed by the inode number of the directory and the message id holding
+# that version of the shard: message ids are never reused, so an entry
+# can't become stale, and writing a shard moves its entry to the key of the
+# new message. The number of hits and misses is counted.
+class DirectoryCache:
+    def __init__(self, max_entries=1024):
+        # maximum number of shards kept
+        self.max_entries = max_entries
+        # cached shards by (inode number, message id), oldest first
+        self.entries = OrderedDict()
+        # counters
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Routine to get a cached shard, None if it is not cached.
+    def get(self, inode_n, message_id):
+        key = (inode_n, message_id)
+        shard = self.entries.get(key, None)
+        if shard is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            # mark it as the most recently used
+            self.entries.move_to_end(key)
+        return shard
+
+    # Routine to cache a shard evicting the least recently used ones if
+    # the cache is full.
+    def put(self, inode_n, message_id, shard):
+        if self.max_entries <= 0:
+            return
+        key = (inode_n, message_id)
+        self.entries[key] = shard
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    # Routine to remove a cached shard (if present).
+    def discard(self, inode_n, message_id):
+        self.entries.pop((inode_n, message_id), None)
@@ -0,0 +1,160 @@
+from bisect import bisect_left, bisect_right
+
+
+# A sparse in-memory buffer made of extents, runs of bytes kept in mutable
+# bytearrays sorted by their offset. Writes are absorbed in place (appending
+# to an extent is amortized O(len(buf))), extents that become adjacent or
+# overlapping are merged and reads inside a single extent are served as
+# memoryview slices without copying. Bytes not covered by any extent read
+# as zeros. The bytes held are counted as they change, in the buffer and
+# in the MemoryUsage given (shared by the buffers of the open files).
+class ExtentBuffer:
+    def __init__(self, usage=None):
+        # offsets of the extents and their contents, in the same order
+        self.starts = []
+        self.extents = []
+        self.size = 0
+        self.usage = usage
+
+    # The number of bytes held in memory.
+    def __len__(self):
+        return self.size
+
+    def _count(self, amount):
+        self.size += amount
+        if self.usage is not None:
+            self.usage.bytes += amount
+
+    # The offset after the last byte held (0 if empty).
+    def end(self):
+        return self.starts[-1] + len(self.extents[-1]) if self.extents else 0
+
+    # Routine to write buf at offset off, merging the extents it touches.
+    def write(self, off, buf):
+        if not buf:
+            return
+        end = off + len(buf)
+        # the first extent touching the range: the one starting before it
+        # if it reaches off, otherwise the next one
+        first = bisect_right(self.starts, off) - 1
+        if first < 0 or self.starts[first] + len(self.extents[first]) < off:
+            first += 1
+        # the extents starting up to end are touched too
+        last = bisect_right(self.starts, end)
+        # no extent touched: insert a new one
+        if first == last:
+            self.starts.insert(first, off)
+            self.extents.insert(first, bytearray(buf))
+            self._count(len(buf))
+            return
+        start = self.starts[first]
+        extent = self.extents[first]
+        merged = sum(map(len, self.extents[first:last]))
+        try:
+            self._merge(extent, start, off, buf, first, last)
+        except BufferError:
+            # the extent is exported by a memoryview still in use and can't
+            # be resized: continue on a copy
+            extent = self.extents[first] = bytearray(extent)
+            self._merge(extent, start, off, buf, first, last)
+        self._count(len(extent) - merged)
+        # the merged extents starts at the lowest offset
+        if off < start:
+            self.starts[first] = off
+        # drop the extents merged into the first one
+        del self.starts[first + 1:last]
+        del self.extents[first + 1:last]
+
+    def _merge(self, extent, start, off, buf, first, last):
+        # the write starts before the extent: prepend the gap
+        if off < start:
+            extent[0:0] = bytes(start - off)
+            start = off
+        # write in place (extending if necessary)
+        extent[off - start:off - start + len(buf)] = buf
+        # append what is left of the following touched extents
+        for k in range(first + 1, last):
+            rel = self.starts[k] - start
+            following = self.extents[k]
+            if rel + len(following) > len(extent):
+                extent += following[len(extent) - rel:]
+
+    # Routine to read size bytes from offset off. A memoryview is returned
+    # when the range is inside one extent, otherwise the bytes are copied
+    # and the gaps filled with zeros.
+    def read(self, off, size):
+        end = off + size
+        i = bisect_right(self.starts, off) - 1
+        # the whole range inside one extent: no copy
+        if i >= 0 and self.starts[i] + len(self.extents[i]) >= end:
+            rel = off - self.starts[i]
+            return memoryview(self.extents[i])[rel:rel + size]
+        # otherwise assemble the pieces
+        data = bytearray(size)
+        i = max(i, 0)
+        while i < len(self.starts) and self.starts[i] < end:
+            start = self.starts[i]
+            extent = self.extents[i]
+            # the intersection with the requested range
+            lo = max(start, off)
+            hi = min(start + len(extent), end)
+            if lo < hi:
+                data[lo - off:hi - off] = memoryview(extent)[lo - start:hi - start]
+            i += 1
+        return data
+
+    # Routine to write the given data only where nothing was written yet.
+    def fill(self, off, data):
+        end = off + len(data)
+        pos = off
+        i = max(bisect_right(self.starts, off) - 1, 0)
+        # collect the gaps first (writing changes the extents)
+        gaps = []
+        while pos < end:
+            if i < len(self.starts) and self.starts[i] < end:
+                start = self.starts[i]
+                stop = start + len(self.extents[i])
+                if start > pos:
+                    gaps.append((pos, start))
+                pos = max(pos, stop)
+                i += 1
+            else:
+                gaps.append((pos, end))
+                pos = end
+        # write them
+        view = memoryview(data)
+        for (lo, hi) in gaps:
+            self.write(lo, view[lo - off:hi - off])
+
+    # Routine to drop the bytes from offset size on (they read as zeros
+    # again).
+    def truncate(self, size):
+        # the extents starting from size on are dropped, the previous one
+        # is cut at size
+        i = bisect_left(self.starts, size)
+        self._count(-sum(map(len, self.extents[i:])))
+        del self.starts[i:]
+        del self.extents[i:]
+        if i:
+            extent = self.extents[i - 1]
+            rel = size - self.starts[i - 1]
+            if len(extent) > rel:
+                self._count(rel - len(extent))
+                try:
+                    del extent[rel:]
+                except BufferError:
+                    # exported by a memoryview still in use: keep a copy
+                    self.extents[i - 1] = extent[:rel]
+
+    # Routine to drop every byte held, when the contents are moved
+    # elsewhere or no longer needed.
+    def clear(self):
+        self._count(-self.size)
+        self.starts = []
+        self.extents = []
+
+
+# The bytes held in memory by the buffers sharing it.
+class MemoryUsage:
+    def __init__(self):
+        self.bytes = 0
@@ -0,0 +1,150 @@
+import asyncio
+import os
+import random
+from time import monotonic
+from backend import *
+
+
+# This class is a stand-in for TgFuseWrapper that keeps the messages in the
+# local process (or in a local directory when a path is given) instead of
+# Telegram. It can simulate the behaviour of the remote service: a fixed
+# latency per call (plus a random jitter), a bandwidth cap shared by all
+# transfers and a rate limit on the number of calls that, like Telegram's
+# FloodWait, makes the caller wait or raises ThrottledError when the wait
+# is longer than flood_sleep_threshold.
+class LocalBackend(StorageBackend):
+    def __init__(self, path=None, latency=0.0, jitter=0.0, bandwidth=None,
+                 rate_limit=None, burst=1, flood_sleep_threshold=60):
+        # directory where messages are stored, None to keep them in memory
+        self.path = path
+        # seconds added to every call and maximum random extra seconds
+        self.latency = latency
+        self.jitter = jitter
+        # bytes per second shared by all the transfers (None for unlimited)
+        self.bandwidth = bandwidth
+        # calls per second allowed and how many can be issued at once
+        self.rate_limit = rate_limit
+        self.burst = burst
+        # throttling waits longer than this raise ThrottledError
+        self.flood_sleep_threshold = flood_sleep_threshold
+        # the time at which the simulated link is free again
+        self._link_free = 0.0
+        # rate limiter state: available tokens and last refill time
+        self._tokens = float(burst)
+        self._refill = monotonic()
+        # number of calls that were throttled
+        self.throttled = 0
+        # messages kept in memory by id and the pinned message id
+        self.messages = {}
+        self.pinned = None
+        # next message id, message ids are never reused
+        self.next_id = 1
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            # continue after the highest stored message id
+            ids = [int(name) for name in os.listdir(path) if name.isdigit()]
+            self.next_id = max(ids, default=0) + 1
+            # restore the pinned message id if any
+            pinned_path = os.path.join(path, 'pinned')
+            if os.path.exists(pinned_path):
+                with open(pinned_path) as f:
+                    self.pinned = int(f.read())
+
+    # Routine to simulate the cost of a call to the remote service
+    # transferring the given amount of bytes.
+    async def _simulate(self, size=0):
+        # apply the rate limit before anything else
+        if self.rate_limit is not None:
+            await self._throttle()
+        # wait for the latency of the call
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+        # wait for the transfer over the shared link
+        if self.bandwidth and size:
+            now = monotonic()
+            start = max(now, self._link_free)
+            self._link_free = start + size / self.bandwidth
+            await asyncio.sleep(self._link_free - now)
+
+    # Routine implementing the rate limit with a token bucket.
+    async def _throttle(self):
+        # refill the bucket according to the elapsed time
+        now = monotonic()
+        self._tokens = min(float(self.burst), self._tokens + (now - self._refill) * self.rate_limit)
+        self._refill = now
+        # take a token, the bucket may go negative (calls waiting for it)
+        self._tokens -= 1
+        # if there was a token available we are done
+        if self._tokens >= 0:
+            return
+        # otherwise the call is throttled for the time to get the token
+        self.throttled += 1
+        wait = -self._tokens / self.rate_limit
+        # too long: give the token back and fail like a FloodWait
+        if wait > self.flood_sleep_threshold:
+            self._tokens += 1
+            raise ThrottledError(wait)
+        # short enough: sleep like telethon does
+        await asyncio.sleep(wait)
+
+    def _message_path(self, message_id):
+        return os.path.join(self.path, str(message_id))
+
+    async def _send_data(self, data, caption=None):
+        await self._simulate(len(data))
+        # assign a new message id
+        message_id = self.next_id
+        self.next_id += 1
+        # store the data
+        if self.path is None:
+            self.messages[message_id] = bytes(data)
+        else:
+            with open(self._message_path(message_id), 'wb') as f:
+                f.write(data)
+        return message_id
+
+    async def _download_data(self, message_id):
+        # read the data (None if missing)
+        if self.path is None:
+            data = self.messages.get(message_id, None)
+        else:
+            try:
+                with open(self._message_path(message_id), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                data = None
+        await self._simulate(len(data) if data is not None else 0)
+        return data
+
+    async def _delete_data(self, message_id):
+        await self._simulate()
+        self._remove(message_id)
+
+    async def _delete_many(self, message_ids):
+        # a single call for all of them
+        await self._simulate()
+        for message_id in message_ids:
+            self._remove(message_id)
+
+    def _remove(self, message_id):
+        # remove the data if it exists
+        if self.path is None:
+            self.messages.pop(message_id, None)
+        else:
+            try:
+                os.remove(self._message_path(message_id))
+            except FileNotFoundError:
+                pass
+
+    async def _get_pinned_id(self):
+        await self._simulate()
+        return self.pinned
+
+    async def _pin_data(self, message_id):
+        await self._simulate()
+        self.pinned = message_id
+        # persist the pinned id when stored in a directory
+        if self.path is not None:
+            with open(os.path.join(self.path, 'pinned'), 'w') as f:
+                f.write(str(message_id))
@@ -0,0 +1,80 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+# A readers/writer lock for asyncio tasks: many readers or a single writer
+# can hold it. Waiting writers are preferred so readers can't starve them.
+class RWLock:
+    def __init__(self):
+        self._cond = asyncio.Condition()
+        # number of readers holding the lock, if a writer holds it and
+        # the number of writers waiting for it
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @asynccontextmanager
+    async def reader(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: not self._writer and not self._waiting_writers)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._readers -= 1
+                self._cond.notify_all()
+
+    @asynccontextmanager
+    async def writer(self):
+        async with self._cond:
+            self._waiting_writers += 1
+            try:
+                await self._cond.wait_for(lambda: not self._writer and not self._readers)
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+# The table of RWLock of the inodes, created when needed and dropped when no
+# task holds or waits for them. To stay deadlock-free a task holding the lock
+# of an inode may only acquire the locks of the entries of that inode (when
+# it is a directory), that is, locks are always taken from parent to child.
+class InodeLocks:
+    def __init__(self):
+        # lock and number of users (holders and waiters) by inode number
+        self.locks = {}
+
+    def __len__(self):
+        return len(self.locks)
+
+    @asynccontextmanager
+    async def read(self, inode_n):
+        async with self._use(inode_n) as lock:
+            async with lock.reader():
+                yield
+
+    @asynccontextmanager
+    async def write(self, inode_n):
+        async with self._use(inode_n) as lock:
+            async with lock.writer():
+                yield
+
+    @asynccontextmanager
+    async def _use(self, inode_n):
+        # get (or create) the lock and count the new user
+        entry = self.locks.setdefault(inode_n, [RWLock(), 0])
+        entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            # drop the lock when it has no users left
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[inode_n]
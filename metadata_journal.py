@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import serialization
+from data_structures import *
+from transfers import BACKGROUND, transfer_priority
+
+log = logging.getLogger(__name__)
+
+
+# Appends the changes of the inodes to the storage while the file system is
+# mounted instead of keeping them until the superblock is written: every
+# interval seconds the inodes changed and the numbers of the ones freed are
+# written as a MetadataBatch pointing to the previous batch (or to the
+# superblock the journal started from), which is pinned in place of the
+# superblock. A mount replays the batches on it (see
+# StorageBackend.read_superblock), so a crash only loses the changes of the
+# last interval and unmounting only writes one more batch. Once there are
+# more than checkpoint_batches batches they are folded in background into a
+# new superblock by checkpoint (an async callable writing it), which
+# replaces the journal. The messages deleted meanwhile are only deleted
+# once the batch (or superblock) written after them is pinned, and each
+# batch records the messages left to delete like the superblock.
+class MetadataJournal:
+    def __init__(self, backend, checkpoint, interval=5, checkpoint_batches=64):
+        self.backend = backend
+        self.checkpoint = checkpoint
+        self.interval = interval
+        self.checkpoint_batches = checkpoint_batches
+        # superblock whose changes are appended (see start)
+        self.superblock = None
+        # task appending the batches (None when stopped) and the event
+        # stopping it
+        self.task = None
+        self.stopping = asyncio.Event()
+        # held while writing a batch or a checkpoint (append is also called
+        # by fsync)
+        self.lock = asyncio.Lock()
+        # counters
+        self.batches = 0
+        self.checkpoints = 0
+
+    # Routine to start appending the changes of the given superblock.
+    def start(self, superblock):
+        self.superblock = superblock
+        if self.task is None:
+            self.stopping.clear()
+            self.task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        transfer_priority.set(BACKGROUND)
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.interval)
+                break
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.append()
+                if len(self.superblock.journal) > self.checkpoint_batches:
+                    await self._checkpoint()
+            except Exception:
+                log.exception('writing the metadata journal failed, retrying in %s seconds', self.interval)
+
+    # Routine to write the changes since the last batch (if any) as a new
+    # batch and pin it.
+    async def append(self):
+        async with self.lock:
+            await self._append()
+
+    async def _append(self):
+        superblock = self.superblock
+        # nothing changed and no message waits for a batch to be deleted
+        deletions = self.backend.deletions
+        if not superblock.changed and (deletions is None or not deletions.held):
+            return
+        numbers = superblock.changed
+        superblock.changed = set()
+        inodes = []
+        freed = []
+        for number in sorted(numbers):
+            inode = superblock.get_inode_by_number(number)
+            if inode is not None:
+                # the last stored state of an inode being rewritten
+                inodes.append(superblock.stored_inode(inode))
+            else:
+                freed.append(number)
+        # encoded now, so the packs and the dedup index written next hold
+        # every object the inodes point to
+        data = serialization.dumps(MetadataBatch(superblock.head, used=superblock.used, inodes=inodes, freed=freed))
+        deleted = []
+        try:
+            # the messages deleted until now are no longer used by them
+            deleted = await self.backend.take_deletions()
+            old_index = None
+            if self.backend.dedup is not None:
+                (superblock.dedup_pointer, old_index) = await self.backend.dedup.save()
+            old_packs = []
+            if self.backend.packs is not None:
+                (superblock.pack_pointer, old_packs) = await self.backend.packs.save()
+            # the batch replaces the old pack table (and the packs it
+            # dropped) and dedup index
+            replaced = old_packs + ([old_index] if old_index is not None else []) + deleted
+            # save the messages still to delete, including the ones
+            # replaced by this batch, to delete them on the next mount when
+            # the storage is left before they are
+            pending = sorted(deletions.pending.union(replaced)) if deletions is not None else []
+            data = serialization.complete_batch(data, superblock.pack_pointer, superblock.dedup_pointer, pending)
+            message_id = await self.backend.write_raw(data, 'metadata journal', may_pack=False)
+            await self.backend.pin(message_id)
+        except:
+            # written by the next batch
+            superblock.changed |= numbers
+            self.backend.restore_deletions(deleted)
+            raise
+        if not superblock.journal:
+            superblock.journal = [superblock.head]
+        superblock.journal.append(message_id)
+        superblock.head = message_id
+        self.batches += 1
+        # now the replaced messages can be deleted
+        await self.backend.release_deletions(replaced)
+
+    async def _checkpoint(self):
+        async with self.lock:
+            await self.checkpoint()
+        self.checkpoints += 1
+
+    # Routine to stop appending and write the changes left, as a last batch
+    # or in a new superblock when checkpoint is set or the journal is long.
+    # It returns the message id pinned.
+    async def close(self, checkpoint=False):
+        self.stopping.set()
+        if self.task is not None:
+            await self.task
+            self.task = None
+        if checkpoint or len(self.superblock.journal) >= self.checkpoint_batches:
+            await self._checkpoint()
+        else:
+            await self.append()
+        return self.superblock.head
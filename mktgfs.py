@@ -1,16 +1,21 @@
 import asyncio
+import os
+from argparse import ArgumentParser
 from time import time_ns
+import serialization
 from data_structures import *
 from wrapper import *
+from local_backend import *
 
 
 # Routine to set the files that will recognize the superblock within the file
-# system stored in the self-chat of your Telegram account.
-async def make():
-    # Creates an empty superblock that handles 1000 inodes.
-    # The inode id 1 is given to the root directory and the others
-    # are left for the contents of the file system.
-    s = Superblock(1000)
+# system stored in the self-chat of your Telegram account (or in the given
+# storage backend).
+async def make(w):
+    # Creates an empty superblock with a single segment of inodes (the
+    # table grows as needed). The inode id 1 is given to the root
+    # directory and the others are left for the contents of the file system.
+    s = Superblock()
     # get the inode reserved for the root directory
     ino = s.get_inode_by_number(1)
     # init its attributes
@@ -22,19 +27,37 @@ async def make():
     entry.st_mtime_ns = stamp
     entry.st_gid = os.getgid()
     entry.st_uid = os.getuid()
-    # create and initialize the root directory with the
+    # create and initialize the root directory (a single shard) with the
     # parent inode id and current inode id being itself, 1.
-    dd = DirectoryData(1, 1)
-    entry.st_size = len(dd)
-    # write the directory
-    message_id = await w.write_data(dd, 'ROOT directory data')
-    # save the pointer in the inode
-    ino.data_pointer = message_id
+    shard = DirectoryShard()
+    shard.add(b'.', 1)
+    shard.add(b'..', 1)
+    entry.st_size = len(shard)
+    # keep it inline in the inode (a shard with pointer 0)
+    ino.inline = serialization.dumps(shard)
+    ino.chunks = [0]
     # write the superblock
     await w.write_superblock(s)
 
-# Initializes the client to communicate with Telegram. The argument
-# passed is your phone number.
-w = TgFuseWrapper(sys.argv[1])
 
-asyncio.get_event_loop().run_until_complete(make())
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('phone_number', type=str, nargs='?', help='Phone number like +XXXXXXXXXXXX')
+    parser.add_argument('--local', type=str, default=None, metavar='DIR',
+                        help='Use a local directory as storage instead of Telegram')
+    options = parser.parse_args()
+    # one of the storages is required
+    if options.phone_number is None and options.local is None:
+        parser.error('a phone number or --local DIR is required')
+    return options
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    # Initializes the client to communicate with Telegram (the argument
+    # passed is your phone number) or the local directory storage.
+    if options.local is not None:
+        w = LocalBackend(options.local)
+    else:
+        w = TgFuseWrapper(options.phone_number)
+    asyncio.get_event_loop().run_until_complete(make(w))
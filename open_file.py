@@ -0,0 +1,252 @@
+import asyncio
+import errno
+from pyfuse3 import FUSEError
+from data_structures import *
+from extent_buffer import *
+from spill_buffer import *
+
+
+# The state of a regular file while it is open. Its contents are kept in an
+# ExtentBuffer holding the chunks that were loaded from the storage (only
+# the ones covering the ranges read or partially written) and the data
+# written since it was opened. The indexes of the chunks modified since the
+# last flush are kept so that flushing uploads only those chunks. Files up
+# to inline_threshold bytes are kept in the inode instead of messages. The
+# contents can be moved to a SpillBuffer to release their memory (see
+# spill), reads and writes work the same on both; the bytes held in memory
+# are counted in usage (a MemoryUsage) when given. The messages replaced in
+# the chunk map are given to replaced (an async callable) when set, which
+# deletes them once the inode no longer pointing to them is written,
+# otherwise they are deleted at once.
+class OpenFile:
+    def __init__(self, inode, wrapper, inline_threshold=0, replaced=None, usage=None):
+        # the inode of the file and the storage of its chunks
+        self.inode = inode
+        self.wrapper = wrapper
+        self.replaced = replaced
+        # maximum size of the files kept inline (at most a chunk)
+        self.inline_threshold = min(inline_threshold, CHUNK_SIZE)
+        # contents of the file
+        self.buffer = ExtentBuffer(usage)
+        # indexes of the chunks whose stored contents are in the buffer
+        self.loaded = set()
+        # chunks being loaded by index (as futures)
+        self.loading = {}
+        # indexes of the modified chunks
+        self.dirty = set()
+        # the number of "opens" of the file
+        self.count = 0
+        # message id of the whole contents of a file created before chunking
+        self.legacy_pointer = 0
+
+    # Routine to load the contents of a file created before chunking, that
+    # are stored as a single FileData. They are kept loaded in the buffer and
+    # written as chunks in the next flush.
+    async def load_legacy(self):
+        # if the file has a chunk map there is nothing to do
+        if self.inode.chunks is not None:
+            return
+        # get file data from the storage
+        fd = await self.wrapper.read_data(self.inode.data_pointer)
+        self.buffer.write(0, fd.raw_data)
+        self.loaded.update(range(-(-len(fd) // CHUNK_SIZE)))
+        # remember the message to delete it once the chunks are written
+        self.legacy_pointer = self.inode.data_pointer
+
+    # Routine to move the contents to a temporary file in the given
+    # directory (see SpillBuffer). It returns the bytes released.
+    def spill(self, directory):
+        size = len(self.buffer)
+        buffer = SpillBuffer(directory, MAX_FILE_SIZE)
+        for (start, extent) in zip(self.buffer.starts, self.buffer.extents):
+            buffer.write(start, extent)
+        self.buffer.clear()
+        self.buffer = buffer
+        return size
+
+    # Routine to drop the contents when the open file is dropped.
+    def close(self):
+        self.buffer.clear()
+
+    def is_spilled(self):
+        return isinstance(self.buffer, SpillBuffer)
+
+    def is_dirty(self):
+        return bool(self.dirty)
+
+    # Routine to delete the given messages, replaced in the chunk map.
+    async def _delete_replaced(self, pointers):
+        if self.replaced is not None:
+            await self.replaced(pointers)
+            return
+        for pointer in pointers:
+            await self.wrapper.delete_data(pointer)
+
+    # Routine to get the message id of a chunk, 0 if it was never written.
+    def _chunk_pointer(self, index):
+        chunks = self.inode.chunks
+        return chunks[index] if chunks is not None and index < len(chunks) else 0
+
+    # Routine to make sure the chunk with the given index is loaded in the
+    # buffer. Concurrent calls for the same chunk share the download.
+    async def _load_chunk(self, index):
+        # being loaded by another call: wait for it
+        while index in self.loading:
+            future = self.loading[index]
+            await asyncio.wait([future])
+            # if it was cancelled (a prefetch) try again
+            if not future.cancelled():
+                return future.result()
+        # already loaded
+        if index in self.loaded:
+            return
+        # the contents kept inline are the first chunk
+        if self.inode.inline is not None and index == 0:
+            self.buffer.fill(0, self.inode.inline)
+            self.loaded.add(0)
+            return
+        pointer = self._chunk_pointer(index)
+        # a chunk never written has nothing to load
+        if not pointer:
+            self.loaded.add(index)
+            return
+        self.loading[index] = asyncio.get_event_loop().create_future()
+        try:
+            data = await self.wrapper.read_raw(pointer)
+            # the message is missing from the storage
+            if data is None:
+                raise FUSEError(errno.EIO)
+            # it may have been completely overwritten in the meantime
+            if index not in self.loaded:
+                # keep the bytes written while downloading
+                self.buffer.fill(index * CHUNK_SIZE, data)
+                self.loaded.add(index)
+            self.loading.pop(index).set_result(None)
+        except asyncio.CancelledError:
+            self.loading.pop(index).cancel()
+            raise
+        except BaseException as e:
+            self.loading.pop(index).set_exception(e)
+            raise
+
+    # Routine to read size bytes from offset off, only the chunks covering
+    # the requested range are loaded (concurrently). The data is returned
+    # as a memoryview of the buffer when possible.
+    async def read(self, off, size):
+        # do not read past the end of the file
+        end = min(off + size, self.inode.attributes.st_size)
+        if end <= off:
+            return b''
+        # load the required chunks
+        await asyncio.gather(*[self._load_chunk(i) for i in range(off // CHUNK_SIZE, (end - 1) // CHUNK_SIZE + 1)])
+        # read from the buffer
+        return self.buffer.read(off, end - off)
+
+    # Routine to write buf at offset off. Chunks partially overwritten are
+    # loaded first, the ones written are marked as dirty.
+    async def write(self, off, buf):
+        # nothing to do for empty writes
+        if not buf:
+            return
+        end = off + len(buf)
+        first = off // CHUNK_SIZE
+        last = (end - 1) // CHUNK_SIZE
+        # the first and last chunks may be partially overwritten: load them
+        # (the others are completely overwritten and don't need to be)
+        partial = {i for i in (first, last)
+                   if i * CHUNK_SIZE < off or min((i + 1) * CHUNK_SIZE, self.inode.attributes.st_size) > end}
+        await asyncio.gather(*[self._load_chunk(i) for i in partial])
+        # write in the buffer
+        self.buffer.write(off, buf)
+        chunks = range(first, last + 1)
+        self.loaded.update(chunks)
+        self.dirty.update(chunks)
+        # update the size
+        self.inode.attributes.st_size = max(self.inode.attributes.st_size, end)
+
+    # Routine to set the size of the file. Growing only changes the size,
+    # the new bytes are a hole. Shrinking turns the chunks past the end into
+    # holes (their messages are deleted) and only loads the chunk cut by
+    # the new size to rewrite it; a file shrunk to inline_threshold bytes
+    # goes back inline in the next flush.
+    async def truncate(self, size):
+        old_size = self.inode.attributes.st_size
+        if size < old_size:
+            n_chunks = -(-size // CHUNK_SIZE)
+            # the chunk cut by the new size keeps its bytes before it
+            if size % CHUNK_SIZE:
+                await self._load_chunk(size // CHUNK_SIZE)
+                self.dirty.add(size // CHUNK_SIZE)
+            self.buffer.truncate(size)
+            self.dirty = {index for index in self.dirty if index < n_chunks}
+            # the chunks past the end are holes now: nothing to load (the
+            # downloads still running for them are discarded)
+            self.loaded.update(range(n_chunks, -(-old_size // CHUNK_SIZE)))
+            if size <= self.inline_threshold:
+                self.dirty.add(0)
+            if self.inode.chunks is not None:
+                dropped = self.inode.chunks[n_chunks:]
+                del self.inode.chunks[n_chunks:]
+                await self._delete_replaced([pointer for pointer in dropped if pointer])
+        self.inode.attributes.st_size = size
+
+    # Routine to upload the modified chunks, replacing their old messages
+    # (or to keep the contents inline when small enough).
+    async def flush(self):
+        # a file created before chunking is written completely as chunks
+        if self.inode.chunks is None:
+            self.inode.chunks = []
+            self.dirty.update(index for index in self.loaded
+                              if index * CHUNK_SIZE < self.inode.attributes.st_size)
+        if self.inode.attributes.st_size <= self.inline_threshold:
+            await self._flush_inline()
+        else:
+            await self._flush_chunks()
+        # delete the contents stored before chunking
+        if self.legacy_pointer:
+            legacy_pointer = self.legacy_pointer
+            self.inode.data_pointer = self.legacy_pointer = 0
+            await self._delete_replaced([legacy_pointer])
+
+    # Routine to keep the contents in the inode, the messages of the chunks
+    # are deleted.
+    async def _flush_inline(self):
+        size = self.inode.attributes.st_size
+        if size:
+            await self._load_chunk(0)
+        self.dirty = set()
+        old_pointers = [pointer for pointer in self.inode.chunks if pointer]
+        self.inode.inline = bytes(self.buffer.read(0, size))
+        self.inode.chunks = []
+        await self._delete_replaced(old_pointers)
+
+    async def _flush_chunks(self):
+        # the contents kept inline until now are written as the first chunk
+        if self.inode.inline is not None:
+            await self._load_chunk(0)
+            self.dirty.add(0)
+        # extend the chunk map to the size of the file
+        n_chunks = -(-self.inode.attributes.st_size // CHUNK_SIZE)
+        self.inode.chunks.extend([0] * (n_chunks - len(self.inode.chunks)))
+        # take the dirty set, chunks modified during the upload stay dirty
+        dirty = self.dirty
+        self.dirty = set()
+        # upload the chunks concurrently
+        try:
+            await asyncio.gather(*[self._flush_chunk(index) for index in sorted(dirty)])
+        except:
+            # keep them dirty to retry later
+            self.dirty |= dirty
+            raise
+        self.inode.inline = None
+
+    # Routine to upload a single chunk and update the chunk map.
+    async def _flush_chunk(self, index):
+        off = index * CHUNK_SIZE
+        # copy the chunk, it may be modified during the upload
+        data = bytes(self.buffer.read(off, min(CHUNK_SIZE, self.inode.attributes.st_size - off)))
+        old = self.inode.chunks[index] or None
+        # only zeros: kept as a hole
+        self.inode.chunks[index] = 0 if is_hole(data) else await self.wrapper.write_chunk(data)
+        if old is not None:
+            await self._delete_replaced([old])
@@ -0,0 +1,244 @@
+import asyncio
+import errno
+import logging
+from collections import OrderedDict
+from pyfuse3 import FUSEError
+import serialization
+from data_structures import *
+
+log = logging.getLogger(__name__)
+
+
+# Groups the small objects written to a storage backend (the chunks of
+# small files, directory shards and journals up to max_object bytes) in
+# packs, so that many of them take a single message and a single call.
+# Objects are given a pointer at once (see pack_pointer) and their pack is
+# uploaded in background when it reaches pack_size bytes or linger seconds
+# after its first object; until then they are read from memory. Reads
+# download and keep whole packs (the cache_packs most recently used). When
+# the live objects of a pack fall below compact_ratio of its bytes it is
+# rewritten with only them (with the same slots); a pack with no live
+# objects is just dropped. The old messages are only deleted once the
+# superblock (or journal batch) pointing to the table without them is
+# pinned (see save). The PackTable is loaded when first needed and written
+# with the superblock.
+class PackStore:
+    def __init__(self, backend, max_object=64 * 1024, pack_size=4 * 1024 * 1024, linger=0.5,
+                 compact_ratio=0.5, cache_packs=8, retry_delay=5):
+        self.backend = backend
+        # objects up to this size are packed (0 disables packing, packs
+        # written before are still read)
+        self.max_object = max_object
+        self.pack_size = pack_size
+        self.linger = linger
+        self.compact_ratio = compact_ratio
+        self.cache_packs = cache_packs
+        self.retry_delay = retry_delay
+        # message id of the table (from the superblock) and the table once
+        # loaded, modified since written or not
+        self.table_pointer = 0
+        self.table = None
+        self.table_dirty = False
+        self.table_lock = asyncio.Lock()
+        # number of the pack being filled (None if there is none) and the
+        # objects of the packs not uploaded yet by pack number (by slot)
+        self.current = None
+        self.current_size = 0
+        self.pending = {}
+        self.linger_handle = None
+        # uploads and compactions running
+        self.tasks = set()
+        self.compacting = set()
+        # messages of the packs dropped or rewritten since the table was
+        # written
+        self.obsolete = []
+        # objects of the recently read packs by message id
+        self.cache = OrderedDict()
+        # counters
+        self.packed_objects = 0
+        self.packs_written = 0
+        self.compactions = 0
+
+    # Routine to start from the pack table of the given superblock.
+    def open(self, superblock):
+        if superblock.pack_pointer != self.table_pointer:
+            self.table_pointer = superblock.pack_pointer
+            self.table = None
+
+    def accepts(self, data):
+        return len(data) <= self.max_object
+
+    async def _get_table(self):
+        if self.table is None:
+            async with self.table_lock:
+                if self.table is None:
+                    self.table = (await self.backend.read_data(self.table_pointer) if self.table_pointer
+                                  else PackTable())
+        return self.table
+
+    # Routine to add an object to the pack being filled. It returns the
+    # pointer to the object.
+    async def put(self, data):
+        table = await self._get_table()
+        # start a new pack if needed
+        if self.current is None:
+            self.current = table.next_pack
+            table.next_pack += 1
+            table.packs[self.current] = Pack()
+            self.pending[self.current] = {}
+            self.current_size = 0
+            self.linger_handle = asyncio.get_event_loop().call_later(self.linger, self._seal)
+        pack_n = self.current
+        objects = self.pending[pack_n]
+        slot = len(objects)
+        objects[slot] = bytes(data)
+        table.packs[pack_n].live[slot] = len(data)
+        self.table_dirty = True
+        self.packed_objects += 1
+        self.current_size += len(data)
+        if self.current_size >= self.pack_size or len(objects) >= PACK_SLOTS:
+            self._seal()
+        return pack_pointer(pack_n, slot)
+
+    # Routine to close the pack being filled and upload it in background.
+    def _seal(self):
+        if self.current is None:
+            return
+        self.linger_handle.cancel()
+        pack_n = self.current
+        self.current = None
+        self._start(self._upload(pack_n))
+
+    def _start(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    # Routine to upload a pack (its live objects), retrying until it is.
+    async def _upload(self, pack_n):
+        pack = self.table.packs[pack_n]
+        while True:
+            objects = {slot: data for (slot, data) in self.pending[pack_n].items() if slot in pack.live}
+            # every object was released meanwhile
+            if not objects:
+                break
+            try:
+                (pack.message_id, pack.size) = await self._write(objects)
+                break
+            except Exception:
+                log.exception('upload of pack %d failed, retrying in %s seconds', pack_n, self.retry_delay)
+                await asyncio.sleep(self.retry_delay)
+        del self.pending[pack_n]
+        self._check(pack_n)
+
+    # Routine to write the given objects as a pack. It returns the message
+    # id and the bytes of the objects.
+    async def _write(self, objects):
+        message_id = await self.backend.write_raw(serialization.dump_pack(objects), 'pack', may_pack=False)
+        self.packs_written += 1
+        self.table_dirty = True
+        return (message_id, sum(len(data) for data in objects.values()))
+
+    # Routine to get a packed object.
+    async def read(self, pointer):
+        (pack_n, slot) = split_pack_pointer(pointer)
+        while True:
+            # not uploaded yet
+            objects = self.pending.get(pack_n, None)
+            if objects is not None:
+                return objects[slot]
+            table = await self._get_table()
+            message_id = table.packs[pack_n].message_id
+            objects = self.cache.get(message_id, None)
+            if objects is None:
+                data = await self.backend.read_raw(message_id)
+                # rewritten by the compactor meanwhile: try again
+                if data is None and table.packs[pack_n].message_id != message_id:
+                    continue
+                # the message is missing from the storage
+                if data is None:
+                    raise FUSEError(errno.EIO)
+                objects = serialization.loads(data)
+                self.cache[message_id] = objects
+                while len(self.cache) > self.cache_packs:
+                    self.cache.popitem(last=False)
+            self.cache.move_to_end(message_id)
+            return objects[slot]
+
+    # Routine to release an object no longer referenced.
+    async def release(self, pointer):
+        table = await self._get_table()
+        (pack_n, slot) = split_pack_pointer(pointer)
+        pack = table.packs.get(pack_n, None)
+        if pack is None or slot not in pack.live:
+            return
+        del pack.live[slot]
+        self.table_dirty = True
+        self._check(pack_n)
+
+    # Routine to delete or compact an uploaded pack if needed.
+    def _check(self, pack_n):
+        pack = self.table.packs.get(pack_n, None)
+        if pack is None or pack_n in self.pending or pack_n in self.compacting:
+            return
+        if not pack.live:
+            del self.table.packs[pack_n]
+            self.table_dirty = True
+            if pack.message_id:
+                self._drop(pack.message_id)
+        elif pack.live_bytes() < self.compact_ratio * pack.size:
+            self.compacting.add(pack_n)
+            self._start(self._compact(pack_n))
+
+    def _drop(self, message_id):
+        self.cache.pop(message_id, None)
+        self.obsolete.append(message_id)
+
+    # Routine to rewrite a pack with only its live objects.
+    async def _compact(self, pack_n):
+        try:
+            pack = self.table.packs[pack_n]
+            old_id = pack.message_id
+            # the objects are read before checking which ones are live
+            objects = {slot: bytes(await self.read(pack_pointer(pack_n, slot))) for slot in list(pack.live)}
+            objects = {slot: data for (slot, data) in objects.items() if slot in pack.live}
+            (pack.message_id, pack.size) = await self._write(objects)
+            self.compactions += 1
+            self._drop(old_id)
+        except Exception:
+            log.exception('compaction of pack %d failed', pack_n)
+        finally:
+            self.compacting.discard(pack_n)
+        self._check(pack_n)
+
+    # Routine to wait for the packs being uploaded (including the one being
+    # filled) and the compactions.
+    async def flush(self):
+        self._seal()
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks))
+
+    # Routine to write the table (when modified) after uploading every
+    # pack. It returns the message id of the table and the list of the
+    # messages it replaces (the old table and the packs dropped or
+    # rewritten), to delete once the superblock is written. The packs
+    # started after the flush are left out (they only hold objects written
+    # after the metadata being saved); they are in the next table.
+    async def save(self):
+        await self.flush()
+        if not self.table_dirty:
+            return (self.table_pointer, [])
+        old_pointer = self.table_pointer
+        obsolete = self.obsolete
+        self.obsolete = []
+        self.table_dirty = False
+        try:
+            table = PackTable(self.table.next_pack,
+                              {pack_n: pack for (pack_n, pack) in self.table.packs.items() if pack.message_id})
+            self.table_pointer = await self.backend.write_raw(serialization.dumps(table), 'pack table',
+                                                              may_pack=False)
+        except:
+            self.table_dirty = True
+            self.obsolete = obsolete + self.obsolete
+            raise
+        return (self.table_pointer, ([old_pointer] if old_pointer else []) + obsolete)
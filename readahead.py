@@ -0,0 +1,69 @@
+import asyncio
+from data_structures import *
+
+
+# Sequential readahead of a file handle. Reads starting near where the
+# previous one ended are considered sequential and prefetch (concurrently
+# and without waiting for them) the chunks following the read, a window
+# that starts with one chunk and doubles every time the reader moves to a
+# new chunk, up to max_window chunks. A read elsewhere in the file means
+# the access turned random: the prefetches not finished are cancelled and
+# the window starts again from zero, so random reads don't prefetch.
+class Readahead:
+    def __init__(self, open_file, max_window=8):
+        # the open file read through the handle
+        self.open_file = open_file
+        # maximum number of chunks prefetched (0 disables readahead)
+        self.max_window = max_window
+        # current number of chunks prefetched
+        self.window = 0
+        # offset where the last read ended (reading from the start of the
+        # file is considered sequential)
+        self.pos = 0
+        # prefetch tasks by chunk index
+        self.tasks = {}
+
+    # Routine to be called before reading size bytes from offset off.
+    def access(self, off, size):
+        if not self.max_window:
+            return
+        end = min(off + size, self.open_file.inode.attributes.st_size)
+        # the kernel may reorder concurrent reads: tolerate a chunk of
+        # difference
+        if abs(off - self.pos) > CHUNK_SIZE:
+            # random access: stop prefetching
+            self.cancel()
+            self.window = 0
+            self.pos = end
+        elif end > self.pos:
+            # sequential and moving to a new chunk: grow the window
+            if (end - 1) // CHUNK_SIZE > (self.pos - 1) // CHUNK_SIZE:
+                self.window = min(max(1, self.window * 2), self.max_window)
+            self.pos = end
+        if self.window and end > off:
+            self._prefetch((end - 1) // CHUNK_SIZE + 1)
+
+    # Routine to start loading the window of chunks from the given index.
+    def _prefetch(self, first):
+        of = self.open_file
+        n_chunks = -(-of.inode.attributes.st_size // CHUNK_SIZE)
+        for index in range(first, min(first + self.window, n_chunks)):
+            # already loaded or being loaded
+            if index in of.loaded or index in of.loading or index in self.tasks:
+                continue
+            task = asyncio.ensure_future(of._load_chunk(index))
+            self.tasks[index] = task
+            task.add_done_callback(lambda task, index=index: self._done(index, task))
+
+    def _done(self, index, task):
+        if self.tasks.get(index, None) is task:
+            del self.tasks[index]
+        # errors are raised again to the reader that needs the chunk
+        if not task.cancelled():
+            task.exception()
+
+    # Routine to cancel the prefetches not finished.
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
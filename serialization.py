@@ -0,0 +1,410 @@
+import pickle
+import struct
+from array import array
+from data_structures import *
+
+# Compact binary format of the metadata stored in messages. Every message
+# starts with a header: the magic bytes, the format version and the kind of
+# record. Integers are little endian. Messages without the magic bytes were
+# written with pickle (before this format existed) and are still readable.
+# Version 2 split the inode table of the superblock in segments and
+# directories in shards, version 3 added the inline contents of the inodes
+# and version 4 the packs. Version 5 added the index of the deduplicated
+# chunks, version 6 the messages left to delete and version 7 the batches
+# of the metadata journal.
+MAGIC = b'TGFS'
+VERSION = 7
+HEADER = struct.Struct('<4sBB')
+
+# kinds of records
+SUPERBLOCK = 1
+DIRECTORY = 2
+SEGMENT = 3
+SHARD = 4
+JOURNAL = 5
+PACK = 6
+PACK_TABLE = 7
+DEDUP_INDEX = 8
+METADATA_BATCH = 9
+
+# inode record: number, mode, nlink, uid, gid, size, atime, mtime, ctime,
+# data pointer and number of chunks (NO_CHUNK_MAP when it has none), followed
+# by the message id of each chunk
+INODE = struct.Struct('<QIIIIQqqqqI')
+NO_CHUNK_MAP = 0xFFFFFFFF
+# length of the inline contents of an inode (NO_INLINE when it has none),
+# following its record and chunk map since version 3
+INLINE = struct.Struct('<I')
+NO_INLINE = 0xFFFFFFFF
+COUNT = struct.Struct('<I')
+# segment of the inode table: message id and number of used inodes
+SEGMENT_POINTER = struct.Struct('<qI')
+# directory entry: name length and inode number, followed by the name
+ENTRY = struct.Struct('<HQ')
+# entry of a directory shard (or record of a journal): name length, inode
+# number and cookie, followed by the name
+SHARD_ENTRY = struct.Struct('<HQQ')
+# message id of the pack table, after the segments of the superblock
+POINTER = struct.Struct('<q')
+# object of a pack: slot, offset and length, followed by the objects
+PACK_OBJECT = struct.Struct('<III')
+# pack table: next pack number and number of packs, followed by each pack:
+# number, message id, size and number of live objects,
+# followed by the slot and length of each of them
+PACK_TABLE_HEADER = struct.Struct('<QI')
+PACK_ENTRY = struct.Struct('<QqQI')
+PACK_LIVE = struct.Struct('<II')
+# chunk of the dedup index: hash, pointer, length and references
+DEDUP_ENTRY = struct.Struct('<32sqII')
+# batch of the metadata journal: message ids of the previous batch (or
+# superblock), of the pack table and of the dedup index
+BATCH_HEADER = struct.Struct('<qqq')
+
+
+# Raised when a message can't be decoded.
+class FormatError(Exception):
+    pass
+
+
+# Routine to encode a Superblock, an InodeSegment, a DirectoryShard, a
+# DirectoryJournal, a PackTable, a DedupIndex, a MetadataBatch or a
+# DirectoryData as bytes (packs are encoded by dump_pack).
+def dumps(obj):
+    if isinstance(obj, Superblock):
+        return HEADER.pack(MAGIC, VERSION, SUPERBLOCK) + _dump_superblock(obj)
+    if isinstance(obj, InodeSegment):
+        return HEADER.pack(MAGIC, VERSION, SEGMENT) + _dump_segment(obj)
+    if isinstance(obj, DirectoryShard):
+        return HEADER.pack(MAGIC, VERSION, SHARD) + _dump_entries(
+            (name, inode_n, cookie) for (name, (inode_n, cookie)) in obj.entries.items())
+    if isinstance(obj, DirectoryJournal):
+        return HEADER.pack(MAGIC, VERSION, JOURNAL) + _dump_entries(obj.records)
+    if isinstance(obj, PackTable):
+        return HEADER.pack(MAGIC, VERSION, PACK_TABLE) + _dump_pack_table(obj)
+    if isinstance(obj, DedupIndex):
+        return HEADER.pack(MAGIC, VERSION, DEDUP_INDEX) + _dump_dedup_index(obj)
+    if isinstance(obj, MetadataBatch):
+        return HEADER.pack(MAGIC, VERSION, METADATA_BATCH) + _dump_batch(obj)
+    if isinstance(obj, DirectoryData):
+        return HEADER.pack(MAGIC, VERSION, DIRECTORY) + _dump_directory(obj)
+    raise TypeError('cannot serialize %s' % type(obj).__name__)
+
+
+# Routine to decode the bytes written by dumps (or by pickle before).
+def loads(data):
+    view = memoryview(data)
+    # written by pickle
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        obj = pickle.loads(view)
+        # a superblock without segments: convert it
+        if isinstance(obj, Superblock) and 'segments' not in vars(obj):
+            obj = Superblock.from_inodes(obj.inodes)
+        return obj
+    (_, version, kind) = HEADER.unpack_from(view)
+    if version > VERSION:
+        raise FormatError('unsupported format version %d' % version)
+    if kind == SUPERBLOCK:
+        if version == 1:
+            return _load_superblock_v1(view, HEADER.size)
+        return _load_superblock(view, HEADER.size, version)
+    if kind == SEGMENT:
+        return _load_segment(view, HEADER.size, version)
+    if kind == SHARD:
+        return DirectoryShard(_load_entries(view, HEADER.size))
+    if kind == JOURNAL:
+        return DirectoryJournal(_load_entries(view, HEADER.size))
+    if kind == PACK_TABLE:
+        return _load_pack_table(view, HEADER.size)
+    if kind == PACK:
+        return _load_pack(view, HEADER.size)
+    if kind == DEDUP_INDEX:
+        return _load_dedup_index(view, HEADER.size)
+    if kind == METADATA_BATCH:
+        return _load_batch(view, HEADER.size, version)
+    if kind == DIRECTORY:
+        return _load_directory(view, HEADER.size)
+    raise FormatError('unknown record kind %d' % kind)
+
+
+def _dump_inode(inode, parts):
+    attr = inode.attributes
+    chunks = inode.chunks
+    parts.append(INODE.pack(attr.st_ino, attr.st_mode, attr.st_nlink, attr.st_uid, attr.st_gid, attr.st_size,
+                            attr.st_atime_ns, attr.st_mtime_ns, attr.st_ctime_ns, inode.data_pointer,
+                            NO_CHUNK_MAP if chunks is None else len(chunks)))
+    if chunks:
+        parts.append(array('q', chunks).tobytes())
+    if inode.inline is None:
+        parts.append(INLINE.pack(NO_INLINE))
+    else:
+        parts.append(INLINE.pack(len(inode.inline)))
+        parts.append(inode.inline)
+
+
+def _load_inode(view, off, version=VERSION):
+    (number, mode, nlink, uid, gid, size, atime, mtime, ctime, pointer, n_chunks) = INODE.unpack_from(view, off)
+    off += INODE.size
+    inode = Inode(number)
+    attr = inode.attributes
+    attr.st_mode = mode
+    attr.st_nlink = nlink
+    attr.st_uid = uid
+    attr.st_gid = gid
+    attr.st_size = size
+    attr.st_atime_ns = atime
+    attr.st_mtime_ns = mtime
+    attr.st_ctime_ns = ctime
+    inode.data_pointer = pointer
+    if n_chunks == NO_CHUNK_MAP:
+        # stored as a single FileData (keep the class default)
+        del inode.chunks
+    elif n_chunks:
+        chunks = array('q')
+        chunks.frombytes(view[off:off + 8 * n_chunks])
+        inode.chunks = chunks.tolist()
+        off += 8 * n_chunks
+    if version >= 3:
+        (length,) = INLINE.unpack_from(view, off)
+        off += INLINE.size
+        if length != NO_INLINE:
+            inode.inline = bytes(view[off:off + length])
+            off += length
+    return (inode, off)
+
+
+# The superblock is encoded as the number of segments followed by the
+# message id and number of used inodes of each one, the message ids of the
+# pack table and the dedup index and the message ids left to delete.
+def _dump_superblock(superblock):
+    parts = [COUNT.pack(len(superblock.pointers))]
+    parts.extend(SEGMENT_POINTER.pack(pointer, used) for (pointer, used) in zip(superblock.pointers, superblock.used))
+    parts.append(POINTER.pack(superblock.pack_pointer))
+    parts.append(POINTER.pack(superblock.dedup_pointer))
+    parts.append(COUNT.pack(len(superblock.deletions)))
+    parts.extend(POINTER.pack(message_id) for message_id in superblock.deletions)
+    return b''.join(parts)
+
+
+def _load_superblock(view, off, version):
+    superblock = Superblock.__new__(Superblock)
+    (n_segments,) = COUNT.unpack_from(view, off)
+    off += COUNT.size
+    pointers = SEGMENT_POINTER.iter_unpack(view[off:off + SEGMENT_POINTER.size * n_segments])
+    (superblock.pointers, superblock.used) = (list(values) for values in zip(*pointers))
+    off += SEGMENT_POINTER.size * n_segments
+    if version >= 4:
+        (superblock.pack_pointer,) = POINTER.unpack_from(view, off)
+        off += POINTER.size
+    if version >= 5:
+        (superblock.dedup_pointer,) = POINTER.unpack_from(view, off)
+        off += POINTER.size
+    if version >= 6:
+        (n_deletions,) = COUNT.unpack_from(view, off)
+        off += COUNT.size
+        superblock.deletions = [message_id for (message_id,) in
+                                POINTER.iter_unpack(view[off:off + POINTER.size * n_deletions])]
+    # no segment is loaded yet
+    superblock.segments = {}
+    superblock.with_space = set()
+    superblock.dirty = set()
+    superblock.changed = set()
+    superblock.replayed = {}
+    superblock.stored = {}
+    return superblock
+
+
+# A segment is encoded as its index and number of inodes followed by them.
+def _dump_segment(segment):
+    parts = [COUNT.pack(segment.index), COUNT.pack(len(segment.inodes))]
+    for inode in segment.inodes.values():
+        _dump_inode(inode, parts)
+    return b''.join(parts)
+
+
+def _load_segment(view, off, version):
+    (index,) = COUNT.unpack_from(view, off)
+    off += COUNT.size
+    inodes = []
+    (n_inodes,) = COUNT.unpack_from(view, off)
+    off += COUNT.size
+    for _ in range(n_inodes):
+        (inode, off) = _load_inode(view, off, version)
+        inodes.append(inode)
+    return InodeSegment(index, inodes)
+
+
+# In version 1 the superblock held all the inodes, encoded as their number
+# and records followed by the free inode numbers as ranges (not needed).
+def _load_superblock_v1(view, off):
+    inodes = {}
+    (n_inodes,) = COUNT.unpack_from(view, off)
+    off += COUNT.size
+    for _ in range(n_inodes):
+        (inode, off) = _load_inode(view, off, 1)
+        inodes[inode.attributes.st_ino] = inode
+    return Superblock.from_inodes(inodes)
+
+
+# A directory is encoded as the number of entries followed by them.
+def _dump_directory(dd):
+    parts = [COUNT.pack(len(dd.entries))]
+    for (name, inode_n) in dd.entries.items():
+        parts.append(ENTRY.pack(len(name), inode_n))
+        parts.append(name)
+    return b''.join(parts)
+
+
+def _load_directory(view, off):
+    dd = DirectoryData.__new__(DirectoryData)
+    dd.entries = {}
+    (n_entries,) = COUNT.unpack_from(view, off)
+    off += COUNT.size
+    for _ in range(n_entries):
+        (length, inode_n) = ENTRY.unpack_from(view, off)
+        off += ENTRY.size
+        dd.entries[bytes(view[off:off + length])] = inode_n
+        off += length
+    return dd
+
+
+# The entries of a directory shard and the records of a journal are encoded
+# as their number followed by them.
+def _dump_entries(entries):
+    parts = [COUNT.pack(0)]
+    for (name, inode_n, cookie) in entries:
+        parts.append(SHARD_ENTRY.pack(len(name), inode_n, cookie))
+        parts.append(name)
+    parts[0] = COUNT.pack((len(parts) - 1) // 2)
+    return b''.join(parts)
+
+
+def _load_entries(view, off):
+    entries = []
+    (n_entries,) = COUNT.unpack_from(view, off)
+    off += COUNT.size
+    for _ in range(n_entries):
+        (length, inode_n, cookie) = SHARD_ENTRY.unpack_from(view, off)
+        off += SHARD_ENTRY.size
+        entries.append((bytes(view[off:off + length]), inode_n, cookie))
+        off += length
+    return entries
+
+
+# Routine to encode the objects of a pack given by slot.
+def dump_pack(objects):
+    parts = [HEADER.pack(MAGIC, VERSION, PACK), COUNT.pack(len(objects))]
+    off = 0
+    for (slot, data) in objects.items():
+        parts.append(PACK_OBJECT.pack(slot, off, len(data)))
+        off += len(data)
+    parts.extend(objects.values())
+    return b''.join(parts)
+
+
+# A pack is decoded as a dict of its objects by slot (as memoryviews of
+# the given data).
+def _load_pack(view, off):
+    (n_objects,) = COUNT.unpack_from(view, off)
+    off += COUNT.size
+    start = off + PACK_OBJECT.size * n_objects
+    objects = {}
+    for (slot, offset, length) in PACK_OBJECT.iter_unpack(view[off:start]):
+        objects[slot] = view[start + offset:start + offset + length]
+    return objects
+
+
+def _dump_pack_table(table):
+    parts = [PACK_TABLE_HEADER.pack(table.next_pack, len(table.packs))]
+    for (pack_n, pack) in table.packs.items():
+        parts.append(PACK_ENTRY.pack(pack_n, pack.message_id, pack.size, len(pack.live)))
+        parts.extend(PACK_LIVE.pack(slot, length) for (slot, length) in pack.live.items())
+    return b''.join(parts)
+
+
+def _load_pack_table(view, off):
+    (next_pack, n_packs) = PACK_TABLE_HEADER.unpack_from(view, off)
+    off += PACK_TABLE_HEADER.size
+    packs = {}
+    for _ in range(n_packs):
+        (pack_n, message_id, size, n_live) = PACK_ENTRY.unpack_from(view, off)
+        off += PACK_ENTRY.size
+        live = dict(PACK_LIVE.iter_unpack(view[off:off + PACK_LIVE.size * n_live]))
+        off += PACK_LIVE.size * n_live
+        packs[pack_n] = Pack(message_id, size, live)
+    return PackTable(next_pack, packs)
+
+
+# The dedup index is encoded as the number of chunks followed by the entry
+# of each one.
+def _dump_dedup_index(index):
+    parts = [COUNT.pack(len(index.chunks))]
+    parts.extend(DEDUP_ENTRY.pack(digest, entry.pointer, entry.length, entry.refs)
+                 for (digest, entry) in index.chunks.items())
+    return b''.join(parts)
+
+
+def _load_dedup_index(view, off):
+    (n_chunks,) = COUNT.unpack_from(view, off)
+    off += COUNT.size
+    chunks = {}
+    for (digest, pointer, length, refs) in DEDUP_ENTRY.iter_unpack(view[off:off + DEDUP_ENTRY.size * n_chunks]):
+        chunks[digest] = DedupEntry(pointer, length, refs)
+    return DedupIndex(chunks)
+
+
+# A batch of the metadata journal is encoded as its header followed by the
+# number of segments and the used inodes of each one, the number of inodes
+# and their records, the number of freed inodes and their numbers, and the
+# number of messages left to delete and their ids.
+def _dump_batch(batch):
+    parts = [BATCH_HEADER.pack(batch.previous, batch.pack_pointer, batch.dedup_pointer),
+             COUNT.pack(len(batch.used)), array('I', batch.used).tobytes(), COUNT.pack(len(batch.inodes))]
+    for inode in batch.inodes:
+        _dump_inode(inode, parts)
+    parts.append(COUNT.pack(len(batch.freed)))
+    parts.append(array('Q', batch.freed).tobytes())
+    _dump_batch_deletions(batch.deletions, parts)
+    return b''.join(parts)
+
+
+def _dump_batch_deletions(deletions, parts):
+    parts.append(COUNT.pack(len(deletions)))
+    parts.extend(POINTER.pack(message_id) for message_id in deletions)
+
+
+def _load_batch(view, off, version):
+    batch = MetadataBatch(*BATCH_HEADER.unpack_from(view, off))
+    off += BATCH_HEADER.size
+    (n_segments,) = COUNT.unpack_from(view, off)
+    off += COUNT.size
+    used = array('I')
+    used.frombytes(view[off:off + 4 * n_segments])
+    batch.used = used.tolist()
+    off += 4 * n_segments
+    (n_inodes,) = COUNT.unpack_from(view, off)
+    off += COUNT.size
+    for _ in range(n_inodes):
+        (inode, off) = _load_inode(view, off, version)
+        batch.inodes.append(inode)
+    (n_freed,) = COUNT.unpack_from(view, off)
+    off += COUNT.size
+    freed = array('Q')
+    freed.frombytes(view[off:off + 8 * n_freed])
+    batch.freed = freed.tolist()
+    off += 8 * n_freed
+    (n_deletions,) = COUNT.unpack_from(view, off)
+    off += COUNT.size
+    batch.deletions = [message_id for (message_id,) in
+                       POINTER.iter_unpack(view[off:off + POINTER.size * n_deletions])]
+    return batch
+
+
+# Routine to set the message ids of the pack table and of the dedup index
+# and the messages left to delete of an encoded batch (encoded without
+# them), which is encoded before they are known (see MetadataJournal).
+def complete_batch(data, pack_pointer, dedup_pointer, deletions):
+    data = bytearray(data[:len(data) - COUNT.size])
+    struct.pack_into('<qq', data, HEADER.size + POINTER.size, pack_pointer, dedup_pointer)
+    parts = [bytes(data)]
+    _dump_batch_deletions(deletions, parts)
+    return b''.join(parts)
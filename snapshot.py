@@ -0,0 +1,73 @@
+import os
+import struct
+import serialization
+from data_structures import Superblock, InodeSegment
+
+# header of the snapshot file: the id of the pinned message it was taken
+# from, followed by the serialized superblock and the serialized segments
+# it had loaded, each one preceded by its length
+PINNED_ID = struct.Struct('<q')
+LENGTH = struct.Struct('<I')
+
+
+# A copy of the superblock kept in a local file, tagged with the id of the
+# pinned message holding the same superblock. It is saved when the file
+# system is closed so the next mount can start from it without waiting for
+# the storage; the mount compares the tag with the pinned message to detect
+# that the file system was changed elsewhere in the meantime. The segments
+# of the inode table that were loaded are saved too (the messages holding
+# them never change while the tag matches), so the first operations need
+# no download either.
+class SuperblockSnapshot:
+    def __init__(self, path):
+        self.path = path
+
+    # Routine to load the snapshot. It returns the pinned message id and the
+    # superblock (with the segments saved loaded), None if there is no
+    # valid snapshot.
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            (pinned_id,) = PINNED_ID.unpack_from(data)
+            objects = []
+            off = PINNED_ID.size
+            while off < len(data):
+                (length,) = LENGTH.unpack_from(data, off)
+                off += LENGTH.size
+                # never unpickle a local file
+                if length < len(serialization.MAGIC) or not data.startswith(serialization.MAGIC, off):
+                    return None
+                objects.append(serialization.loads(data[off:off + length]))
+                off += length
+        except (OSError, struct.error, serialization.FormatError):
+            return None
+        if not objects or not isinstance(objects[0], Superblock):
+            return None
+        superblock = objects[0]
+        for segment in objects[1:]:
+            if not isinstance(segment, InodeSegment) or not 0 <= segment.index < len(superblock.pointers):
+                return None
+            superblock.add_segment(segment)
+        return (pinned_id, superblock)
+
+    # Routine to save the superblock pinned as the given message id with
+    # its loaded segments (the ones written). The file is replaced
+    # atomically.
+    def save(self, pinned_id, superblock):
+        objects = [superblock] + [superblock.stored_segment(index) for index in sorted(superblock.segments)
+                                  if index not in superblock.dirty]
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(PINNED_ID.pack(pinned_id))
+            for obj in objects:
+                data = serialization.dumps(obj)
+                f.write(LENGTH.pack(len(data)))
+                f.write(data)
+        os.replace(self.path + '.tmp', self.path)
+
+    # Routine to delete the snapshot (if any).
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,106 @@
+import mmap
+import tempfile
+from bisect import bisect_left, bisect_right
+
+# bytes overwritten at a time to zero a range that can't be released
+ZERO_STEP = 1024 * 1024
+
+
+# A buffer with the same interface as ExtentBuffer whose contents are kept
+# in a sparse temporary file mapped in memory instead of the memory of the
+# process: the kernel writes its pages to disk and drops them when memory
+# is needed. The file is created with the given capacity (disk space is
+# only used by the bytes written) and deleted when the buffer is freed.
+# The ranges written are kept to tell them from the holes, which read as
+# zeros.
+class SpillBuffer:
+    def __init__(self, directory, capacity):
+        with tempfile.TemporaryFile(dir=directory) as f:
+            f.truncate(capacity)
+            self.map = mmap.mmap(f.fileno(), capacity)
+        # starts and ends of the ranges written, sorted and disjoint
+        self.starts = []
+        self.ends = []
+
+    # Nothing is held in the memory of the process.
+    def __len__(self):
+        return 0
+
+    # The offset after the last byte held (0 if empty).
+    def end(self):
+        return self.ends[-1] if self.ends else 0
+
+    # Routine to write buf at offset off.
+    def write(self, off, buf):
+        if not buf:
+            return
+        end = off + len(buf)
+        self.map[off:end] = buf
+        # merge the range with the ones it touches
+        first = bisect_left(self.ends, off)
+        last = bisect_right(self.starts, end)
+        if first < last:
+            off = min(off, self.starts[first])
+            end = max(end, self.ends[last - 1])
+        self.starts[first:last] = [off]
+        self.ends[first:last] = [end]
+
+    # Routine to read size bytes from offset off, as a memoryview of the
+    # mapped file.
+    def read(self, off, size):
+        return memoryview(self.map)[off:off + size]
+
+    # Routine to write the given data only where nothing was written yet.
+    def fill(self, off, data):
+        end = off + len(data)
+        pos = off
+        i = bisect_right(self.ends, off)
+        # collect the gaps first (writing changes the ranges)
+        gaps = []
+        while pos < end:
+            if i < len(self.starts) and self.starts[i] < end:
+                if self.starts[i] > pos:
+                    gaps.append((pos, self.starts[i]))
+                pos = max(pos, self.ends[i])
+                i += 1
+            else:
+                gaps.append((pos, end))
+                pos = end
+        # write them
+        view = memoryview(data)
+        for (lo, hi) in gaps:
+            self.write(lo, view[lo - off:hi - off])
+
+    # Routine to drop the bytes from offset size on (they read as zeros
+    # again): the pages of the dropped ranges are released from the file.
+    def truncate(self, size):
+        # the ranges ending after size: the first one is cut at size (or
+        # dropped if it starts from size on), the others are dropped
+        i = bisect_right(self.ends, size)
+        for (start, end) in zip(self.starts[i:], self.ends[i:]):
+            self._zero(max(start, size), end)
+        if i < len(self.starts) and self.starts[i] < size:
+            self.ends[i] = size
+            i += 1
+        del self.starts[i:]
+        del self.ends[i:]
+
+    # Routine to drop every byte held (the pages are released from the
+    # file).
+    def clear(self):
+        self.truncate(0)
+
+    def _zero(self, lo, hi):
+        # whole pages are released from the file (reading zeros), the rest
+        # is overwritten
+        first = min(-(-lo // mmap.PAGESIZE) * mmap.PAGESIZE, hi)
+        last = max(hi // mmap.PAGESIZE * mmap.PAGESIZE, first)
+        self.map[lo:first] = bytes(first - lo)
+        self.map[last:hi] = bytes(hi - last)
+        if first < last:
+            try:
+                self.map.madvise(mmap.MADV_REMOVE, first, last - first)
+            except (AttributeError, OSError):
+                for off in range(first, last, ZERO_STEP):
+                    end = min(off + ZERO_STEP, last)
+                    self.map[off:end] = bytes(end - off)
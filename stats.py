@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import os
+from bisect import bisect_left
+from collections import defaultdict
+from functools import wraps
+from time import perf_counter
+
+log = logging.getLogger(__name__)
+
+# upper bounds in seconds of the buckets of the latency histograms (from
+# 100 us doubling up to about 52 s, plus the infinite one)
+BUCKETS = tuple(0.0001 * 2 ** k for k in range(20))
+
+
+# A latency histogram: the number of samples in each bucket, their number
+# and their sum.
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+# The performance counters of a mount: latency histograms and counters,
+# both by metric name and label (like 'op="read"'), and gauges whose value
+# is taken when rendered. They are rendered in the Prometheus text format,
+# which is served by the stats file of the mount and can be written to a
+# file periodically (see write_textfile).
+class Stats:
+    def __init__(self):
+        self.histograms = defaultdict(Histogram)
+        self.counters = defaultdict(int)
+        # functions returning the value of each gauge by metric name
+        self.gauges = {}
+
+    # Routine to add a latency sample.
+    def observe(self, name, label, seconds):
+        self.histograms[(name, label)].observe(seconds)
+
+    # Routine to increase a counter.
+    def count(self, name, label='', amount=1):
+        self.counters[(name, label)] += amount
+
+    # Routine to register a gauge.
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def render(self):
+        lines = []
+        for name in sorted({name for (name, _) in self.histograms}):
+            lines.append('# TYPE %s histogram' % name)
+            for ((other, label), histogram) in sorted(self.histograms.items()):
+                if other != name:
+                    continue
+                cumulative = 0
+                for (bound, count) in zip(BUCKETS + ('+Inf',), histogram.buckets):
+                    cumulative += count
+                    lines.append('%s_bucket{%s} %d' % (name, _labels(label, 'le="%s"' % bound), cumulative))
+                lines.append('%s_sum{%s} %.6f' % (name, label, histogram.sum))
+                lines.append('%s_count{%s} %d' % (name, label, histogram.count))
+        for name in sorted({name for (name, _) in self.counters}):
+            lines.append('# TYPE %s counter' % name)
+            for ((other, label), value) in sorted(self.counters.items()):
+                if other == name:
+                    lines.append('%s{%s} %d' % (name, label, value))
+        for (name, function) in sorted(self.gauges.items()):
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %s' % (name, function()))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(*labels):
+    return ','.join(label for label in labels if label)
+
+
+# Decorator recording the latency and the errors of an operation of a file
+# system (a method of a class with a stats attribute).
+def timed(method):
+    label = 'op="%s"' % method.__name__
+
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return await method(self, *args, **kwargs)
+        except Exception:
+            self.stats.count('tgfuse_op_errors_total', label)
+            raise
+        finally:
+            self.stats.observe('tgfuse_op_seconds', label, perf_counter() - start)
+    return wrapper
+
+
+# A lock recording the time waited to acquire it in a histogram.
+class TimedLock(asyncio.Lock):
+    def __init__(self, stats, name):
+        super().__init__()
+        self.stats = stats
+        self.name = name
+
+    async def acquire(self):
+        start = perf_counter()
+        result = await super().acquire()
+        self.stats.observe(self.name, '', perf_counter() - start)
+        return result
+
+
+# Routine to write the stats to a file every interval seconds (for the
+# textfile collector of the Prometheus node exporter). The file is
+# replaced atomically.
+async def write_textfile(stats, path, interval):
+    while True:
+        try:
+            with open(path + '.tmp', 'w') as f:
+                f.write(stats.render())
+            os.replace(path + '.tmp', path)
+        except OSError:
+            log.exception('writing the stats to %s failed', path)
+        await asyncio.sleep(interval)
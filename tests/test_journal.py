@@ -0,0 +1,183 @@
+import asyncio
+import os
+import stat
+import tempfile
+import unittest
+
+import tgfuse
+import serialization
+from mktgfs import make
+from local_backend import LocalBackend
+from deletions import DeletionQueue
+from data_structures import CHUNK_SIZE, SHARD_ENTRIES, DirectoryShard
+from benchmarks.common import make_ctx
+
+
+# Crash tests of the metadata journal: the file system is modified while
+# batches are written, then its tasks are killed without closing it and
+# it is mounted again from the stored messages. Every entry and file that
+# was persisted before the crash must still be readable.
+# Run them from the repository root: python3 -m unittest tests.test_journal
+
+# LocalBackend whose uploads (but the journal batches) take the seconds
+# given by delay (a callable getting the data) once set, so the batches are
+# written while the write backs are running.
+class SlowBackend(LocalBackend):
+    delay = None
+
+    async def _send_data(self, data, caption=None):
+        if self.delay is not None and caption != 'metadata journal':
+            await asyncio.sleep(self.delay(data))
+        return await super()._send_data(data, caption)
+
+
+class JournalCrashTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.ctx = make_ctx()
+        self._run(make(LocalBackend(self.path)))
+
+    def _run(self, coroutine):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    # Routine to mount the file system on a new event loop (batches every
+    # 50 ms, deletions shortly after).
+    def _mount(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        backend = SlowBackend(self.path)
+        backend.deletions = DeletionQueue(backend, linger=0.05)
+        return tgfuse.TgFuseFs(backend, journal_interval=0.05, inline_threshold=0)
+
+    # Routine to kill every task of the mount without closing it.
+    def _crash(self):
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    async def _persist(self, fs):
+        await fs.writeback.drain()
+        await fs.journal.append()
+
+    async def _read(self, fs, parent_inode_n, name):
+        attr = await fs.lookup(parent_inode_n, name, self.ctx)
+        fi = await fs.open(attr.st_ino, os.O_RDONLY, self.ctx)
+        try:
+            return bytes(await fs.read(fi.fh, 0, attr.st_size))
+        finally:
+            await fs.release(fi.fh)
+
+    def test_split_directory(self):
+        fs = self._mount()
+        names = [b'file%05d' % i for i in range(SHARD_ENTRIES - 8)]
+
+        async def write():
+            dir_attr = await fs.mkdir(1, b'dir', stat.S_IFDIR | 0o755, self.ctx)
+            for name in names:
+                await fs.mknod(dir_attr.st_ino, name, stat.S_IFREG | 0o644, 0, self.ctx)
+            await self._persist(fs)
+            # split the directory while the uploads are slow, the batches
+            # are written meanwhile
+            fs.wrapper.delay = lambda data: 1
+            for i in range(20):
+                await fs.mknod(dir_attr.st_ino, b'more%05d' % i, stat.S_IFREG | 0o644, 0, self.ctx)
+            await asyncio.sleep(0.5)
+        self.loop.run_until_complete(write())
+        self._crash()
+        fs = self._mount()
+
+        async def check():
+            dir_attr = await fs.lookup(1, b'dir', self.ctx)
+            for name in names:
+                await fs.lookup(dir_attr.st_ino, name, self.ctx)
+            await fs.close()
+        self.loop.run_until_complete(check())
+        self.loop.close()
+
+    def test_new_directory(self):
+        fs = self._mount()
+
+        async def write():
+            await fs.mkdir(1, b'old', stat.S_IFDIR | 0o755, self.ctx)
+            await self._persist(fs)
+            # only the shard of the new directory is slow
+            fs.wrapper.delay = lambda data: 1 if isinstance(serialization.loads(data), DirectoryShard) else 0
+            await fs.mkdir(1, b'new', stat.S_IFDIR | 0o755, self.ctx)
+            await asyncio.sleep(0.5)
+        self.loop.run_until_complete(write())
+        self._crash()
+        fs = self._mount()
+
+        async def check():
+            dir_attr = await fs.lookup(1, b'new', self.ctx)
+            await fs.lookup(dir_attr.st_ino, b'..', self.ctx)
+            await fs.close()
+        self.loop.run_until_complete(check())
+        self.loop.close()
+
+    def test_rewritten_file(self):
+        fs = self._mount()
+        old = os.urandom(3 * CHUNK_SIZE)
+        new = os.urandom(3 * CHUNK_SIZE)
+
+        async def write():
+            (fi, attr) = await fs.create(1, b'file', stat.S_IFREG | 0o644, 0, self.ctx)
+            await fs.write(fi.fh, 0, old)
+            await fs.release(fi.fh)
+            await self._persist(fs)
+            # the chunks are written one after the other, the batches are
+            # written meanwhile
+            delays = iter([0.1, 0.3, 0.5])
+            fs.wrapper.delay = lambda data: next(delays, 0)
+            fi = await fs.open(attr.st_ino, os.O_RDWR, self.ctx)
+            await fs.write(fi.fh, 0, new)
+            await fs.release(fi.fh)
+            await asyncio.sleep(0.4)
+        self.loop.run_until_complete(write())
+        self._crash()
+        fs = self._mount()
+
+        async def check():
+            # the old contents or the new ones, never a mix
+            self.assertIn(await self._read(fs, 1, b'file'), (old, new))
+            await fs.close()
+        self.loop.run_until_complete(check())
+        self.loop.close()
+
+    def test_overwritten_file(self):
+        fs = self._mount()
+        data = os.urandom(2 * CHUNK_SIZE + 5)
+
+        async def write():
+            (fi, attr) = await fs.create(1, b'file', stat.S_IFREG | 0o644, 0, self.ctx)
+            await fs.write(fi.fh, 0, data)
+            await fs.release(fi.fh)
+            await self._persist(fs)
+            # no batch from now on: the replaced chunk must not be deleted
+            fs.journal.stopping.set()
+            await fs.journal.task
+            fi = await fs.open(attr.st_ino, os.O_RDWR, self.ctx)
+            await fs.write(fi.fh, 10, b'12345')
+            await fs.release(fi.fh)
+            await fs.writeback.drain()
+            await asyncio.sleep(0.5)
+        self.loop.run_until_complete(write())
+        self._crash()
+        fs = self._mount()
+
+        async def check():
+            self.assertEqual(await self._read(fs, 1, b'file'), data)
+            await fs.close()
+        self.loop.run_until_complete(check())
+        self.loop.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,341 @@
+import pyfuse3
+import asyncio
+import errno
+import json
+import os
+import stat
+from argparse import ArgumentParser
+from time import perf_counter
+from data_structures import *
+from wrapper import *
+from local_backend import *
+from transfers import *
+from deletions import *
+from tgfuse import TgFuseFs
+
+# Bulk import of a local directory tree into the file system and export of
+# a tree of the file system to a local directory, without mounting it (the
+# file system must not be mounted meanwhile). The contents are streamed
+# from (or to) the local files a chunk at a time by a pool of concurrent
+# transfers. An import builds the inodes directly, writes each directory
+# once at the end and only links the new tree into the file system with the
+# superblock, after everything is written. The chunks uploaded are recorded
+# in a state file so an interrupted import run again does not upload them
+# again; an interrupted export skips the files already exported.
+
+
+# Counts the files and bytes transferred and reports the throughput.
+class Progress:
+    def __init__(self):
+        self.start = perf_counter()
+        self.files = 0
+        self.bytes = 0
+        self.resumed = 0
+        self.skipped = []
+
+    def report(self, action):
+        elapsed = perf_counter() - self.start
+        print('%s %d files, %.1f MB in %.1f s: %.1f files/s, %.2f MB/s' % (
+            action, self.files, self.bytes / 1E6, elapsed, self.files / elapsed if elapsed else float('inf'),
+            self.bytes / elapsed / 1E6 if elapsed else float('inf')))
+        if self.resumed:
+            print('%d chunks or files were already transferred' % self.resumed)
+        for path in self.skipped:
+            print('skipped %s (not a regular file or directory)' % path)
+
+
+# The chunks uploaded by an import, saved as a line for each one in a file:
+# the relative path, size and mtime of the file and the index and pointer
+# of the chunk. The ones of files modified since are not reused.
+class ImportState:
+    def __init__(self, path):
+        self.path = path
+        # pointers of the chunks by (path, size, mtime) and index
+        self.chunks = {}
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # cut by an interruption
+                        continue
+                    key = (record['path'], record['size'], record['mtime_ns'])
+                    self.chunks.setdefault(key, {})[record['index']] = record['pointer']
+        except FileNotFoundError:
+            pass
+        self.file = open(path, 'a')
+
+    # Method to take the recorded chunks of a file (by index).
+    def take(self, path, st):
+        return self.chunks.pop((path, st.st_size, st.st_mtime_ns), {})
+
+    def add(self, path, st, index, pointer):
+        self.file.write(json.dumps({'path': path, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                                    'index': index, 'pointer': pointer}) + '\n')
+        self.file.flush()
+
+    # Method to get the pointers recorded and not taken (of files modified
+    # or removed since).
+    def unused(self):
+        return [pointer for chunks in self.chunks.values() for pointer in chunks.values() if pointer]
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.path)
+
+
+# Routine to get the inode number of the directory at the given path of
+# the file system.
+async def resolve(fs, path):
+    inode_n = pyfuse3.ROOT_INODE
+    for name in os.fsencode(path).split(b'/'):
+        if name:
+            inode_n = (await fs._lookup(inode_n, name)).st_ino
+    return inode_n
+
+
+def _set_attributes(ino, st):
+    attr = ino.attributes
+    attr.st_mode = st.st_mode
+    attr.st_uid = st.st_uid
+    attr.st_gid = st.st_gid
+    attr.st_atime_ns = st.st_atime_ns
+    attr.st_mtime_ns = st.st_mtime_ns
+    attr.st_ctime_ns = st.st_ctime_ns
+
+
+# Routine to run a job for every item of a list with jobs workers.
+async def _pool(items, jobs, job):
+    queue = list(reversed(items))
+
+    async def worker():
+        while queue:
+            await job(*queue.pop())
+    await asyncio.gather(*[worker() for _ in range(jobs)])
+
+
+# Routine to import the local directory source as a new entry (with the
+# same name) of the directory at path target of the file system.
+async def import_tree(fs, source, target, jobs=8, state_path='tgbulk.state'):
+    progress = Progress()
+    loop = asyncio.get_event_loop()
+    source = os.path.abspath(source)
+    parent_n = await resolve(fs, target)
+    name = os.fsencode(os.path.basename(source))
+    try:
+        await fs._lookup(parent_n, name)
+    except FUSEError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    else:
+        raise FileExistsError(errno.EEXIST, 'already in the file system', os.path.join(target, os.path.basename(source)))
+    state = ImportState(state_path)
+    # create the inodes of the tree, the entries of the directories are
+    # kept to write them at the end
+    directories = []
+    files = []
+    top = await fs._new_inode()
+    pending = [(source, top, parent_n)]
+    while pending:
+        (path, dir_ino, parent_n) = pending.pop()
+        _set_attributes(dir_ino, os.lstat(path))
+        entries = {b'.': dir_ino.attributes.st_ino, b'..': parent_n}
+        directories.append((dir_ino, entries))
+        for entry in os.scandir(path):
+            st = entry.stat(follow_symlinks=False)
+            if not (stat.S_ISDIR(st.st_mode) or stat.S_ISREG(st.st_mode)):
+                progress.skipped.append(entry.path)
+                continue
+            ino = await fs._new_inode()
+            entries[os.fsencode(entry.name)] = ino.attributes.st_ino
+            if stat.S_ISDIR(st.st_mode):
+                pending.append((entry.path, ino, dir_ino.attributes.st_ino))
+            else:
+                _set_attributes(ino, st)
+                ino.attributes.st_size = st.st_size
+                files.append((ino, entry.path, st))
+    # upload the files, each one streamed from disk a chunk at a time with
+    # at most jobs chunks transferred at once
+    transfers = asyncio.Semaphore(jobs)
+
+    async def upload(ino, path, st):
+        relative = os.path.relpath(path, source)
+        if st.st_size <= min(fs.inline_threshold, CHUNK_SIZE):
+            with open(path, 'rb') as f:
+                ino.inline = f.read(st.st_size)
+        else:
+            recorded = state.take(relative, st)
+            ino.chunks = [0] * -(-st.st_size // CHUNK_SIZE)
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                async def upload_chunk(index):
+                    if index in recorded:
+                        ino.chunks[index] = recorded[index]
+                        progress.resumed += 1
+                        return
+                    async with transfers:
+                        data = await loop.run_in_executor(None, os.pread, fd, CHUNK_SIZE, index * CHUNK_SIZE)
+                        # only zeros: kept as a hole. The chunks are messages
+                        # of their own (neither shared through the dedup
+                        # index nor packed), since the ones recorded and
+                        # left unused by an interrupted import are deleted
+                        ino.chunks[index] = 0 if is_hole(data) else await fs.wrapper.write_raw(data, may_pack=False)
+                    state.add(relative, st, index, ino.chunks[index])
+                # every upload ends before the file is closed
+                results = await asyncio.gather(*[upload_chunk(index) for index in range(len(ino.chunks))],
+                                               return_exceptions=True)
+                for result in results:
+                    if isinstance(result, BaseException):
+                        raise result
+            finally:
+                os.close(fd)
+        fs.superblock.mark_dirty(ino.attributes.st_ino)
+        progress.files += 1
+        progress.bytes += st.st_size
+    await _pool(files, jobs, upload)
+    # the chunks of the files modified since the interrupted import
+    for pointer in state.unused():
+        await fs.wrapper.delete_data(pointer)
+    # write the directories once, split in shards like the ones of the
+    # mount (see TgFuseFs._convert_directory)
+    for (dir_ino, entries) in directories:
+        n_shards = 1
+        while len(entries) > n_shards * SHARD_ENTRIES:
+            n_shards *= 2
+        shards = [DirectoryShard() for _ in range(n_shards)]
+        for (entry_name, inode_n) in entries.items():
+            shards[shard_index(name_hash(entry_name), n_shards)].add(entry_name, inode_n)
+        dir_ino.chunks = [0] * n_shards
+        dir_ino.attributes.st_size = len(entries)
+        fs.superblock.mark_dirty(dir_ino.attributes.st_ino)
+        fs._write_shards_later(dir_ino.attributes.st_ino, dict(enumerate(shards)))
+    # link the tree and write the superblock once everything is written
+    await fs.writeback.drain()
+    await fs._update_directory(await resolve(fs, target), [('+', name, top.attributes.st_ino)])
+    await fs.close()
+    state.discard()
+    progress.report('imported')
+
+
+# Routine to export the tree at path source of the file system to the
+# local directory target (as an entry with the same name, the contents of
+# the root are exported to target itself).
+async def export_tree(fs, source, target, jobs=8):
+    progress = Progress()
+    loop = asyncio.get_event_loop()
+    name = os.path.basename(source.rstrip('/'))
+    top = await fs._get_inode(await resolve(fs, source))
+    directories = []
+    files = []
+    pending = [(top, os.path.join(target, name) if name else target)]
+    while pending:
+        (ino, path) = pending.pop()
+        if not ino.is_directory():
+            files.append((ino, path))
+            continue
+        os.makedirs(path, exist_ok=True)
+        directories.append((ino, path))
+        for (entry_name, inode_n) in await _list_directory(fs, ino):
+            if entry_name not in (b'.', b'..'):
+                pending.append((await fs._get_inode(inode_n), os.path.join(path, os.fsdecode(entry_name))))
+    transfers = asyncio.Semaphore(jobs)
+
+    async def download(ino, path):
+        attr = ino.attributes
+        # exported by an interrupted export (the mtime is set last)
+        try:
+            st = os.stat(path)
+            if st.st_size == attr.st_size and st.st_mtime_ns == attr.st_mtime_ns:
+                progress.resumed += 1
+                return
+        except FileNotFoundError:
+            pass
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.S_IMODE(attr.st_mode))
+        try:
+            if ino.inline is not None:
+                os.write(fd, ino.inline)
+            elif ino.chunks is None:
+                # written before chunking
+                os.write(fd, (await fs.wrapper.read_data(ino.data_pointer)).raw_data)
+            else:
+                async def download_chunk(index, pointer):
+                    async with transfers:
+                        data = await fs.wrapper.read_raw(pointer)
+                        await loop.run_in_executor(None, os.pwrite, fd, data, index * CHUNK_SIZE)
+                results = await asyncio.gather(*[download_chunk(index, pointer)
+                                                 for (index, pointer) in enumerate(ino.chunks) if pointer],
+                                               return_exceptions=True)
+                for result in results:
+                    if isinstance(result, BaseException):
+                        raise result
+            # chunks never written are holes
+            os.ftruncate(fd, attr.st_size)
+        finally:
+            os.close(fd)
+        os.utime(path, ns=(attr.st_atime_ns, attr.st_mtime_ns))
+        progress.files += 1
+        progress.bytes += attr.st_size
+    await _pool(files, jobs, download)
+    # the times of the directories once their entries are written
+    for (ino, path) in reversed(directories):
+        os.utime(path, ns=(ino.attributes.st_atime_ns, ino.attributes.st_mtime_ns))
+    progress.report('exported')
+
+
+# Routine to get the entries of a directory as (name, inode number).
+async def _list_directory(fs, dir_ino):
+    # written before sharding
+    if not dir_ino.chunks:
+        return list((await fs.wrapper.read_data(dir_ino.data_pointer)).entries.items())
+    entries = []
+    n_shards = len(dir_ino.chunks)
+    for index in range(n_shards):
+        (_, shard) = await fs._read_shard(dir_ino, shard_start(index, n_shards))
+        entries.extend((name, inode_n) for (_, name, inode_n) in shard.after(0))
+    return entries
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('command', choices=('import', 'export'),
+                        help='import a local directory or export a directory of the file system')
+    parser.add_argument('source', type=str, help='Local directory to import or path to export')
+    parser.add_argument('target', type=str, help='Path of the directory receiving the import or local directory')
+    parser.add_argument('phone_number', type=str, nargs='?', help='Phone number like +XXXXXXXXXXXX')
+    parser.add_argument('--local', type=str, default=None, metavar='DIR',
+                        help='Use a local directory as storage instead of Telegram')
+    parser.add_argument('--jobs', type=int, default=8, metavar='N',
+                        help='Maximum number of concurrent transfers (default: 8)')
+    parser.add_argument('--connections', type=int, default=4, metavar='N',
+                        help='Number of connections to Telegram used for the transfers (default: 4)')
+    parser.add_argument('--inline-threshold', type=int, default=1024, metavar='BYTES',
+                        help='Maximum size of the files and directories kept in their inode (default: 1024)')
+    parser.add_argument('--state', type=str, default='tgbulk.state', metavar='FILE',
+                        help='File recording the progress of an import to resume it (default: tgbulk.state)')
+    options = parser.parse_args()
+    # one of the storages is required
+    if options.phone_number is None and options.local is None:
+        parser.error('a phone number or --local DIR is required')
+    return options
+
+
+def main():
+    options = parse_args()
+    if options.local is not None:
+        w = LocalBackend(options.local)
+    else:
+        w = TgFuseWrapper(options.phone_number, connections=options.connections, flood_sleep_threshold=0)
+    w.transfers = TransferScheduler(options.jobs)
+    w.deletions = DeletionQueue(w)
+    # the imported tree is only written (and linked) on close
+    fs = TgFuseFs(w, upload_workers=options.jobs, inline_threshold=options.inline_threshold, journal_interval=0)
+    loop = asyncio.get_event_loop()
+    if options.command == 'import':
+        loop.run_until_complete(import_tree(fs, options.source, options.target, options.jobs, options.state))
+    else:
+        loop.run_until_complete(export_tree(fs, options.source, options.target, options.jobs))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,60 +3,345 @@ import pyfuse3_asyncio
 import errno
 import asyncio
 import itertools
+import logging
+import os
+import serialization
 
 from argparse import ArgumentParser
 from time import time_ns
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from wrapper import *
+from local_backend import *
 from data_structures import *
+from open_file import *
+from dir_cache import *
+from locks import *
+from writeback import *
+from block_cache import *
+from readahead import *
+from transfers import *
+from stats import *
+from snapshot import *
+from packs import *
+from dedup import *
+from deletions import *
+from metadata_journal import *
 
 pyfuse3_asyncio.enable()
 
+log = logging.getLogger(__name__)
+
+# name of the read-only file in the root directory serving the performance
+# counters of the mount (see Stats), and its inode number (out of the
+# inode table)
+STATS_NAME = b'.tgfuse-stats'
+STATS_INODE = 2 ** 63 - 1
+
 
 # Class that contains all methods to recognize and manage the file system.
-# It inherits from the pyfuse3.Operations class. Is initialized with a
-# phone number associated to a Telegram account.
+# It inherits from the pyfuse3.Operations class. Is initialized with the
+# storage backend holding the file system (usually a TgFuseWrapper).
+# Operations lock only the inodes they use (see InodeLocks), the superblock
+# lock is only held while allocating or freeing inodes. The segments of the
+# inode table are loaded when first used (see _get_inode) and every change
+# to an inode marks its segment as dirty to be written on close. Every
+# operation records its latency in stats, served by the STATS_NAME file.
+# With a snapshot (a SuperblockSnapshot) the file system starts from the
+# superblock saved locally by the last close, without waiting for the
+# storage: it is compared with the pinned one in background and the
+# operations modifying the file system wait for that check. The contents of
+# the open files held in memory are kept within memory_budget bytes by
+# moving the least recently used ones to temporary files in spill_dir (see
+# OpenFile.spill). Files and directories up to inline_threshold bytes are
+# kept in their inode instead of messages. The kernel keeps the entries and
+# attributes for cache_timeout seconds and the pages of the files unchanged
+# since it last opened them; this mount is the only one modifying the file
+# system and the kernel updates its caches for the operations it sends, so
+# they are only invalidated when the superblock is replaced. The changes of
+# the inodes are appended every journal_interval seconds to a
+# MetadataJournal (0 keeps them until close) folded into a new superblock
+# after checkpoint_batches batches.
 class TgFuseFs(pyfuse3.Operations):
-    def __init__(self, number: str, *args, **kwargs):
+    def __init__(self, wrapper: StorageBackend, dir_cache_size=1024, upload_workers=4, readahead=8,
+                 snapshot=None, memory_budget=256 * 1024 * 1024, spill_dir=None, inline_threshold=1024,
+                 cache_timeout=300, journal_interval=5, checkpoint_batches=64, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        # create the wrapper
-        self.wrapper = TgFuseWrapper(number)
-        # synchronously get the superblock
-        self.superblock = asyncio.get_event_loop().run_until_complete(self.wrapper.read_superblock())
+        # save the wrapper and record its calls with the operations
+        self.wrapper = wrapper
+        self.stats = Stats()
+        self.wrapper.stats = self.stats
+        # start from the snapshot of the superblock if there is one and
+        # check it in background, otherwise synchronously get the superblock
+        self.snapshot = snapshot
+        self.verification = None
+        saved = snapshot.load() if snapshot is not None else None
+        if saved is not None:
+            (self.snapshot_id, self.superblock) = saved
+            self.superblock.head = self.snapshot_id
+            self.wrapper.open_stores(self.superblock)
+            self.verification = asyncio.ensure_future(self._verify_snapshot())
+        else:
+            self.superblock = asyncio.get_event_loop().run_until_complete(self.wrapper.read_superblock())
         assert self.superblock is not None
-        # create a mutex lock for the superblock
-        self.sb_lock = asyncio.Lock()
+        # create a mutex lock for the superblock and the inode locks
+        self.sb_lock = TimedLock(self.stats, 'tgfuse_sb_lock_wait_seconds')
+        self.inode_locks = InodeLocks()
+        # renames between directories run one at a time (see rename)
+        self.rename_lock = asyncio.Lock()
         # init a counter
         self.counter = itertools.count()
-        # create open files and dirs dict
+        # segments of the inode table being loaded by index
+        self.loading_segments = {}
+        # create open files and dirs dict (open files in order of use, the
+        # least recently used first)
         self.open_dirs = {}
-        self.open_files = {}
+        self.open_files = OrderedDict()
+        # maximum bytes of the open files held in memory (None for no
+        # limit), the bytes they hold and where their contents are moved
+        # beyond it
+        self.memory_budget = memory_budget
+        self.memory = MemoryUsage()
+        self.spill_dir = spill_dir
+        # inode number and readahead state of the file handles by fh
+        self.file_handles = {}
+        # maximum number of chunks read ahead by a file handle
+        self.readahead = readahead
+        # maximum size in bytes of the contents kept inline
+        self.inline_threshold = inline_threshold
         # create a lookup counter dict defaulting to 0
         self.lookup_counters = defaultdict(int)
-        # create a list deferred removal
-        self.deferred = []
+        # seconds the kernel keeps entries and attributes (0 disables the
+        # kernel caches), the mtime of each file when its pages were cached
+        # by the kernel and the entries given to the kernel before the
+        # snapshot was checked (to invalidate them if it was stale)
+        self.cache_timeout = cache_timeout
+        self.cached_pages = {}
+        self.unverified_entries = []
+        # inodes removed while still looked up, deleted when forgotten
+        self.deferred = set()
+        # create the cache of directory shards
+        self.dir_cache = DirectoryCache(dir_cache_size)
+        # directory shards modified but not written yet by inode number
+        # (as dicts by shard index) and the indexes of the shards modified
+        # since their write started
+        self.dirty_dirs = {}
+        self.changed_shards = {}
+        # journals of the directories by inode number (once loaded)
+        self.journals = {}
+        # messages replaced in the inodes whose stored state is held, by
+        # inode number (see _replaced)
+        self.held_pointers = {}
+        # create the write back queue uploading dirty files and directories
+        self.writeback = WriteBack(upload_workers)
+        # journal of the changes of the inodes (None to write them on
+        # close), started once the superblock is checked
+        self.journal = None
+        if journal_interval > 0:
+            self.journal = MetadataJournal(self.wrapper, self._checkpoint, journal_interval, checkpoint_batches)
+            if self.verification is None:
+                self.journal.start(self.superblock)
+        # attributes of the stats file and its contents by fh (rendered
+        # when opened)
+        self.stats_attr = self._stats_attributes()
+        self.stats_handles = {}
+        self._register_gauges()
+
+    def _stats_attributes(self):
+        attr = EntryAttributes()
+        attr.st_ino = STATS_INODE
+        attr.st_mode = stat.S_IFREG | 0o444
+        attr.st_nlink = 1
+        attr.st_uid = os.getuid()
+        attr.st_gid = os.getgid()
+        attr.st_atime_ns = attr.st_mtime_ns = attr.st_ctime_ns = time_ns()
+        return attr
+
+    def _register_gauges(self):
+        gauges = {
+            'tgfuse_open_files': lambda: len(self.open_files),
+            # bytes of the contents of the open files held in memory
+            'tgfuse_open_file_bytes': lambda: self.memory.bytes,
+            'tgfuse_spilled_files': lambda: sum(1 for of in self.open_files.values() if of.is_spilled()),
+            'tgfuse_deferred_deletions': lambda: len(self.deferred),
+            'tgfuse_writeback_pending': lambda: len(self.writeback),
+            'tgfuse_dirty_directories': lambda: len(self.dirty_dirs),
+            'tgfuse_loaded_segments': lambda: len(self.superblock.segments),
+            'tgfuse_dir_cache_hits': lambda: self.dir_cache.hits,
+            'tgfuse_dir_cache_misses': lambda: self.dir_cache.misses,
+        }
+        if self.wrapper.block_cache is not None:
+            gauges['tgfuse_block_cache_hits'] = lambda: self.wrapper.block_cache.hits
+            gauges['tgfuse_block_cache_misses'] = lambda: self.wrapper.block_cache.misses
+            gauges['tgfuse_block_cache_bytes'] = lambda: self.wrapper.block_cache.used_bytes
+        if self.wrapper.packs is not None:
+            gauges['tgfuse_packed_objects'] = lambda: self.wrapper.packs.packed_objects
+            gauges['tgfuse_packs_written'] = lambda: self.wrapper.packs.packs_written
+            gauges['tgfuse_pack_compactions'] = lambda: self.wrapper.packs.compactions
+            gauges['tgfuse_packs_pending'] = lambda: len(self.wrapper.packs.pending)
+        if self.wrapper.dedup is not None:
+            gauges['tgfuse_dedup_chunks'] = lambda: len(self.wrapper.dedup.hashes)
+            gauges['tgfuse_dedup_ratio'] = lambda: '%.3f' % self.wrapper.dedup.ratio()
+            gauges['tgfuse_dedup_saved_bytes'] = lambda: self.wrapper.dedup.saved_bytes()
+        if self.wrapper.deletions is not None:
+            gauges['tgfuse_deletions_queued'] = lambda: len(self.wrapper.deletions)
+            gauges['tgfuse_deleted_messages'] = lambda: self.wrapper.deletions.deleted
+            gauges['tgfuse_deletion_calls'] = lambda: self.wrapper.deletions.calls
+        if self.journal is not None:
+            gauges['tgfuse_journal_batches'] = lambda: self.journal.batches
+            gauges['tgfuse_journal_length'] = lambda: len(self.superblock.journal)
+            gauges['tgfuse_checkpoints'] = lambda: self.journal.checkpoints
+        if self.wrapper.transfers is not None:
+            gauges['tgfuse_transfers_queued'] = lambda: self.wrapper.transfers.queue_depth()
+            gauges['tgfuse_transfers_in_flight'] = lambda: self.wrapper.transfers.in_flight
+            gauges['tgfuse_transfers_limit'] = lambda: self.wrapper.transfers.limit
+            gauges['tgfuse_transfers_throttled'] = lambda: self.wrapper.transfers.throttled
+        for (name, function) in gauges.items():
+            self.stats.gauge(name, function)
+
+    # Routine to check that the superblock of the snapshot is the pinned
+    # one, otherwise the file system was modified elsewhere after the
+    # snapshot was taken and the pinned one replaces it. It is retried
+    # until the storage answers.
+    async def _verify_snapshot(self):
+        while True:
+            try:
+                pinned_id = await self.wrapper.get_pinned_id()
+                if pinned_id != self.snapshot_id:
+                    log.warning('the superblock snapshot is stale (%s pinned instead of %s), reloading',
+                                pinned_id, self.snapshot_id)
+                    await self._replace_superblock(await self.wrapper.read_superblock())
+                break
+            except Exception:
+                log.exception('checking the superblock snapshot failed, retrying in 5 seconds')
+                await asyncio.sleep(5)
+        # the changes can be journaled from now on
+        if self.journal is not None:
+            self.journal.start(self.superblock)
+
+    # Routine to wait for the check of the snapshot (if not done yet).
+    # Every operation modifying the file system calls it first.
+    async def _wait_verified(self):
+        if self.verification is not None:
+            await asyncio.shield(self.verification)
+            self.verification = None
+            self.unverified_entries.clear()
+
+    # Routine to replace a stale superblock. Nothing was modified yet (see
+    # _wait_verified): the state read from the old one is dropped and the
+    # open files and directories are opened again from the new one.
+    async def _replace_superblock(self, superblock):
+        self.superblock = superblock
+        self.journals.clear()
+        self.dirty_dirs.clear()
+        self.changed_shards.clear()
+        for (fh, dir_inode) in list(self.open_dirs.items()):
+            inode = await self._get_inode(dir_inode.attributes.st_ino)
+            if inode is not None:
+                self.open_dirs[fh] = inode
+        for (inode_n, old_of) in list(self.open_files.items()):
+            inode = await self._get_inode(inode_n)
+            # removed elsewhere: keep reading the old contents
+            if inode is None:
+                continue
+            of = self._open_file(inode)
+            await of.load_legacy()
+            of.count = old_of.count
+            self.open_files[inode_n] = of
+            old_of.close()
+        for (fh, (inode_n, readahead)) in list(self.file_handles.items()):
+            readahead.cancel()
+            self.file_handles[fh] = (inode_n, Readahead(self.open_files[inode_n], self.readahead))
+        # drop what the kernel cached from the old one
+        for (parent_inode_n, name) in self.unverified_entries:
+            self._invalidate(pyfuse3.invalidate_entry, parent_inode_n, name)
+        for (inode_n, count) in self.lookup_counters.items():
+            if count > 0 and inode_n != STATS_INODE:
+                self._invalidate(pyfuse3.invalidate_inode, inode_n)
+        self.cached_pages.clear()
+
+    # Method to record an entry given to the kernel while the snapshot is
+    # not checked, found in the given superblock (invalidated at once if it
+    # was replaced meanwhile).
+    def _entry_given(self, parent_inode_n, name, superblock):
+        if superblock is not self.superblock:
+            self._invalidate(pyfuse3.invalidate_entry, parent_inode_n, name)
+        elif self.verification is not None and not self.verification.done() and self.cache_timeout > 0:
+            self.unverified_entries.append((parent_inode_n, name))
+
+    # Method to invalidate something cached by the kernel with the given
+    # function of pyfuse3. It runs in a thread: it waits for the kernel,
+    # which may be waiting for an operation on the same inode.
+    def _invalidate(self, function, *args):
+        if self.cache_timeout > 0:
+            asyncio.get_event_loop().run_in_executor(None, _notify_kernel, function, *args)
 
+    @timed
     async def getattr(self, inode_n, ctx):
-        # acquire superblock mutex and call internal method
-        async with self.sb_lock:
-            return await self._getattr(inode_n, ctx)
+        if inode_n == STATS_INODE:
+            return self.stats_attr
+        # attributes are never updated across an await: no lock is needed
+        return await self._getattr(inode_n, ctx)
 
     async def _getattr(self, inode_n, ctx=None):
         # try to get the requested inode and if succeeded
-        inode = self.superblock.get_inode_by_number(inode_n)
+        inode = await self._get_inode(inode_n)
         if inode is not None:
             # return the requested attributes
-            return inode.attributes
+            return self._cacheable(inode.attributes)
         # otherwise raise ENOENT
         raise FUSEError(errno.ENOENT)
 
+    # Method to set how long the kernel may keep the given attributes (and
+    # the entry they are returned for).
+    def _cacheable(self, attr):
+        attr.entry_timeout = self.cache_timeout
+        attr.attr_timeout = self.cache_timeout
+        return attr
+
+    # Routine to get an inode by number loading its segment if needed.
+    # It returns None if the inode doesn't exist.
+    async def _get_inode(self, inode_n):
+        index = self.superblock.segment_of(inode_n)
+        if index not in self.superblock.segments:
+            # out of the table
+            if not 0 <= index < len(self.superblock.pointers):
+                return None
+            await self._load_segment(index)
+        return self.superblock.get_inode_by_number(inode_n)
+
+    # Routine to load a segment of the inode table. Concurrent calls for
+    # the same segment share a single download.
+    async def _load_segment(self, index):
+        future = self.loading_segments.get(index, None)
+        if future is None:
+            # the superblock may be replaced meanwhile (see _replace_superblock)
+            superblock = self.superblock
+            future = asyncio.ensure_future(self.wrapper.read_data(superblock.pointers[index]))
+            self.loading_segments[index] = future
+            try:
+                segment = await future
+            finally:
+                if self.loading_segments.get(index, None) is future:
+                    del self.loading_segments[index]
+            superblock.add_segment(segment)
+        else:
+            await future
+
+    @timed
     async def setattr(self, inode_n, new_attr, fields, fh, ctx):
-        # acquire superblock mutex
-        async with self.sb_lock:
+        # the stats file is read-only
+        if inode_n == STATS_INODE:
+            raise FUSEError(errno.EPERM)
+        await self._wait_verified()
+        # acquire the inode lock
+        async with self.inode_locks.write(inode_n):
             # try to get the requested inode
-            inode = self.superblock.get_inode_by_number(inode_n)
+            inode = await self._get_inode(inode_n)
             # get its attributes
             attr = inode.attributes
+            # the size of a regular file is changed through its chunk map
+            if fields.update_size and inode.is_regular_file():
+                await self._truncate(inode_n, inode, new_attr.st_size)
             # update the required fields
             attr.st_atime_ns = new_attr.st_atime_ns if fields.update_atime else attr.st_atime_ns
             attr.st_mtime_ns = new_attr.st_mtime_ns if fields.update_mtime else attr.st_mtime_ns
@@ -65,37 +350,76 @@ class TgFuseFs(pyfuse3.Operations):
             attr.st_uid = new_attr.st_uid if fields.update_uid else attr.st_uid
             attr.st_gid = new_attr.st_gid if fields.update_gid else attr.st_gid
             attr.st_size = new_attr.st_size if fields.update_size else attr.st_size
+            # the kernel truncated the pages it holds itself
+            if fields.update_size and inode_n in self.cached_pages:
+                self.cached_pages[inode_n] = attr.st_mtime_ns
+            self.superblock.mark_dirty(inode_n)
             # return the attributes
-            return attr
+            return self._cacheable(attr)
+
+    # Routine to set the size of a regular file (with its lock held). Its
+    # upload must not run meanwhile: the chunks it drops are written (or
+    # deleted) in background like after a write.
+    async def _truncate(self, inode_n, inode, size):
+        if size > MAX_FILE_SIZE:
+            raise FUSEError(errno.EFBIG)
+        await self.writeback.cancel(('file', inode_n))
+        of = self.open_files.get(inode_n, None)
+        # not open: opened just to truncate it
+        if of is None:
+            of = self._open_file(inode)
+            await of.load_legacy()
+            self.open_files[inode_n] = of
+        await of.truncate(size)
+        if of.is_dirty():
+            self._write_file_later(inode_n)
+        else:
+            # held by a failed upload: nothing is left to write
+            await self._release_inode(inode_n)
+            if of.count == 0:
+                del self.open_files[inode_n]
 
+    @timed
     async def lookup(self, parent_inode_n, name, ctx):
-        # acquire superblock mutex
-        async with self.sb_lock:
+        if self._is_stats_file(parent_inode_n, name):
+            self.lookup_counters[STATS_INODE] += 1
+            return self.stats_attr
+        superblock = self.superblock
+        # acquire the parent directory lock (shared)
+        async with self.inode_locks.read(parent_inode_n):
             # try to lookup (may raise exceptions)
             result = await self._lookup(parent_inode_n, name, ctx)
             # increase the lookup count (if no exceptions occurred)
             self.lookup_counters[result.st_ino] += 1
+            self._entry_given(parent_inode_n, name, superblock)
             return result
 
+    # Method to check if a directory entry is the stats file.
+    @staticmethod
+    def _is_stats_file(parent_inode_n, name):
+        return parent_inode_n == pyfuse3.ROOT_INODE and name == STATS_NAME
+
     async def _lookup(self, parent_inode_n, name, ctx=None):
         # try to get the requested inode
-        parent_inode = self.superblock.get_inode_by_number(parent_inode_n)
-        # get directory data
-        dd = await self.wrapper.read_data(parent_inode.data_pointer)
+        parent_inode = await self._get_inode(parent_inode_n)
+        # get the shard of the directory holding the name
+        (_, shard) = await self._read_shard(parent_inode, name_hash(name))
         # try to get the entry inode number and if succeeded
-        entry_inode_n = dd.entries.get(name, None)
+        entry_inode_n = shard.get(name)
         if entry_inode_n is not None:
             # FOUND: get attr and return
             return await self._getattr(entry_inode_n, ctx)
         # entry not found: raise ENOENT
         raise FUSEError(errno.ENOENT)
 
+    @timed
     async def opendir(self, inode_n, ctx):
-
-        # acquire superblock mutex
-        async with self.sb_lock:
+        if inode_n == STATS_INODE:
+            raise FUSEError(errno.ENOTDIR)
+        # acquire the directory lock (shared)
+        async with self.inode_locks.read(inode_n):
             # try to get the requested inode
-            inode = self.superblock.get_inode_by_number(inode_n)
+            inode = await self._get_inode(inode_n)
             # if completely failed
             if inode is None:
                 # raise ENOENT
@@ -105,80 +429,313 @@ class TgFuseFs(pyfuse3.Operations):
                 # raise ENOTDIR
                 raise FUSEError(errno.ENOTDIR)
             # else, it's a directory, good!
-            # get directory data
-            dd = await self.wrapper.read_data(inode.data_pointer)
             # get next counter value as fh
             fh = next(self.counter)
-            # save current DD status in open dirs (cache) and return the key
-            self.open_dirs[fh] = (inode, dd)
+            # save the inode in open dirs and return the key
+            self.open_dirs[fh] = inode
             return fh
 
+    @timed
     async def readdir(self, fh, start_id, token):
-        # acquire superblock mutex
-        async with self.sb_lock:
-            # get directory data from cache and its inode
-            (dir_inode, dd) = self.open_dirs[fh]
-            # init an index as start id
-            index = start_id
-            # iterate over the entries from the given offset
-            for (name, inode_n) in list(dd.entries.items())[start_id:]:
-                # get attributes for the current inode
-                attr = await self._getattr(inode_n)
+        # get the inode of the directory
+        dir_inode = self.open_dirs[fh]
+        dir_inode_n = dir_inode.attributes.st_ino
+        superblock = self.superblock
+        # the offsets are the cookies of the entries: continue after start_id
+        cookie = start_id
+        while True:
+            # get the entries after the cookie in its shard (under the
+            # directory lock, shared)
+            async with self.inode_locks.read(dir_inode_n):
+                (index, shard) = await self._read_shard(dir_inode, cookie >> 8)
+                entries = shard.after(cookie)
+                n_shards = len(dir_inode.chunks)
+            for (cookie, name, inode_n) in entries:
+                # get attributes for the current inode (skip removed ones)
+                try:
+                    attr = await self._getattr(inode_n)
+                except FUSEError:
+                    continue
                 # reply and if necessary stop the iteration
-                if not readdir_reply(token, name, attr, index + 1):
+                if not readdir_reply(token, name, attr, cookie):
                     break
                 # increase lookup counter only if not '.' nor '..'
                 if name != b'.' and name != b'..':
                     self.lookup_counters[inode_n] += 1
-                index += 1
-            # update atime
-            dir_inode.attributes.st_atime_ns = time_ns()
+                    self._entry_given(dir_inode_n, name, superblock)
+            else:
+                # continue with the next shard if any
+                if index + 1 < n_shards:
+                    cookie = shard_start(index + 1, n_shards) << 8
+                    continue
+            break
+        # update atime
+        dir_inode.attributes.st_atime_ns = time_ns()
+        self.superblock.mark_dirty(dir_inode_n)
 
+    @timed
     async def releasedir(self, fh):
         # remove the cached DD status
         del self.open_dirs[fh]
 
+    # Routine to get the shard of a directory holding the entries with the
+    # given name hash (with the changes of the journal). It returns its
+    # index and the shard.
+    async def _read_shard(self, dir_ino, hash_value):
+        # directories written before sharding are converted first
+        if not dir_ino.chunks:
+            await self._convert_directory(dir_ino)
+        dir_ino_n = dir_ino.attributes.st_ino
+        n_shards = len(dir_ino.chunks)
+        index = shard_index(hash_value, n_shards)
+        # if it differs from the stored one use the modified version
+        shard = self.dirty_dirs.get(dir_ino_n, {}).get(index, None)
+        if shard is not None:
+            return (index, shard)
+        # get the records of the journal for this shard
+        journal = await self._read_journal(dir_ino)
+        records = [record for record in journal.records
+                   if shard_index(record[2] >> 8, n_shards) == index] if journal else []
+        pointer = dir_ino.chunks[index]
+        # with no records it is the stored shard: try to get it from the
+        # cache and if not cached download and cache it
+        if not records:
+            shard = self.dir_cache.get(dir_ino_n, pointer)
+            if shard is None:
+                shard = await self._load_shard(dir_ino, index)
+                self.dir_cache.put(dir_ino_n, pointer, shard)
+            return (index, shard)
+        # otherwise download it and apply the records
+        shard = await self._load_shard(dir_ino, index)
+        # it may have been loaded by a concurrent call
+        dirty = self.dirty_dirs.setdefault(dir_ino_n, {})
+        if index not in dirty:
+            for record in records:
+                shard.apply(*record)
+            dirty[index] = shard
+        return (index, dirty[index])
+
+    # Routine to get a stored shard of a directory (inline when its pointer
+    # is 0, see _write_back_shard).
+    async def _load_shard(self, dir_ino, index):
+        pointer = dir_ino.chunks[index]
+        if not pointer and dir_ino.inline is not None:
+            return serialization.loads(dir_ino.inline)
+        shard = await self.wrapper.read_data(pointer)
+        # the message is missing from the storage
+        if shard is None:
+            raise FUSEError(errno.EIO)
+        return shard
+
+    # Routine to get the journal of a directory, None if it has none.
+    async def _read_journal(self, dir_ino):
+        dir_ino_n = dir_ino.attributes.st_ino
+        journal = self.journals.get(dir_ino_n, None)
+        # if it was written but not loaded yet load it
+        if journal is None and dir_ino.data_pointer:
+            journal = await self.wrapper.read_data(dir_ino.data_pointer)
+            journal = self.journals.setdefault(dir_ino_n, journal)
+        return journal
+
+    # Routine to split the entries of a directory written before sharding
+    # in shards. They are written (and the old message deleted) by the
+    # write back.
+    async def _convert_directory(self, dir_ino):
+        dd = await self.wrapper.read_data(dir_ino.data_pointer)
+        # it may have been converted by a concurrent call
+        if dir_ino.chunks:
+            return
+        n_shards = 1
+        while len(dd) > n_shards * SHARD_ENTRIES:
+            n_shards *= 2
+        shards = [DirectoryShard() for _ in range(n_shards)]
+        for (name, inode_n) in dd.entries.items():
+            shards[shard_index(name_hash(name), n_shards)].add(name, inode_n)
+        # the stored state is the old data until the shards are written
+        self.superblock.hold(dir_ino)
+        dir_ino.chunks = [0] * n_shards
+        # the data pointer is not a journal
+        self.journals[dir_ino.attributes.st_ino] = DirectoryJournal()
+        self.superblock.mark_dirty(dir_ino.attributes.st_ino)
+        self._write_shards_later(dir_ino.attributes.st_ino, dict(enumerate(shards)))
+
     async def _update_directory(self, dir_ino_n, entries):
-        # get directory data
-        dir_ino = self.superblock.get_inode_by_number(dir_ino_n)
-        dir_dd = await self.wrapper.read_data(dir_ino.data_pointer)
+        # get the directory inode (its shards are updated in place)
+        dir_ino = await self._get_inode(dir_ino_n)
         # for each entry
         for (action, name, inode_n) in entries:
+            # get the shard holding the name and the journal
+            (index, shard) = await self._read_shard(dir_ino, name_hash(name))
+            journal = await self._read_journal(dir_ino)
+            if journal is None:
+                journal = self.journals[dir_ino_n] = DirectoryJournal()
+            size = len(shard)
             # if action is an add ('+')
             if action == '+':
                 # add the new entry
-                dir_dd.entries[name] = inode_n
+                cookie = shard.add(name, inode_n)
+                journal.records.append((name, inode_n, cookie))
             # otherwise is a delete
             else:
-                assert dir_dd.entries[name] == inode_n
                 # remove the entry
-                del dir_dd.entries[name]
-        # update parent directory size
-        dir_ino.attributes.st_size = len(dir_dd)
+                (removed, cookie) = shard.remove(name)
+                assert removed == inode_n
+                journal.records.append((name, 0, cookie))
+            # update parent directory size
+            dir_ino.attributes.st_size += len(shard) - size
+            # schedule the write of the change
+            self._write_shards_later(dir_ino_n, {index: shard})
+            # split the shards when too big
+            if len(shard) > SHARD_ENTRIES:
+                await self._split_directory(dir_ino)
         # update ctime and mtime
         now = time_ns()
         dir_ino.attributes.st_ctime_ns = now
         dir_ino.attributes.st_mtime_ns = now
-        # write and save parent directory data
-        dir_ino.data_pointer = await self.wrapper.write_data(dir_dd, old_to_delete=dir_ino.data_pointer)
+        self.superblock.mark_dirty(dir_ino_n)
 
+    # Routine to double the number of shards of a directory: the hashes of
+    # shard i are split between the new shards 2i and 2i+1.
+    async def _split_directory(self, dir_ino):
+        n_shards = len(dir_ino.chunks)
+        new_shards = {}
+        for index in range(n_shards):
+            (_, shard) = await self._read_shard(dir_ino, shard_start(index, n_shards))
+            halves = ([], [])
+            for (name, (inode_n, cookie)) in shard.entries.items():
+                halves[shard_index(cookie >> 8, 2 * n_shards) & 1].append((name, inode_n, cookie))
+            new_shards[2 * index] = DirectoryShard(halves[0])
+            new_shards[2 * index + 1] = DirectoryShard(halves[1])
+        # every shard is rewritten (the new ones are not written yet so the
+        # next write back rewrites them), the old ones are replaced by the
+        # new shards with the same index. The stored state is the old
+        # shards until the new ones are written
+        self.superblock.hold(dir_ino)
+        dir_ino.chunks.extend([0] * n_shards)
+        self._write_shards_later(dir_ino.attributes.st_ino, new_shards)
+
+    def _write_shards_later(self, dir_ino_n, shards):
+        dir_ino = self.superblock.get_inode_by_number(dir_ino_n)
+        # keep them as dirty until written
+        dirty = self.dirty_dirs.setdefault(dir_ino_n, {})
+        changed = self.changed_shards.setdefault(dir_ino_n, set())
+        for (index, shard) in shards.items():
+            # the cached shard no longer matches the stored one
+            self.dir_cache.discard(dir_ino_n, dir_ino.chunks[index])
+            dirty[index] = shard
+            changed.add(index)
+        self.writeback.schedule(('dir', dir_ino_n), lambda: self._write_back_directory(dir_ino_n))
+
+    async def _write_back_directory(self, dir_ino_n):
+        # it may have been removed
+        if dir_ino_n not in self.dirty_dirs:
+            return
+        dir_ino = await self._get_inode(dir_ino_n)
+        journal = self.journals.get(dir_ino_n, None)
+        # rewrite the changed shards if the journal is too long, some shard
+        # was never written (or is inline) or it may be kept inline
+        if ((journal is not None and len(journal) > JOURNAL_RECORDS) or 0 in dir_ino.chunks
+                or self._may_inline(dir_ino)):
+            # the shards are written one by one: the stored state is kept
+            # until all of them are
+            self.superblock.hold(dir_ino)
+            await self._compact_directory(dir_ino)
+        # otherwise write the journal (replacing the old one)
+        elif journal:
+            old_pointer = dir_ino.data_pointer
+            dir_ino.data_pointer = await self.wrapper.write_data(journal)
+            if old_pointer:
+                await self._replaced(dir_ino_n, [old_pointer])
+        # unless split meanwhile every shard is written
+        if all(dir_ino.chunks) or (len(dir_ino.chunks) == 1 and dir_ino.inline is not None):
+            await self._release_inode(dir_ino_n)
+        self.superblock.mark_dirty(dir_ino_n)
+
+    # Routine to write the shards of a directory that differ from the stored
+    # ones, then the journal can start again.
+    async def _compact_directory(self, dir_ino):
+        dir_ino_n = dir_ino.attributes.st_ino
+        # the records written in the shards (the ones added from now on
+        # are kept)
+        journal = self.journals.get(dir_ino_n, None)
+        n_records = len(journal) if journal is not None else 0
+        # load the shards with records that are not loaded yet (with the
+        # records applied, they are dirty)
+        if n_records:
+            n_shards = len(dir_ino.chunks)
+            for index in sorted({shard_index(record[2] >> 8, n_shards) for record in journal.records[:n_records]}):
+                await self._read_shard(dir_ino, shard_start(index, n_shards))
+        # the shards modified during the writes stay dirty
+        changed = self.changed_shards.pop(dir_ino_n, set())
+        dirty = self.dirty_dirs.get(dir_ino_n, {})
+        # write them concurrently
+        try:
+            await asyncio.gather(*[self._write_back_shard(dir_ino, index, shard)
+                                   for (index, shard) in sorted(dirty.items())])
+        except:
+            # write them again when retried
+            self.changed_shards.setdefault(dir_ino_n, set()).update(changed)
+            raise
+        if journal is not None:
+            del journal.records[:n_records]
+        # delete the old journal (or the directory data written before
+        # sharding), the records left are written by the next write back
+        if dir_ino.data_pointer:
+            old_pointer = dir_ino.data_pointer
+            dir_ino.data_pointer = 0
+            await self._replaced(dir_ino_n, [old_pointer])
+
+    # Method to check if the entries of a directory may fit inline (a
+    # single shard with few entries).
+    def _may_inline(self, dir_ino):
+        return len(dir_ino.chunks) == 1 and dir_ino.attributes.st_size <= self.inline_threshold // serialization.SHARD_ENTRY.size
+
+    async def _write_back_shard(self, dir_ino, index, shard):
+        dir_ino_n = dir_ino.attributes.st_ino
+        old_pointer = dir_ino.chunks[index]
+        data = serialization.dumps(shard)
+        # keep the only shard of a small directory inline (pointer 0)
+        if len(dir_ino.chunks) == 1 and len(data) <= self.inline_threshold:
+            dir_ino.inline = data
+            pointer = 0
+        # otherwise write it
+        else:
+            pointer = await self.wrapper.write_raw(data)
+            dir_ino.inline = None
+        # save the pointer, the old message is deleted once the inode is
+        # written
+        dir_ino.chunks[index] = pointer
+        if old_pointer:
+            await self._replaced(dir_ino_n, [old_pointer])
+        # unless modified again in the meantime it is clean now: cache it
+        if index not in self.changed_shards.get(dir_ino_n, ()):
+            dirty = self.dirty_dirs[dir_ino_n]
+            del dirty[index]
+            if not dirty:
+                del self.dirty_dirs[dir_ino_n]
+            self.dir_cache.put(dir_ino_n, pointer, shard)
+
+    @timed
     async def mkdir(self, parent_inode_n, name, mode, ctx):
-        # acquire superblock mutex and call internal method
-        async with self.sb_lock:
+        await self._wait_verified()
+        # acquire the parent directory lock and call internal method
+        async with self.inode_locks.write(parent_inode_n):
             return await self._create(parent_inode_n, name, mode, ctx)
 
+    @timed
     async def mknod(self, parent_inode_n, name, mode, rdev, ctx):
-        # acquire superblock mutex and call internal method
-        async with self.sb_lock:
+        await self._wait_verified()
+        # acquire the parent directory lock and call internal method
+        async with self.inode_locks.write(parent_inode_n):
             # special file are not supported: rdev is ignored
             return await self._create(parent_inode_n, name, mode, ctx)
 
     async def _create(self, parent_inode_n, name, mode, ctx):
+        # the name of the stats file is taken
+        if self._is_stats_file(parent_inode_n, name):
+            raise FUSEError(errno.EEXIST)
         # get a new inode for the new file or directory
-        new_ino = self.superblock.get_new_inode()
-        # if none (no more inodes) raise ENOSPC
-        if new_ino is None:
-            raise FUSEError(errno.ENOSPC)
+        new_ino = await self._new_inode()
         # init metadata
         new_ino.attributes.st_mode = mode
         new_ino.attributes.st_uid = ctx.uid
@@ -187,101 +744,275 @@ class TgFuseFs(pyfuse3.Operations):
         new_ino.attributes.st_atime_ns = now
         new_ino.attributes.st_mtime_ns = now
         new_ino.attributes.st_ctime_ns = now
+        self.superblock.mark_dirty(new_ino.attributes.st_ino)
         # if we are creating a directory
         if new_ino.is_directory():
-            # create DirectoryData with only add '.' and '..'
-            data = DirectoryData(new_ino.attributes.st_ino, parent_inode_n)
+            # create a single shard with only '.' and '..'
+            shard = DirectoryShard()
+            shard.add(b'.', new_ino.attributes.st_ino)
+            shard.add(b'..', parent_inode_n)
+            new_ino.chunks = [0]
+            # kept inline until written, so the inode always points to it
+            new_ino.inline = serialization.dumps(shard)
+            # save the size and schedule the write of the shard
+            new_ino.attributes.st_size = len(shard)
+            self._write_shards_later(new_ino.attributes.st_ino, {0: shard})
         # if we are creating a regular file
-        elif new_ino.is_regular_file():
-            # create empty FileData
-            data = FileData()
-        else:
+        elif not new_ino.is_regular_file():
             # we don't implement this case:
             # free the inode and raise ENOSYS
-            self.superblock.free_inode(new_ino.attributes.st_ino)
+            async with self.sb_lock:
+                self.superblock.free_inode(new_ino.attributes.st_ino)
             raise FUSEError(errno.ENOSYS)
-        # write the file data and save the id as pointer
-        new_ino.data_pointer = await self.wrapper.write_data(data)
-        # save the size
-        new_ino.attributes.st_size = len(data)
+        # a regular file starts empty with no chunks: nothing to write
         # update parent directory
         await self._update_directory(parent_inode_n, [('+', name, new_ino.attributes.st_ino)])
         # increase the lookup counter and return the attributes
         self.lookup_counters[new_ino.attributes.st_ino] += 1
-        return new_ino.attributes
+        return self._cacheable(new_ino.attributes)
 
-    async def open(self, file_inode_n, flags, ctx):
-        # acquire superblock mutex
+    # Routine to allocate an inode (loading a segment with free inodes if
+    # needed).
+    async def _new_inode(self):
         async with self.sb_lock:
-            # try to get the file and open count from local open cache
-            (inode, fd, dirty, count) = self.open_files.get(file_inode_n, (None, None, False, 0))
-            # if failed then populate it
-            if fd is None:
-                # get the inode
-                inode = self.superblock.get_inode_by_number(file_inode_n)
-                # get file data from Telegram
-                fd = await self.wrapper.read_data(inode.data_pointer)
-            # dirty already false and count already 0
-            # update (or create) entry in cache
-            self.open_files[file_inode_n] = (inode, fd, dirty, count + 1)
-            # return the inode number as fh
-            return FileInfo(fh=file_inode_n)
+            new_ino = self.superblock.get_new_inode()
+            # if none the free inodes are in a segment not loaded yet
+            while new_ino is None:
+                await self._load_segment(self.superblock.segment_to_load())
+                new_ino = self.superblock.get_new_inode()
+        return new_ino
 
+    @timed
+    async def create(self, parent_inode_n, name, mode, flags, ctx):
+        await self._wait_verified()
+        # acquire the parent directory lock
+        async with self.inode_locks.write(parent_inode_n):
+            # create the file and open it (acquiring its lock)
+            attr = await self._create(parent_inode_n, name, mode, ctx)
+            async with self.inode_locks.write(attr.st_ino):
+                return (await self._open(attr.st_ino), attr)
+
+    @timed
+    async def open(self, file_inode_n, flags, ctx):
+        if file_inode_n == STATS_INODE:
+            return self._open_stats(flags)
+        # acquire the file lock and call internal method
+        async with self.inode_locks.write(file_inode_n):
+            return await self._open(file_inode_n)
+
+    async def _open(self, file_inode_n):
+        # try to get the file from local open cache
+        of = self.open_files.get(file_inode_n, None)
+        # if failed then populate it
+        if of is None:
+            # get the inode and create the open file (no chunk is loaded yet)
+            of = self._open_file(await self._get_inode(file_inode_n))
+            # files created before chunking are loaded completely
+            await of.load_legacy()
+            self.open_files[file_inode_n] = of
+        # increase the open count
+        of.count += 1
+        # get next counter value as fh, each one reads ahead on its own
+        fh = next(self.counter)
+        self.file_handles[fh] = (file_inode_n, Readahead(of, self.readahead))
+        # the kernel keeps the pages it has if the file didn't change
+        # since it cached them
+        mtime = of.inode.attributes.st_mtime_ns
+        keep_cache = self.cache_timeout > 0 and self.cached_pages.get(file_inode_n, None) == mtime
+        self.cached_pages[file_inode_n] = mtime
+        return FileInfo(fh=fh, keep_cache=keep_cache)
+
+    # Method to open the stats file (only for reading). Its contents are
+    # rendered now and served directly (the size in its attributes is 0).
+    def _open_stats(self, flags):
+        if flags & os.O_ACCMODE != os.O_RDONLY:
+            raise FUSEError(errno.EACCES)
+        fh = next(self.counter)
+        self.stats_handles[fh] = self.stats.render().encode()
+        return FileInfo(fh=fh, direct_io=True)
+
+    @timed
     async def read(self, fh, off, size):
-        # acquire superblock mutex
-        async with self.sb_lock:
-            # get inode and fd from the cache
-            (inode, fd, _, _) = self.open_files[fh]
+        if fh in self.stats_handles:
+            return self.stats_handles[fh][off:off + size]
+        (inode_n, readahead) = self.file_handles[fh]
+        # acquire the file lock (shared)
+        async with self.inode_locks.read(inode_n):
+            # get the open file from the cache
+            of = self.open_files[inode_n]
+            # prefetch the next chunks if reading sequentially
+            readahead.access(off, size)
             # update atime and return the requested data
-            inode.attributes.st_atime_ns = time_ns()
-            return fd.raw_data[off:off + size]
+            of.inode.attributes.st_atime_ns = time_ns()
+            self.superblock.mark_dirty(inode_n)
+            data = await of.read(off, size)
+            self._used(inode_n)
+            return data
 
+    @timed
     async def write(self, fh, off, buf):
-        # acquire superblock mutex
-        async with self.sb_lock:
-            # get inode and fd from the cache
-            (inode, fd, _, count) = self.open_files[fh]
+        await self._wait_verified()
+        (inode_n, _) = self.file_handles[fh]
+        # acquire the file lock
+        async with self.inode_locks.write(inode_n):
+            # get the open file from the cache
+            of = self.open_files[inode_n]
             # if the resulting file would be too big raise EFBIG
-            if max(off + len(buf), len(fd)) > 1.5E9:
+            if off + len(buf) > MAX_FILE_SIZE:
                 raise FUSEError(errno.EFBIG)
-            # write to cache, set as dirty and update size
-            fd.raw_data = fd.raw_data[:off] + buf + fd.raw_data[off + len(buf):]
-            self.open_files[fh] = (inode, fd, True, count)
-            inode.attributes.st_size = len(fd)
+            # write to the affected chunks (this updates the size)
+            await of.write(off, buf)
+            self._used(inode_n)
             # update timestamps and return the amount of data written
             now = time_ns()
-            inode.attributes.st_ctime_ns = now
-            inode.attributes.st_mtime_ns = now
+            of.inode.attributes.st_ctime_ns = now
+            of.inode.attributes.st_mtime_ns = now
+            # the pages of the kernel hold the write
+            if inode_n in self.cached_pages:
+                self.cached_pages[inode_n] = now
+            self.superblock.mark_dirty(inode_n)
             return len(buf)
 
+    # Method to mark an open file as the most recently used and keep the
+    # memory of the open files within the budget: the least recently used
+    # ones are spilled first.
+    def _used(self, inode_n):
+        self.open_files.move_to_end(inode_n)
+        if self.memory_budget is None:
+            return
+        for of in list(self.open_files.values()):
+            if self.memory.bytes <= self.memory_budget:
+                break
+            if len(of.buffer):
+                of.spill(self.spill_dir)
+                self.stats.count('tgfuse_spills_total')
+
+    @timed
     async def release(self, fh):
-        # acquire superblock mutex
-        async with self.sb_lock:
-            # get inode and fd from the cache
-            (inode, fd, dirty, count) = self.open_files[fh]
-            # if is the last "open"
-            if count == 1:
-                # if the cache is dirty (invalid remote data)
-                if dirty:
-                    # write (replace) data and save pointer
-                    inode.data_pointer = await self.wrapper.write_data(fd, old_to_delete=inode.data_pointer)
+        if self.stats_handles.pop(fh, None) is not None:
+            return
+        # forget the handle and stop its prefetches
+        (inode_n, readahead) = self.file_handles.pop(fh)
+        readahead.cancel()
+        # acquire the file lock
+        async with self.inode_locks.write(inode_n):
+            # get the open file from the cache and reduce the counter
+            of = self.open_files[inode_n]
+            of.count -= 1
+            # if it was the last "open"
+            if of.count == 0:
+                # if the cache is dirty (invalid remote data) or being written
+                if of.is_dirty() or self.writeback.is_busy(('file', inode_n)):
+                    # write the modified chunks in background, then
+                    # it is deleted from cache
+                    self._write_file_later(inode_n)
+                else:
                     # delete from cache
-                del self.open_files[fh]
-                # otherwise just reduce the counter
-            else:
-                self.open_files[fh] = (inode, fd, dirty, count - 1)
+                    self._drop_open_file(inode_n)
+
+    @timed
+    async def flush(self, fh):
+        if fh in self.stats_handles:
+            return
+        (inode_n, _) = self.file_handles[fh]
+        # start writing the modified chunks (without waiting)
+        if self.open_files[inode_n].is_dirty():
+            self._write_file_later(inode_n)
 
+    @timed
+    async def fsync(self, fh, datasync):
+        if fh in self.stats_handles:
+            return
+        (inode_n, _) = self.file_handles[fh]
+        # write the modified chunks and wait for them (and their packs)
+        if self.open_files[inode_n].is_dirty():
+            self._write_file_later(inode_n)
+        await self.writeback.wait(('file', inode_n))
+        await self._sync_metadata()
+
+    @timed
+    async def fsyncdir(self, fh, datasync):
+        # wait for the directory data to be written
+        dir_inode = self.open_dirs[fh]
+        await self.writeback.wait(('dir', dir_inode.attributes.st_ino))
+        await self._sync_metadata()
+
+    # Routine to make the changes written so far persistent: they are
+    # appended to the metadata journal (when used), which uploads the
+    # packs too.
+    async def _sync_metadata(self):
+        if self.journal is not None:
+            await self._wait_verified()
+            await self.journal.append()
+        elif self.wrapper.packs is not None:
+            await self.wrapper.packs.flush()
+
+    # Routine to create the state of an open file.
+    def _open_file(self, inode):
+        inode_n = inode.attributes.st_ino
+        return OpenFile(inode, self.wrapper, self.inline_threshold, lambda pointers: self._replaced(inode_n, pointers),
+                        self.memory)
+
+    # Routine to drop an open file from the cache, releasing its memory.
+    def _drop_open_file(self, inode_n):
+        of = self.open_files.pop(inode_n, None)
+        if of is not None:
+            of.close()
+
+    # Routine to delete the messages an inode no longer points to. They are
+    # deleted once the inode is written, so it is marked as changed first,
+    # or kept until it is released while its stored state is held (see
+    # Superblock.hold).
+    async def _replaced(self, inode_n, pointers):
+        if self.superblock.is_held(inode_n):
+            self.held_pointers.setdefault(inode_n, []).extend(pointers)
+            return
+        self.superblock.mark_dirty(inode_n)
+        for pointer in pointers:
+            await self.wrapper.delete_data(pointer)
+
+    # Routine to release an inode held once everything it points to is
+    # written, deleting the messages it replaced meanwhile.
+    async def _release_inode(self, inode_n):
+        self.superblock.release(inode_n)
+        await self._replaced(inode_n, self.held_pointers.pop(inode_n, []))
+
+    def _write_file_later(self, inode_n):
+        self.writeback.schedule(('file', inode_n), lambda: self._write_back_file(inode_n))
+
+    async def _write_back_file(self, inode_n):
+        # get the open file (it may have been removed)
+        of = self.open_files.get(inode_n, None)
+        if of is None:
+            return
+        # write only the modified chunks, the chunk map is partly updated
+        # until all of them are
+        if of.is_dirty():
+            self.superblock.hold(of.inode)
+            await of.flush()
+            await self._release_inode(inode_n)
+        # if closed, clean and not scheduled again delete it from cache
+        if of.count == 0 and not of.is_dirty() and not self.writeback.is_pending(('file', inode_n)):
+            self._drop_open_file(inode_n)
+
+    @timed
     async def rmdir(self, parent_inode_n, name, ctx):
-        # acquire superblock mutex
-        async with self.sb_lock:
+        await self._wait_verified()
+        # acquire the parent directory lock
+        async with self.inode_locks.write(parent_inode_n):
             await self._remove(parent_inode_n, name, ctx, is_dir=True)
 
+    @timed
     async def unlink(self, parent_inode_n, name, ctx):
-        # acquire superblock mutex
-        async with self.sb_lock:
+        await self._wait_verified()
+        # acquire the parent directory lock
+        async with self.inode_locks.write(parent_inode_n):
             await self._remove(parent_inode_n, name, ctx)
 
     async def _remove(self, parent_inode_n, name, ctx, is_dir=False):
+        # the stats file can't be removed
+        if self._is_stats_file(parent_inode_n, name):
+            raise FUSEError(errno.EPERM)
         # try to lookup (may raise ENOENT)
         attr = await self._lookup(parent_inode_n, name, ctx)
         # if we are removing a directory
@@ -292,33 +1023,165 @@ class TgFuseFs(pyfuse3.Operations):
             # else if is not empty (only . and ..) raise ENOTEMPTY
             elif attr.st_size > 2:
                 raise FUSEError(errno.ENOTEMPTY)
-        # if the lookup count is zero
-        if self.lookup_counters[attr.st_ino] == 0:
-            # get the inode
-            inode = self.superblock.get_inode_by_number(attr.st_ino)
-            # remove the file data and free its inode
-            await self.wrapper.delete_data(inode.data_pointer)
-            self.superblock.free_inode(attr.st_ino)
-        else:
-            # defer deletion
-            self.deferred.append(attr.st_ino)
+        await self._drop_inode(attr.st_ino)
         # update the parent directory
         await self._update_directory(parent_inode_n, [('-', name, attr.st_ino)])
 
-    async def forget(self, inode_list):
-        # acquire superblock mutex
+    # Routine to delete an inode no longer in any directory, or to defer
+    # its deletion until the kernel forgets it. The lock of its parent
+    # directory must be held.
+    async def _drop_inode(self, inode_n):
+        # acquire the entry lock (parent before child)
+        async with self.inode_locks.write(inode_n):
+            # if the lookup count is zero
+            if self.lookup_counters[inode_n] == 0:
+                # remove the file data and free its inode
+                await self._delete_inode(inode_n)
+            else:
+                # defer deletion
+                self.deferred.add(inode_n)
+
+    # Renames only move directory entries: the contents are not copied.
+    # Within a directory its lock is taken, between directories the global
+    # rename_lock is taken first (only renames move directories, so the
+    # tree doesn't change meanwhile) and then the locks of both, the
+    # ancestor first when one contains the other.
+    @timed
+    async def rename(self, parent_inode_n_old, name_old, parent_inode_n_new, name_new, flags, ctx):
+        if self._is_stats_file(parent_inode_n_old, name_old) or self._is_stats_file(parent_inode_n_new, name_new):
+            raise FUSEError(errno.EPERM)
+        # exchanging entries is not supported
+        if flags & ~pyfuse3.RENAME_NOREPLACE:
+            raise FUSEError(errno.EINVAL)
+        await self._wait_verified()
+        if parent_inode_n_old == parent_inode_n_new:
+            async with self.inode_locks.write(parent_inode_n_old):
+                await self._rename(parent_inode_n_old, name_old, parent_inode_n_new, name_new, flags, ctx)
+            return
+        async with self.rename_lock:
+            if await self._is_ancestor(parent_inode_n_new, parent_inode_n_old):
+                locks = (parent_inode_n_new, parent_inode_n_old)
+            else:
+                locks = (parent_inode_n_old, parent_inode_n_new)
+            async with self.inode_locks.write(locks[0]):
+                async with self.inode_locks.write(locks[1]):
+                    await self._rename(parent_inode_n_old, name_old, parent_inode_n_new, name_new, flags, ctx)
+
+    async def _rename(self, parent_inode_n_old, name_old, parent_inode_n_new, name_new, flags, ctx):
+        # the entry to move (may raise ENOENT) and the one it replaces
+        attr = await self._lookup(parent_inode_n_old, name_old, ctx)
+        try:
+            target = await self._lookup(parent_inode_n_new, name_new, ctx)
+        except FUSEError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            target = None
+        is_dir = stat.S_ISDIR(attr.st_mode)
+        moved = parent_inode_n_old != parent_inode_n_new
+        if target is not None:
+            # both names are the same file: nothing to do
+            if target.st_ino == attr.st_ino:
+                return
+            if flags & pyfuse3.RENAME_NOREPLACE:
+                raise FUSEError(errno.EEXIST)
+            # a directory only replaces an empty directory
+            if is_dir and not stat.S_ISDIR(target.st_mode):
+                raise FUSEError(errno.ENOTDIR)
+            if not is_dir and stat.S_ISDIR(target.st_mode):
+                raise FUSEError(errno.EISDIR)
+            if stat.S_ISDIR(target.st_mode) and target.st_size > 2:
+                raise FUSEError(errno.ENOTEMPTY)
+        # a directory can't be moved inside itself
+        if is_dir and moved and await self._is_ancestor(attr.st_ino, parent_inode_n_new):
+            raise FUSEError(errno.EINVAL)
+        # the replaced entry is removed like by unlink or rmdir
+        entries = []
+        if target is not None:
+            await self._drop_inode(target.st_ino)
+            entries.append(('-', name_new, target.st_ino))
+        # update the directories, once when it is the same
+        if moved:
+            await self._update_directory(parent_inode_n_old, [('-', name_old, attr.st_ino)])
+            await self._update_directory(parent_inode_n_new, entries + [('+', name_new, attr.st_ino)])
+        else:
+            await self._update_directory(parent_inode_n_old, entries + [('-', name_old, attr.st_ino),
+                                                                        ('+', name_new, attr.st_ino)])
+        async with self.inode_locks.write(attr.st_ino):
+            # a moved directory points to its new parent
+            if is_dir and moved:
+                await self._update_directory(attr.st_ino, [('-', b'..', parent_inode_n_old),
+                                                           ('+', b'..', parent_inode_n_new)])
+            attr.st_ctime_ns = time_ns()
+            self.superblock.mark_dirty(attr.st_ino)
+
+    # Routine to check if a directory is the given one or contains it,
+    # following the '..' entries up to the root.
+    async def _is_ancestor(self, ancestor_inode_n, inode_n):
+        while inode_n != ancestor_inode_n:
+            if inode_n == pyfuse3.ROOT_INODE:
+                return False
+            inode_n = (await self._lookup(inode_n, b'..')).st_ino
+        return True
+
+    async def _delete_inode(self, inode_n):
+        # drop its pending writes (waiting for the running ones)
+        await self.writeback.cancel(('file', inode_n))
+        await self.writeback.cancel(('dir', inode_n))
+        self._drop_open_file(inode_n)
+        self.dirty_dirs.pop(inode_n, None)
+        self.changed_shards.pop(inode_n, None)
+        self.journals.pop(inode_n, None)
+        # get the inode
+        inode = await self._get_inode(inode_n)
+        # free it first so it disappears at once
         async with self.sb_lock:
-            # iterate over the list
-            for (inode_n, amount) in inode_list:
-                # decrease the counter by the given amount
-                self.lookup_counters[inode_n] -= amount
-                # if the lookup count is 0 and the removal is deferred
-                if self.lookup_counters[inode_n] == 0 and inode_n in self.deferred:
+            self.superblock.free_inode(inode_n)
+        # delete the chunks of a regular file (or the shards of a directory)
+        self.dir_cache.discard(inode_n, 0)
+        if inode.chunks:
+            for pointer in inode.chunks:
+                if pointer:
+                    self.dir_cache.discard(inode_n, pointer)
+                    await self.wrapper.delete_data(pointer)
+        # delete the data stored before chunking (or the journal)
+        if inode.data_pointer:
+            self.dir_cache.discard(inode_n, inode.data_pointer)
+            await self.wrapper.delete_data(inode.data_pointer)
+        # and the ones replaced while its stored state was held
+        for pointer in self.held_pointers.pop(inode_n, []):
+            await self.wrapper.delete_data(pointer)
+
+    @timed
+    async def forget(self, inode_list):
+        # iterate over the list
+        for (inode_n, amount) in inode_list:
+            # decrease the counter by the given amount
+            self.lookup_counters[inode_n] -= amount
+            # the kernel dropped the inode and its pages
+            if self.lookup_counters[inode_n] == 0:
+                self.cached_pages.pop(inode_n, None)
+            # if the lookup count is 0 and the removal is deferred
+            if self.lookup_counters[inode_n] == 0 and inode_n in self.deferred:
+                # remove it from the deferred set
+                self.deferred.discard(inode_n)
+                # acquire the inode lock
+                async with self.inode_locks.write(inode_n):
                     # remove the file data and free its inode
-                    await self.wrapper.delete_data(self.superblock.get_inode_by_number(inode_n).data_pointer)
-                    self.superblock.free_inode(inode_n)
-                    # remove it from the deferred list
-                    self.deferred.remove(inode_n)
+                    await self._delete_inode(inode_n)
+
+    # Routine to write the superblock with every change so far (the
+    # segments with inodes replayed from the journal are loaded to write
+    # them), replacing the journal. It returns its message id.
+    async def _checkpoint(self):
+        for index in list(self.superblock.replayed):
+            await self._load_segment(index)
+        changed = self.superblock.changed
+        self.superblock.changed = set()
+        try:
+            return await self.wrapper.write_superblock(self.superblock, True)
+        except:
+            self.superblock.changed |= changed
+            raise
 
     async def close(self):
         # we assume this is called only when not running the fs
@@ -327,15 +1190,66 @@ class TgFuseFs(pyfuse3.Operations):
         await self.forget(
             [(inode_n, self.lookup_counters[inode_n]) for inode_n in self.deferred]
         )
-        # write the superblock
-        await self.wrapper.write_superblock(self.superblock, True)
+        # stop reading ahead
+        for (_, readahead) in self.file_handles.values():
+            readahead.cancel()
+        # wait for the pending writes and stop the write back workers
+        await self.writeback.drain()
+        await self.writeback.close()
+        # write the changes left (the snapshot must be checked first): as
+        # the last batch of the journal, or in the superblock when it is
+        # saved for the next mount
+        await self._wait_verified()
+        if self.journal is not None:
+            message_id = await self.journal.close(checkpoint=self.snapshot is not None)
+        else:
+            message_id = await self._checkpoint()
+        if self.snapshot is not None:
+            self.snapshot.save(message_id, self.superblock)
+        # delete the obsolete messages (the ones left are in the superblock)
+        if self.wrapper.deletions is not None:
+            await self.wrapper.deletions.close()
+
+
+# Routine to invalidate something cached by the kernel, which may have
+# dropped it already.
+def _notify_kernel(function, *args):
+    try:
+        function(*args)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            log.warning('invalidating the kernel cache failed: %s', e)
 
 
 def main():
     # parse arguments from command line
     options = parse_args()
-    # instance a TgFuseFs with the given number
-    tgfusefs = TgFuseFs(options.phone_number)
+    # instance a TgFuseFs with a local directory or the given number
+    if options.local is not None:
+        wrapper = LocalBackend(options.local)
+    else:
+        # FloodWaits are handled by the transfer scheduler, with a snapshot
+        # the connection is established by the first transfer
+        wrapper = TgFuseWrapper(options.phone_number, connections=options.connections, flood_sleep_threshold=0,
+                                lazy=options.snapshot is not None)
+    # schedule the transfers to the storage and delete in background
+    wrapper.transfers = TransferScheduler(options.transfers)
+    wrapper.deletions = DeletionQueue(wrapper)
+    # group the small objects in packs
+    wrapper.packs = PackStore(wrapper, max_object=options.pack_threshold * 1024)
+    # store the chunks by content if requested
+    if options.dedup:
+        wrapper.dedup = DedupStore(wrapper)
+    # use a persistent cache of the downloaded data if requested
+    if options.cache_dir is not None:
+        wrapper.block_cache = BlockCache(options.cache_dir, options.cache_size * 1024 * 1024)
+    # mount from the local snapshot of the superblock if requested
+    snapshot = SuperblockSnapshot(options.snapshot) if options.snapshot is not None else None
+    tgfusefs = TgFuseFs(wrapper, dir_cache_size=options.dir_cache_size, upload_workers=options.upload_workers,
+                        readahead=options.readahead, snapshot=snapshot,
+                        memory_budget=options.memory_budget * 1024 * 1024, spill_dir=options.spill_dir,
+                        inline_threshold=options.inline_threshold, cache_timeout=options.cache_timeout,
+                        journal_interval=options.journal_interval, checkpoint_batches=options.checkpoint_batches)
     # add fuse options including debug if necessary
     fuse_options = set(pyfuse3.default_options)
     fuse_options.add('fsname=tgfuse')
@@ -344,6 +1258,10 @@ def main():
     # init pyfuse3 with our filesystem implementation and options
     pyfuse3.init(tgfusefs, options.mountpoint, fuse_options)
     loop = asyncio.get_event_loop()
+    # write the stats periodically if requested
+    stats_writer = None
+    if options.stats_file is not None:
+        stats_writer = asyncio.ensure_future(write_textfile(tgfusefs.stats, options.stats_file, options.stats_interval))
     try:
         # run pyfuse3.main and then tgfusefs.close
         loop.run_until_complete(pyfuse3.main())
@@ -352,6 +1270,8 @@ def main():
         pyfuse3.close(unmount=True)
         raise
     finally:
+        if stats_writer is not None:
+            stats_writer.cancel()
         loop.close()
     # close pyfuse3 normally
     pyfuse3.close()
@@ -360,9 +1280,51 @@ def main():
 def parse_args():
     parser = ArgumentParser()
     parser.add_argument('mountpoint', type=str, help='Where to mount the file system')
-    parser.add_argument('phone_number', type=str, help='Phone number like +XXXXXXXXXXXX')
+    parser.add_argument('phone_number', type=str, nargs='?', help='Phone number like +XXXXXXXXXXXX')
+    parser.add_argument('--local', type=str, default=None, metavar='DIR',
+                        help='Use a local directory as storage instead of Telegram')
+    parser.add_argument('--dir-cache-size', type=int, default=1024, metavar='N',
+                        help='Maximum number of directory shards kept in memory (default: 1024)')
+    parser.add_argument('--upload-workers', type=int, default=4, metavar='N',
+                        help='Maximum number of concurrent background uploads (default: 4)')
+    parser.add_argument('--connections', type=int, default=4, metavar='N',
+                        help='Number of connections to Telegram used for the transfers (default: 4)')
+    parser.add_argument('--transfers', type=int, default=8, metavar='N',
+                        help='Maximum number of concurrent transfers (default: 8)')
+    parser.add_argument('--readahead', type=int, default=8, metavar='N',
+                        help='Maximum number of chunks prefetched by sequential reads, 0 to disable (default: 8)')
+    parser.add_argument('--inline-threshold', type=int, default=1024, metavar='BYTES',
+                        help='Maximum size of the files and directories kept in their inode, 0 to disable (default: 1024)')
+    parser.add_argument('--pack-threshold', type=int, default=64, metavar='KB',
+                        help='Maximum size in KiB of the objects grouped in packs, 0 to disable (default: 64)')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Store identical chunks of the files once')
+    parser.add_argument('--memory-budget', type=int, default=256, metavar='MB',
+                        help='Maximum memory in MiB used by the contents of the open files (default: 256)')
+    parser.add_argument('--spill-dir', type=str, default=None, metavar='DIR',
+                        help='Directory of the temporary files holding the open files beyond the memory budget')
+    parser.add_argument('--cache-timeout', type=float, default=300, metavar='SECONDS',
+                        help='Seconds the kernel keeps entries and attributes, 0 to disable its caches (default: 300)')
+    parser.add_argument('--cache-dir', type=str, default=None, metavar='DIR',
+                        help='Keep downloaded data in DIR across mounts')
+    parser.add_argument('--cache-size', type=int, default=1024, metavar='MB',
+                        help='Maximum size of the cache directory in MiB (default: 1024)')
+    parser.add_argument('--snapshot', type=str, default=None, metavar='FILE',
+                        help='Mount from the superblock saved in FILE by the last unmount (checked in background)')
+    parser.add_argument('--journal-interval', type=float, default=5, metavar='SECONDS',
+                        help='Seconds between the writes of the metadata journal, 0 to write it on unmount (default: 5)')
+    parser.add_argument('--checkpoint-batches', type=int, default=64, metavar='N',
+                        help='Batches of the metadata journal folded into a new superblock (default: 64)')
+    parser.add_argument('--stats-file', type=str, default=None, metavar='FILE',
+                        help='Write the stats of the mount to FILE in the Prometheus text format periodically')
+    parser.add_argument('--stats-interval', type=float, default=15, metavar='SECONDS',
+                        help='Seconds between writes of the stats file (default: 15)')
     parser.add_argument('--debug-fuse', action='store_true', default=False, help='Enable FUSE debugging output')
-    return parser.parse_args()
+    options = parser.parse_args()
+    # one of the storages is required
+    if options.phone_number is None and options.local is None:
+        parser.error('a phone number or --local DIR is required')
+    return options
 
 
 if __name__ == '__main__':
@@ -0,0 +1,112 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+from time import monotonic
+from backend import ThrottledError
+
+# priorities of the transfers, lower first: reads the user is waiting for
+# go before the uploads of the write back
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# priority of the transfers started by the current task (the write back
+# workers set it to BACKGROUND)
+transfer_priority = contextvars.ContextVar('transfer_priority', default=INTERACTIVE)
+
+
+# Schedules the calls to the remote service of a storage backend: up to
+# limit of them run at once and the rest wait, the highest priority first
+# (in arrival order for the same priority). When the service throttles a
+# call (ThrottledError) every call waits the requested time, the call is
+# retried and the limit is halved, growing again by one after as many
+# calls succeed (additive increase, multiplicative decrease) up to
+# max_transfers. So throttling slows the file system down instead of
+# failing its operations.
+class TransferScheduler:
+    def __init__(self, max_transfers=8):
+        # maximum and current number of concurrent calls
+        self.max_transfers = max_transfers
+        self.limit = max_transfers
+        # number of calls running
+        self.in_flight = 0
+        # waiting calls as (priority, arrival, future)
+        self.waiting = []
+        self.arrivals = itertools.count()
+        # no call starts before this time (after being throttled)
+        self.resume_at = 0.0
+        # calls succeeded since the limit last changed
+        self.successes = 0
+        # counters
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+
+    # Number of calls waiting to run.
+    def queue_depth(self):
+        return sum(1 for (_, _, future) in self.waiting if not future.cancelled())
+
+    # Routine to run the given raw routine of a backend with its arguments
+    # as a scheduled call. It returns the result of the routine.
+    async def run(self, routine, *args):
+        priority = transfer_priority.get()
+        while True:
+            await self._acquire(priority)
+            try:
+                # wait while throttled
+                delay = self.resume_at - monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                try:
+                    result = await routine(*args)
+                except ThrottledError as e:
+                    self._on_throttled(e.seconds)
+                    continue
+            finally:
+                self._release()
+            self._on_success()
+            return result
+
+    async def _acquire(self, priority):
+        # run at once if there is room and nobody is waiting
+        if self.in_flight < self.limit and not self.waiting:
+            self.in_flight += 1
+            return
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.arrivals), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # cancelled after getting the slot: give it to the next one
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    # Routine to let the waiting calls run while there is room.
+    def _wake(self):
+        while self.waiting and self.in_flight < self.limit:
+            (_, _, future) = heapq.heappop(self.waiting)
+            # the caller was cancelled
+            if future.cancelled():
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+    def _on_throttled(self, seconds):
+        self.throttled += 1
+        self.throttled_seconds += seconds
+        self.resume_at = max(self.resume_at, monotonic() + seconds)
+        self.limit = max(1, self.limit // 2)
+        self.successes = 0
+
+    def _on_success(self):
+        if self.limit >= self.max_transfers:
+            return
+        self.successes += 1
+        if self.successes >= self.limit:
+            self.limit += 1
+            self.successes = 0
+            self._wake()
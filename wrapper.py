@@ -1,119 +1,126 @@
+import asyncio
+import itertools
+from contextlib import contextmanager
 from telethon.sync import TelegramClient
+from telethon.errors import FloodWaitError
+from telethon.sessions import StringSession
 from telethon.tl.functions.users import GetFullUserRequest
-import pickle
+from backend import *
+
+
+# Context manager turning Telegram's FloodWait into a ThrottledError.
+@contextmanager
+def _flood_wait():
+    try:
+        yield
+    except FloodWaitError as e:
+        raise ThrottledError(e.seconds)
 
 
 # This class contains all the methods to establish a connection with the
 # Telegram service using telethon API. It is initialized using a phone
-# number associated to a Telegram account.
-class TgFuseWrapper:
+# number associated to a Telegram account. The file system is stored in
+# the self-chat ('me') of that account. Transfers are spread over a pool of
+# connections: the first client plus connections-1 clients sharing its
+# authorization. Telethon sleeps on FloodWaits shorter than
+# flood_sleep_threshold seconds, longer ones raise ThrottledError (0 leaves
+# all of them to the transfer scheduler). A lazy wrapper connects on its
+# first call instead of when created (the session must be authorized
+# already, the login can't be interactive then).
+class TgFuseWrapper(StorageBackend):
     # To obtain your Telegram's id and hash,
     # enter https://core.telegram.org/api/obtaining_api_id
     # and follow the steps.
     api_id = None
     api_hash = None
 
-    def __init__(self, number):
+    def __init__(self, number, connections=1, flood_sleep_threshold=60, lazy=False):
+        self.number = number
+        self.connections = connections
+        self.flood_sleep_threshold = flood_sleep_threshold
         # create and save the client with default api keys
-        self.client = TelegramClient('anon', TgFuseWrapper.api_id, TgFuseWrapper.api_hash)
+        self.client = TelegramClient('anon', TgFuseWrapper.api_id, TgFuseWrapper.api_hash,
+                                     flood_sleep_threshold=flood_sleep_threshold)
+        # the connection being established (None until the first call)
+        self.connecting = None
+        if not lazy:
+            asyncio.get_event_loop().run_until_complete(self.connect())
+
+    # Routine to start the client and connect the other clients of the
+    # pool. Concurrent calls share a single connection attempt.
+    async def connect(self):
+        if self.connecting is None:
+            self.connecting = asyncio.ensure_future(self._connect())
+        connecting = self.connecting
+        try:
+            await asyncio.shield(connecting)
+        except:
+            # try again on the next call
+            if connecting.done() and self.connecting is connecting:
+                self.connecting = None
+            raise
+
+    async def _connect(self):
         # start the client
-        self.client.start(number)
+        await self.client.start(self.number)
+        # connect the other clients of the pool with the same authorization
+        session = StringSession.save(self.client.session)
+        clients = [self.client]
+        for _ in range(self.connections - 1):
+            client = TelegramClient(StringSession(session), TgFuseWrapper.api_id, TgFuseWrapper.api_hash,
+                                    flood_sleep_threshold=self.flood_sleep_threshold)
+            await client.connect()
+            clients.append(client)
+        self.clients = clients
+        # clients used in turns by the transfers
+        self.next_client = itertools.cycle(self.clients)
 
-    # Routine to pin a message in Telegram self-chats
-    async def _get_pinned_file(self):
+    # Routine to call one of the raw routines once connected.
+    async def _call(self, routine, *args):
+        await self.connect()
+        return await super()._call(routine, *args)
+
+    # Routine to get the id of the pinned message in the self-chat
+    async def _get_pinned_id(self):
         # WORKAROUND: to get pinned messages in PRIVATE chats
         # get full chat object which contains the pinned message id
-        full = await self.client(GetFullUserRequest('me'))
-        # get the message from its id
-        message = await self.client.get_messages('me', ids=full.pinned_msg_id)
-        # get and return the attached file as bytes (None if missing)
-        return await self.client.download_media(message, file=bytes)
+        with _flood_wait():
+            full = await self.client(GetFullUserRequest('me'))
+        # return the pinned message id (None if missing)
+        return full.pinned_msg_id
+
+    # Routine to pin a message in Telegram self-chats
+    async def _pin_data(self, message_id):
+        with _flood_wait():
+            await self.client.pin_message('me', message_id)
 
     # Routine to upload a file into the file system created in your self-chat.
-    # It receives as parameters the data of the file, a caption for the file
-    # to be uploaded and True or False in case the file already exists and
-    # needs to be replaced. The upload contents are force to be in the format
+    # It receives as parameters the data of the file and a caption for the file
+    # to be uploaded. The upload contents are force to be in the format
     # of a file document by using force_document=True in the send_file method.
-    async def _upload_data(self, data, caption=None, old_to_delete=None):
-        # upload given data
-        message = await self.client.send_file('me', file=data, caption=caption, force_document=True)
-        # if old to delete is provided then try to delete that message
-        if old_to_delete is not None:
-            await self.delete_data(old_to_delete)
-        # return the new message
-        return message
+    async def _send_data(self, data, caption=None):
+        # upload given data and return the new message id
+        with _flood_wait():
+            message = await next(self.next_client).send_file('me', file=data, caption=caption,
+                                                             force_document=True)
+        return message.id
 
     # Routine to delete a message (a file) from a self-chat by its id.
-    async def delete_data(self, message_id):
-        await self.client.delete_messages('me', message_id)
+    async def _delete_data(self, message_id):
+        with _flood_wait():
+            await next(self.next_client).delete_messages('me', message_id)
+
+    # Routine to delete several messages in a single request.
+    async def _delete_many(self, message_ids):
+        with _flood_wait():
+            await next(self.next_client).delete_messages('me', message_ids)
 
     # Routine to download the contents of a message (a file) from a self-chat by
     # its id.
     async def _download_data(self, message_id):
-        # get message by id from 'me'
-        message = await self.client.get_messages('me', ids=message_id)
-        # get and return the attached file as bytes (None if missing)
-        return await self.client.download_media(message, file=bytes)
-
-    # Routine to write and pin the contents of the superblock file.
-    # This routine is used by the mktgfs.py script to set the superblock
-    # of the file system.
-    async def write_superblock(self, superblock, should_replace=False):
-        # WORKAROUND: to get pinned messages in PRIVATE chats
-        # if the old superblock should be replaced get its message id, None otherwise
-        old_id = (await self.client(GetFullUserRequest('me'))).pinned_msg_id if should_replace else None
-        # pickle and save the superblock
-        message = await self._pickle_and_save(superblock, 'superblock', old_id)
-        # pin the message containing the superblock data
-        await message.pin()
-        # return the message id
-        return message.id
-
-    # Routine to look for the superblock pinned file within the
-    # self-chat and deserialize its contents to returned them.
-    async def read_superblock(self):
-        # get the pinned file if exists, None otherwise
-        file = await self._get_pinned_file()
-        # the superblock, None as default
-        superblock = None
-        # if existed
-        if file is not None:
-            # unpickle the superblock
-            superblock = self._unpickle(file)
-        # return the superblock or None
-        return superblock
-
-    # Routine to write contents into a file. It the file already exists
-    # its contents are replaced. It additionally receives the caption
-    # of the file.
-    async def write_data(self, data, caption=None, old_to_delete=None):
-        # pickle and save data then return the message id
-        return (await self._pickle_and_save(data, caption, old_to_delete)).id
-
-    # Routine that looks for a file within the self-chats. If the
-    # file exists then its contents are deserialized and returned.
-    async def read_data(self, message_id):
-        # get the file by id
-        file = await self._download_data(message_id)
-        # the directory data, None as default
-        data = None
-        # if existed
-        if file is not None:
-            # unpickle the data
-            data = self._unpickle(file)
-        # return the retrieved data or None
-        return data
-
-    # Routine to serialize a file and saved it into the file system
-    # created within the self-chat.
-    async def _pickle_and_save(self, obj, caption=None, old_to_delete=None):
-        # pickle the given object
-        pickled = pickle.dumps(obj)
-        # upload the pickled data and return the message
-        return await self._upload_data(pickled, caption, old_to_delete)
-
-    # Method to deserialize the contents of a file.
-    @staticmethod
-    def _unpickle(file):
-        # load (maybe changed in case of new serialization method)
-        return pickle.loads(file)
+        client = next(self.next_client)
+        with _flood_wait():
+            # get message by id from 'me'
+            message = await client.get_messages('me', ids=message_id)
+            # get and return the attached file as bytes (None if missing)
+            return await client.download_media(message, file=bytes)
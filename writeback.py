@@ -0,0 +1,120 @@
+import asyncio
+import logging
+from transfers import *
+
+log = logging.getLogger(__name__)
+
+
+# A queue of background jobs (uploads of dirty files and directories)
+# drained by a pool of workers. Jobs are identified by a key: scheduling a
+# key that is already queued keeps a single job (the latest one) and
+# scheduling a key whose job is running runs it once more afterwards, so
+# repeated updates of the same object coalesce into few uploads. Failed
+# jobs are retried after retry_delay seconds. Their transfers have
+# BACKGROUND priority.
+class WriteBack:
+    def __init__(self, workers=4, retry_delay=5):
+        # number of concurrent jobs and seconds before retrying a failure
+        self.n_workers = workers
+        self.retry_delay = retry_delay
+        # queued keys and the job to run for each pending key
+        self.queue = None
+        self.jobs = {}
+        # keys whose job is running
+        self.running = set()
+        # last error of the keys whose job failed
+        self.errors = {}
+        # worker tasks (started with the first job)
+        self.workers = []
+        # condition notified every time a job ends
+        self.cond = None
+
+    def __len__(self):
+        return len(self.jobs) + len(self.running)
+
+    # Routine to schedule the job (an async callable) for the given key.
+    def schedule(self, key, job):
+        # start the workers (it must be done inside the event loop)
+        if not self.workers:
+            self.queue = asyncio.Queue()
+            self.cond = asyncio.Condition()
+            self.workers = [asyncio.ensure_future(self._worker()) for _ in range(self.n_workers)]
+        queued = key in self.jobs
+        self.jobs[key] = job
+        # queue the key unless it is already queued or running (in which
+        # case the worker queues it again when done)
+        if not queued and key not in self.running:
+            self.queue.put_nowait(key)
+
+    # Check if the key has a job queued or running.
+    def is_busy(self, key):
+        return key in self.jobs or key in self.running
+
+    # Check if the key has a job queued (not yet started).
+    def is_pending(self, key):
+        return key in self.jobs
+
+    # Routine to drop the queued job of the given key (if any) and wait for
+    # its running job to end.
+    async def cancel(self, key):
+        self.jobs.pop(key, None)
+        self.errors.pop(key, None)
+        if key in self.running:
+            async with self.cond:
+                await self.cond.wait_for(lambda: key not in self.running)
+
+    # Routine to wait until the key has no job queued or running. If the
+    # last run of its job failed the error is raised.
+    async def wait(self, key):
+        if not self.is_busy(key):
+            return
+        async with self.cond:
+            await self.cond.wait_for(lambda: not self.is_busy(key) or key in self.errors)
+        if key in self.errors:
+            raise self.errors[key]
+
+    # Routine to wait until every job is done.
+    async def drain(self):
+        if not self.workers:
+            return
+        async with self.cond:
+            await self.cond.wait_for(lambda: not len(self))
+
+    # Routine to stop the workers.
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def _worker(self):
+        transfer_priority.set(BACKGROUND)
+        while True:
+            key = await self.queue.get()
+            # the job may have been cancelled
+            job = self.jobs.pop(key, None)
+            if job is None:
+                continue
+            self.running.add(key)
+            try:
+                await job()
+                self.errors.pop(key, None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.exception('write back of %s failed, retrying in %s seconds', key, self.retry_delay)
+                self.errors[key] = e
+                # retry later unless it was scheduled again
+                self.jobs.setdefault(key, job)
+                asyncio.get_event_loop().call_later(self.retry_delay, self._requeue, key)
+            finally:
+                self.running.discard(key)
+            # scheduled again while running: queue it
+            if key in self.jobs and key not in self.errors:
+                self.queue.put_nowait(key)
+            async with self.cond:
+                self.cond.notify_all()
+
+    def _requeue(self, key):
+        if key in self.jobs and key not in self.running:
+            self.queue.put_nowait(key)